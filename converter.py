@@ -1,10 +1,15 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import json
 import logging
+import multiprocessing
 import os
-import shutil
 
+from src.FanOutSource import FanOutSource
 from src.helper import create_source, create_writer
-from src.util import print_dict, print_hbytes
+from src.plan_util import create_plan
+from src.storage_util import copy_output, is_url, join_path
+from src.Timer import Timer, profiler
+from src.util import print_dict, print_hbytes, parse_hbytes, parse_part, parse_selection
 
 
 def init_logging(log_filename, verbose=False):
@@ -22,15 +27,76 @@ def init_logging(log_filename, verbose=False):
 
 
 def convert(input_filename, output_folder, alt_output_folder=None,
-            output_format='omezarr2', show_progress=False, verbose=False):
+            output_format='omezarr2', show_progress=False, verbose=False,
+            profile_folder=None, use_cprofile=False, max_memory=None,
+            storage_options=None, upload_concurrency=None, fuse_fields=False, selection=None,
+            checksums=False, cache_size=None, part=None, finalize=False, staging_folder=None, staging_size=None,
+            progressive=False, plan=False, init_parts=False, merge_trace=True):
+    # merge_trace: merge the profiling traces of all processes at the end; False for parts / server workers,
+    # whose traces are merged by the coordinating process
 
     logging.info(f'Importing {input_filename}')
-    source = create_source(input_filename)
-    writer, output_ext = create_writer(output_format, verbose=verbose)
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
+    # profiling may already be enabled by a coordinating convert_parts
+    own_profile = bool(profile_folder) and not profiler.enabled
+    if own_profile:
+        profiler.enable(profile_folder, name='convert', use_cprofile=use_cprofile, is_main=merge_trace)
+    try:
+        return _convert(input_filename, output_folder, alt_output_folder=alt_output_folder,
+                        output_format=output_format, show_progress=show_progress, verbose=verbose,
+                        max_memory=max_memory, storage_options=storage_options,
+                        upload_concurrency=upload_concurrency, fuse_fields=fuse_fields, selection=selection,
+                        checksums=checksums, cache_size=cache_size, part=part, finalize=finalize,
+                        staging_folder=staging_folder, staging_size=staging_size, progressive=progressive,
+                        plan=plan, init_parts=init_parts)
+    finally:
+        if own_profile:
+            trace_filename = profiler.disable()
+            logging.info(f'Profile trace written to {trace_filename}')
 
-    metadata = source.init_metadata()
+
+def _convert(input_filename, output_folder, alt_output_folder=None,
+             output_format='omezarr2', show_progress=False, verbose=False, max_memory=None,
+             storage_options=None, upload_concurrency=None, fuse_fields=False, selection=None,
+             checksums=False, cache_size=None, part=None, finalize=False, staging_folder=None, staging_size=None,
+             progressive=False, plan=False, init_parts=False):
+    max_memory = parse_hbytes(max_memory)
+    cache_size = parse_hbytes(cache_size)
+    staging_size = parse_hbytes(staging_size)
+    part = parse_part(part)
+    if isinstance(storage_options, str):
+        storage_options = json.loads(storage_options)
+    if selection:
+        selection = parse_selection(**selection)
+    # several output formats (list or comma separated) are written from a single read of the source
+    if isinstance(output_format, str):
+        output_format = output_format.split(',')
+    output_formats = [format1.strip() for format1 in output_format]
+    source = create_source(input_filename, max_memory=max_memory, fuse_fields=fuse_fields, selection=selection,
+                           cache_size=cache_size, staging_folder=staging_folder, staging_size=staging_size)
+    writers = [create_writer(format1, verbose=verbose, max_memory=max_memory, storage_options=storage_options,
+                             concurrency=upload_concurrency, checksums=checksums, progressive=progressive)
+               for format1 in output_formats]
+    if part is not None or finalize or init_parts:
+        if len(writers) > 1 or not hasattr(writers[0][0], 'write_part'):
+            raise ValueError(f'Conversion in parts is not supported for {",".join(output_formats)}')
+    if plan:
+        # dry run: estimates only, nothing is written
+        with Timer('init metadata', verbose=verbose):
+            source.init_metadata()
+        result = create_plan(source, output_formats, writers, max_memory=max_memory)
+        source.close()
+        if verbose:
+            print(print_dict(result))
+        return json.dumps(result)
+    if is_url(output_folder):
+        for format1, (_, output_ext) in zip(output_formats, writers):
+            if '.zarr' not in output_ext:
+                raise ValueError(f'Output to {output_folder} is not supported for {format1}')
+    elif not os.path.exists(output_folder):
+        os.makedirs(output_folder, exist_ok=True)
+
+    with Timer('init metadata', verbose=verbose):
+        metadata = source.init_metadata()
     if verbose:
         print(print_dict(metadata))
         print()
@@ -38,30 +104,97 @@ def convert(input_filename, output_folder, alt_output_folder=None,
             print(source.print_well_matrix())
             print(source.print_timepoint_well_matrix())
         print(f'Total data size:    {print_hbytes(source.get_total_data_size())}')
+    if max_memory and source.get_total_data_size() > max_memory:
+        logging.info(f'Data size exceeds memory budget of {print_hbytes(max_memory)}: '
+                     f'converting oversized images in slabs')
 
     name = source.get_name()
-    output_path = os.path.join(output_folder, name + output_ext)
-    writer.write(output_path, source, name=name)
+    output_paths = [join_path(output_folder, name + output_ext) for _, output_ext in writers]
+    with Timer(f'write {name}', verbose=verbose, args={'output_path': ', '.join(output_paths)}):
+        if init_parts:
+            writers[0][0].init_parts(output_paths[0], source)
+        elif part is not None:
+            writers[0][0].write_part(output_paths[0], source, *part, name=name)
+        elif finalize:
+            writers[0][0].finalize(output_paths[0], source, name=name)
+        elif len(writers) > 1:
+            write_fan_out([writer for writer, _ in writers], output_paths, source, name=name)
+        else:
+            writers[0][0].write(output_paths[0], source, name=name)
     source.close()
 
     if show_progress:
-        print(f'Converting {input_filename} to {output_path}')
-
-    message = f'Exported  {output_path}'
-    result = {'name': name, 'full_path': output_path}
-    if alt_output_folder:
-        if not os.path.exists(alt_output_folder):
-            os.makedirs(alt_output_folder)
-        alt_output_path = os.path.join(alt_output_folder, name + output_ext)
-        if 'zar' in output_format:
-            shutil.copytree(output_path, alt_output_path, dirs_exist_ok=True)
-        else:
-            shutil.copy2(output_path, alt_output_path)
-        result['alt_path'] = alt_output_path
-        message += f' and {alt_output_path}'
+        print(f'Converting {input_filename} to {", ".join(output_paths)}')
+
+    if init_parts:
+        return json.dumps([{'name': name, 'full_path': output_paths[0]}])
+    if part is not None:
+        # the output is complete after finalize
+        result = {'name': name, 'full_path': output_paths[0], 'part': f'{part[0]}/{part[1]}'}
+        logging.info(f'Exported part {result["part"]} of {output_paths[0]}')
+        return json.dumps([result])
+
+    results = []
+    for output_path, (_, output_ext) in zip(output_paths, writers):
+        message = f'Exported  {output_path}'
+        result = {'name': name, 'full_path': output_path}
+        if alt_output_folder:
+            if not is_url(alt_output_folder) and not os.path.exists(alt_output_folder):
+                os.makedirs(alt_output_folder)
+            alt_output_path = join_path(alt_output_folder, name + output_ext)
+            copy_output(output_path, alt_output_path, recursive=output_ext.endswith('.zarr'),
+                        storage_options=storage_options)
+            result['alt_path'] = alt_output_path
+            message += f' and {alt_output_path}'
+
+        logging.info(message)
+        if show_progress:
+            print(message)
+        results.append(result)
+
+    return json.dumps(results)
+
+
+def write_fan_out(writers, output_paths, source, name=None):
+    # all writers in parallel, sharing each field read from the source
+    # lazy fields (beyond the memory budget) share their computed chunks within a part of the budget
+    max_memory = getattr(source, 'max_memory', None)
+    shared_source = FanOutSource(source, len([writer for writer in writers if writer.reads_data]),
+                                 cache_size=max_memory // 4 if max_memory else 0)
+
+    def write(writer, output_path):
+        try:
+            writer.write(output_path, shared_source if writer.reads_data else source, name=name)
+        except Exception as error:
+            shared_source.abort(error)
+            raise
+
+    with ThreadPoolExecutor(max_workers=len(writers)) as executor:
+        futures = [executor.submit(write, writer, output_path) for writer, output_path in zip(writers, output_paths)]
+        for future in futures:
+            future.result()
+    logging.info(f'{shared_source.nloads} source reads shared by {len(writers)} writers')
 
-    logging.info(message)
-    if show_progress:
-        print(message)
 
-    return json.dumps([result])
+def convert_parts(input_filename, output_folder, nparts, **kwargs):
+    # distributed conversion on the local machine: each part (a subset of the wells) in a separate process,
+    # as on separate nodes with: main.py --part <index>/<nparts> ... and then main.py --finalize ...
+    # profiling: a single trace of this process and the part processes
+    profile_folder = kwargs.get('profile_folder')
+    if profile_folder:
+        profiler.enable(profile_folder, name='convert', use_cprofile=kwargs.get('use_cprofile', False))
+    try:
+        with Timer(f'convert {nparts} parts', verbose=kwargs.get('verbose', False)):
+            # the output folder and root group are created once, before the parts write into them
+            convert(input_filename, output_folder, init_parts=True, **kwargs)
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=nparts, mp_context=context) as executor:
+                futures = [executor.submit(convert, input_filename, output_folder, part=(part_index, nparts),
+                                           merge_trace=False, **kwargs)
+                           for part_index in range(nparts)]
+                for future in futures:
+                    future.result()
+            return convert(input_filename, output_folder, finalize=True, **kwargs)
+    finally:
+        if profile_folder:
+            logging.info(f'Profile trace written to {profiler.disable()}')
@@ -1,32 +1,80 @@
 import sys
 import argparse
 
-from converter import convert, init_logging
+from converter import convert, convert_parts, init_logging
 
 
-parser = argparse.ArgumentParser(description='Convert file to ome format')
-parser.add_argument('--inputfile', required=True, help='input file')
-parser.add_argument('--outputfolder', required=True, help='output folder')
-parser.add_argument('--altoutputfolder', help='alternative output folder')
-parser.add_argument('--outputformat', help='output format version', default='omezarr2')
-parser.add_argument('--show_progress', action='store_true')
-parser.add_argument('--verbose', action='store_true')
-args = parser.parse_args()
+if __name__ == '__main__':
+    # guarded: --parts spawns processes, re-importing this module
+    parser = argparse.ArgumentParser(description='Convert file to ome format')
+    parser.add_argument('--inputfile', required=True, help='input file, or folder of tiff files')
+    parser.add_argument('--outputfolder', required=True, help='output folder or url (e.g. s3://bucket/folder)')
+    parser.add_argument('--altoutputfolder', help='alternative output folder or url')
+    parser.add_argument('--storage_options', help='fsspec storage options for output urls, as json string')
+    parser.add_argument('--upload_concurrency', type=int, help='number of concurrent chunk writes / uploads')
+    parser.add_argument('--outputformat', default='omezarr2',
+                        help='output format: omezarr2, omezarr3, omezarr_ref (virtual: references to the source tiles) '
+                             'or ometiff; several formats (comma separated) are written from a single read')
+    parser.add_argument('--fuse_fields', action='store_true',
+                        help='write each well as a single fused mosaic image instead of separate fields')
+    parser.add_argument('--wells', help='subset of wells to convert, e.g. B2,B3')
+    parser.add_argument('--fields', help='subset of fields (indices) to convert, e.g. 0,1')
+    parser.add_argument('--channels', help='subset of channels (indices) to convert, e.g. 0')
+    parser.add_argument('--time_points', help='time point (range) to convert, e.g. 0-3')
+    parser.add_argument('--level', type=int, help='source pyramid level to convert')
+    parser.add_argument('--crop', help='x/y crop of each field in pixels: x,y,width,height')
+    parser.add_argument('--checksums', action='store_true',
+                        help='write a manifest of chunk and source tile checksums, to check the output with verify.py')
+    parser.add_argument('--show_progress', action='store_true')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--max_memory', '--max-memory', help='memory budget, e.g. 4G: larger images are converted in slabs')
+    parser.add_argument('--cache_size', help='byte budget of the cache of assembled wells, e.g. 2G (default: 0, keeps only the last well)')
+    parser.add_argument('--plan', action='store_true',
+                        help='dry run: estimate output size, memory and runtime, and recommend workers and memory')
+    parser.add_argument('--progressive', action='store_true',
+                        help='write a low resolution preview of the whole plate first (ome-zarr)')
+    parser.add_argument('--staging_folder',
+                        help='local (SSD) folder for copies of the input files on a network share, reused across runs')
+    parser.add_argument('--staging_size', help='byte budget of the staging folder, e.g. 200G (default: unlimited)')
+    parser.add_argument('--part', help='distributed conversion: convert part <index>/<count> of the wells, e.g. 0/4')
+    parser.add_argument('--finalize', action='store_true',
+                        help='distributed conversion: complete the plate after all parts are converted')
+    parser.add_argument('--parts', type=int, help='distributed conversion in this number of local processes')
+    parser.add_argument('--profile', help='output folder for profiling trace (Chrome trace / Perfetto) and memory usage')
+    parser.add_argument('--cprofile', action='store_true', help='add cProfile statistics to profiling output')
+    args = parser.parse_args()
 
-init_logging('db_to_zarr.log', verbose=args.verbose)
+    init_logging('db_to_zarr.log', verbose=args.verbose)
 
-result = convert(
-    args.inputfile,
-    args.outputfolder,
-    alt_output_folder = args.altoutputfolder,
-    output_format = args.outputformat,
-    show_progress = args.show_progress,
-    verbose = args.verbose
-)
+    options = dict(
+        alt_output_folder = args.altoutputfolder,
+        output_format = args.outputformat,
+        show_progress = args.show_progress,
+        verbose = args.verbose,
+        profile_folder = args.profile,
+        use_cprofile = args.cprofile,
+        max_memory = args.max_memory,
+        cache_size = args.cache_size,
+        staging_folder = args.staging_folder,
+        staging_size = args.staging_size,
+        storage_options = args.storage_options,
+        upload_concurrency = args.upload_concurrency,
+        fuse_fields = args.fuse_fields,
+        selection = {'wells': args.wells, 'fields': args.fields, 'channels': args.channels,
+                     'time_points': args.time_points, 'level': args.level, 'crop': args.crop},
+        checksums = args.checksums,
+        progressive = args.progressive,
+        plan = args.plan
+    )
 
-if result and result != '{}':
-    print(result)
-    sys.exit(0)
-else:
-    print('Error')
-    sys.exit(1)
+    if args.parts and not args.plan:
+        result = convert_parts(args.inputfile, args.outputfolder, args.parts, **options)
+    else:
+        result = convert(args.inputfile, args.outputfolder, part=args.part, finalize=args.finalize, **options)
+
+    if result and result != '{}':
+        print(result)
+        sys.exit(0)
+    else:
+        print('Error')
+        sys.exit(1)
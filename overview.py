@@ -0,0 +1,22 @@
+import argparse
+import json
+
+from converter import init_logging
+from src.overview_util import create_plate_overview
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render a plate overview and well thumbnails from the coarsest level')
+    parser.add_argument('--inputfile', required=True, help='input file')
+    parser.add_argument('--outputfolder', required=True, help='output folder for overview.png, thumbnails and overview.json')
+    parser.add_argument('--thumbnail_size', type=int, default=256, help='maximum thumbnail width / height')
+    parser.add_argument('--max_size', type=int, default=4096, help='maximum overview width / height')
+    parser.add_argument('--time_point', type=int, help='time point to render (default: first)')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    init_logging('db_to_zarr.log', verbose=args.verbose)
+
+    index = create_plate_overview(args.inputfile, args.outputfolder, thumbnail_size=args.thumbnail_size,
+                                  max_size=args.max_size, time_point=args.time_point, verbose=args.verbose)
+    print(json.dumps({'overview': index['overview'], 'wells': len(index['wells'])}))
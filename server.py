@@ -0,0 +1,18 @@
+import argparse
+
+from converter import init_logging
+from src.ConversionServer import ConversionServer
+
+
+if __name__ == '__main__':
+    # guarded: worker processes are spawned, re-importing this module
+    parser = argparse.ArgumentParser(description='Conversion server: warm workers accepting convert jobs over http')
+    parser.add_argument('--host', default='127.0.0.1', help='host address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=1, help='number of (warm) conversion worker processes')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    init_logging('log/server.log', verbose=args.verbose)
+    server = ConversionServer(host=args.host, port=args.port, nworkers=args.workers, log_filename='log/server.log')
+    server.serve_forever()
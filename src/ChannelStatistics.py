@@ -0,0 +1,156 @@
+# Incremental per-channel intensity statistics (histogram, min/max, percentiles), updated with each written block
+
+import numpy as np
+import threading
+
+
+# values per bincount call, bounding its (intp) temporary copy
+BINCOUNT_CHUNK_SIZE = 1024 * 1024
+
+
+class ChannelStatistics(object):
+    def __init__(self, dtype, nchannels=1, nbins=4096):
+        self.dtype = np.dtype(dtype)
+        self.nchannels = nchannels
+        self.lock = threading.Lock()
+        if self.dtype.kind in 'ui' and self.dtype.itemsize <= 2:
+            # exact histogram over the full integer range
+            info = np.iinfo(self.dtype)
+            self.offset = -int(info.min)
+            self.nbins = int(info.max) - int(info.min) + 1
+            self.exact = True
+        else:
+            # bins over the values seen (start, width), doubled in width (merging bin pairs) to include new values
+            self.nbins = nbins + nbins % 2
+            self.exact = False
+        self.ranges = [None] * nchannels
+        self.histograms = np.zeros((nchannels, self.nbins), dtype=np.int64)
+        self.mins = [None] * nchannels
+        self.maxs = [None] * nchannels
+
+    def update(self, data, channel_axis=None, channel_offset=0):
+        if channel_axis is None:
+            planes = [(channel_offset, data)]
+        else:
+            planes = [(channel_offset + index, data[(slice(None),) * channel_axis + (index,)])
+                      for index in range(data.shape[channel_axis])]
+        for channel, plane in planes:
+            if plane.size == 0 or channel >= self.nchannels:
+                continue
+            values = plane.ravel()
+            min_value, max_value = values.min(), values.max()
+            if self.exact:
+                histogram = self._bincount(values)
+            else:
+                with self.lock:
+                    self._grow_range(channel, min_value, max_value)
+                    value_range = self.ranges[channel]
+                histogram, _ = np.histogram(values, bins=self.nbins,
+                                            range=(value_range[0], value_range[0] + value_range[1]))
+            with self.lock:
+                if not self.exact and self.ranges[channel] != value_range:
+                    # range grown by another thread meanwhile
+                    histogram = self._rebin(channel, histogram, value_range)
+                self.histograms[channel] += histogram
+                if self.mins[channel] is None or min_value < self.mins[channel]:
+                    self.mins[channel] = min_value
+                if self.maxs[channel] is None or max_value > self.maxs[channel]:
+                    self.maxs[channel] = max_value
+
+    def _grow_range(self, channel, min_value, max_value):
+        min_value, max_value = float(min_value), float(max_value)
+        if self.ranges[channel] is None:
+            self.ranges[channel] = min_value, (max_value - min_value) or 1.0
+            return
+        start, width = self.ranges[channel]
+        histogram = self.histograms[channel]
+        while min_value < start or max_value > start + width:
+            merged = histogram.reshape(-1, 2).sum(axis=1)
+            histogram = np.zeros_like(histogram)
+            if min_value < start:
+                histogram[self.nbins // 2:] = merged
+                start -= width
+            else:
+                histogram[:self.nbins // 2] = merged
+            width *= 2
+        self.histograms[channel] = histogram
+        self.ranges[channel] = start, width
+
+    def _rebin(self, channel, histogram, value_range):
+        # counts of bins over another (covered) range, at their bin centers
+        start, width = value_range
+        centers = start + (np.arange(len(histogram)) + 0.5) * width / len(histogram)
+        channel_start, channel_width = self.ranges[channel]
+        indices = np.clip(((centers - channel_start) / channel_width * self.nbins).astype(np.int64),
+                          0, self.nbins - 1)
+        return np.bincount(indices, weights=histogram, minlength=self.nbins).astype(np.int64)
+
+    def _bincount(self, values):
+        # counted in sub-chunks: bincount converts its input to intp. Signed values are shifted (value + offset) by
+        # flipping the sign bit of the unsigned view, keeping the item size
+        if self.dtype.kind == 'i':
+            values = values.view(f'u{self.dtype.itemsize}')
+        histogram = np.zeros(self.nbins, dtype=np.int64)
+        for start in range(0, values.size, BINCOUNT_CHUNK_SIZE):
+            chunk = values[start:start + BINCOUNT_CHUNK_SIZE]
+            if self.dtype.kind == 'i':
+                chunk = chunk ^ np.array(self.offset, dtype=chunk.dtype)
+            histogram += np.bincount(chunk, minlength=self.nbins)
+        return histogram
+
+    def to_dict(self):
+        # sparse histograms, to combine statistics collected in separate processes
+        channels = []
+        for channel in range(self.nchannels):
+            bins = np.flatnonzero(self.histograms[channel])
+            min_value, max_value = self.mins[channel], self.maxs[channel]
+            channels.append({'bins': bins.tolist(), 'counts': self.histograms[channel][bins].tolist(),
+                             'range': self.ranges[channel],
+                             'min': np.asarray(min_value).item() if min_value is not None else None,
+                             'max': np.asarray(max_value).item() if max_value is not None else None})
+        return {'nbins': self.nbins, 'channels': channels}
+
+    def update_from_dict(self, statistics):
+        if statistics['nbins'] != self.nbins:
+            raise ValueError(f'Incompatible statistics: {statistics["nbins"]} bins, expected {self.nbins}')
+        with self.lock:
+            for channel, values in enumerate(statistics['channels'][:self.nchannels]):
+                if values['min'] is None:
+                    continue
+                histogram = np.zeros(self.nbins, dtype=np.int64)
+                histogram[values['bins']] = values['counts']
+                if not self.exact:
+                    self._grow_range(channel, values['range'][0], values['range'][0] + values['range'][1])
+                    histogram = self._rebin(channel, histogram, values['range'])
+                self.histograms[channel] += histogram
+                if self.mins[channel] is None or values['min'] < self.mins[channel]:
+                    self.mins[channel] = values['min']
+                if self.maxs[channel] is None or values['max'] > self.maxs[channel]:
+                    self.maxs[channel] = values['max']
+
+    def get_percentile(self, channel, percentile):
+        histogram = self.histograms[channel]
+        total = histogram.sum()
+        if total == 0:
+            return None
+        index = int(np.searchsorted(np.cumsum(histogram), total * percentile / 100))
+        index = min(index, self.nbins - 1)
+        if self.exact:
+            return index - self.offset
+        start, width = self.ranges[channel]
+        value = start + (index + 0.5) * width / self.nbins
+        return float(value) if self.dtype.kind == 'f' else int(value)
+
+    def get_window(self, channel, min_percentile=0.1, max_percentile=99.9):
+        if channel >= self.nchannels or self.mins[channel] is None:
+            return None
+        start = self.get_percentile(channel, min_percentile)
+        end = self.get_percentile(channel, max_percentile)
+        if self.dtype.kind == 'f':
+            min_value, max_value = float(self.mins[channel]), float(self.maxs[channel])
+        else:
+            min_value, max_value = int(self.mins[channel]), int(self.maxs[channel])
+        # within the values seen, start <= end
+        start = min(max(start, min_value), max_value)
+        end = min(max(end, start), max_value)
+        return {'start': start, 'end': end, 'min': min_value, 'max': max_value}
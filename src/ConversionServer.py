@@ -0,0 +1,290 @@
+# Warm conversion server: worker processes keep the converter, sources and writers (zarr, ome_zarr, ...) imported,
+# and convert() jobs are submitted over a local HTTP json API:
+# POST /jobs (convert() arguments), GET /jobs, GET /jobs/<id>, DELETE /jobs/<id> (cancel), GET /status
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib
+import inspect
+import json
+import logging
+import multiprocessing
+import queue
+import sys
+import threading
+import uuid
+
+from src.Timer import merge_process_traces
+
+
+# imported by the workers before accepting jobs (sources and writers are otherwise imported on first use)
+PRELOAD_MODULES = ['zarr', 'ome_zarr', 'dask.array', 'tifffile', 'src.ImageDbSource', 'src.TiffSource',
+                   'src.TiffFolderSource', 'src.ISyntaxSource', 'src.OmeZarrWriter', 'src.OmeTiffWriter',
+                   'src.OmeZarrReferenceWriter']
+
+
+def _worker_main(conn, log_filename):
+    from converter import convert, init_logging
+
+    init_logging(log_filename)
+    preloaded = []
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+            preloaded.append(module)
+        except ImportError as error:
+            # optional dependency
+            logging.info(f'Worker: not preloading {module}: {error}')
+    conn.send(('ready', preloaded))
+    while True:
+        try:
+            params = conn.recv()
+        except EOFError:
+            break
+        if params is None:
+            break
+        try:
+            modules = set(sys.modules)
+            # profiling traces are merged by the server
+            result = convert(**dict(params, merge_trace=False))
+            logging.info(f'Worker: modules imported by the job: {sorted(set(sys.modules) - modules)}')
+            conn.send(('done', json.loads(result)))
+        except Exception as error:
+            logging.exception(f'Conversion failed: {params}')
+            conn.send(('failed', f'{type(error).__name__}: {error}'))
+
+
+class ConversionWorker:
+    def __init__(self, context, log_filename):
+        self.context = context
+        self.log_filename = log_filename
+        self.start()
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=_worker_main, args=(child_conn, self.log_filename), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def restart(self):
+        self.terminate()
+        self.start()
+
+    def terminate(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self, timeout=10):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.terminate()
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status, value):
+        content = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _get_job_id(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        server = self.server.conversion_server
+        if self.path.rstrip('/') == '/jobs':
+            self._send_json(200, server.list_jobs())
+        elif self.path.rstrip('/') == '/status':
+            self._send_json(200, server.get_status())
+        else:
+            job = server.get_job(self._get_job_id())
+            if job is None:
+                self._send_json(404, {'error': f'Unknown job: {self.path}'})
+            else:
+                self._send_json(200, job)
+
+    def do_POST(self):
+        server = self.server.conversion_server
+        if self.path.rstrip('/') != '/jobs':
+            self._send_json(404, {'error': f'Unknown path: {self.path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            params = json.loads(self.rfile.read(length) or b'{}')
+            job = server.submit(params)
+        except ValueError as error:
+            self._send_json(400, {'error': str(error)})
+            return
+        self._send_json(202, job)
+
+    def do_DELETE(self):
+        server = self.server.conversion_server
+        job_id = self._get_job_id()
+        if server.get_job(job_id) is None:
+            self._send_json(404, {'error': f'Unknown job: {self.path}'})
+        elif not server.cancel(job_id):
+            self._send_json(409, server.get_job(job_id))
+        else:
+            self._send_json(200, server.get_job(job_id))
+
+    def log_message(self, format, *args):
+        logging.info(f'{self.address_string()} {format % args}')
+
+
+class ConversionServer:
+    finished_states = ('done', 'failed', 'cancelled')
+
+    def __init__(self, host='127.0.0.1', port=8000, nworkers=1, log_filename='log/server.log'):
+        from converter import convert
+
+        self.convert_params = list(inspect.signature(convert).parameters)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        context = multiprocessing.get_context('spawn')
+        self.workers = [ConversionWorker(context, log_filename) for _ in range(nworkers)]
+        self.dispatchers = [threading.Thread(target=self._dispatch, args=(worker,), daemon=True)
+                            for worker in self.workers]
+        self.http_server = ThreadingHTTPServer((host, port), JobRequestHandler)
+        self.http_server.conversion_server = self
+        self.http_thread = None
+
+    @property
+    def address(self):
+        host, port = self.http_server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        for dispatcher in self.dispatchers:
+            dispatcher.start()
+        self.http_thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.http_thread.start()
+        logging.info(f'Conversion server listening on {self.address} with {len(self.workers)} workers')
+
+    def serve_forever(self):
+        self.start()
+        try:
+            self.http_thread.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        with self.lock:
+            for job in self.jobs.values():
+                if job['status'] == 'queued':
+                    self._set_finished(job, 'cancelled')
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.stop()
+
+    def submit(self, params):
+        if not isinstance(params, dict):
+            raise ValueError('Job parameters should be a json object with convert() arguments')
+        unknown = [key for key in params if key not in self.convert_params]
+        if unknown:
+            raise ValueError(f'Unknown convert() arguments: {unknown}')
+        for key in ['input_filename', 'output_folder']:
+            if key not in params:
+                raise ValueError(f'Missing convert() argument: {key}')
+        job = {'id': uuid.uuid4().hex, 'status': 'queued', 'params': params, 'result': None, 'error': None,
+               'submitted': datetime.now().isoformat(), 'started': None, 'finished': None}
+        with self.lock:
+            self.jobs[job['id']] = job
+        self.queue.put(job['id'])
+        logging.info(f'Job {job["id"]} queued: {params}')
+        return dict(job)
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def list_jobs(self):
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def get_status(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+        return {'workers': len(self.workers), 'queued': self.queue.qsize(), 'jobs': counts}
+
+    def cancel(self, job_id):
+        # queued jobs are removed from the queue, running jobs are stopped by restarting their worker
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['status'] in self.finished_states:
+                return False
+            if job['status'] == 'queued':
+                self._set_finished(job, 'cancelled')
+            else:
+                job['status'] = 'cancelling'
+        logging.info(f'Job {job_id} cancelled')
+        return True
+
+    def _set_finished(self, job, status, result=None, error=None):
+        job['status'] = status
+        job['result'] = result
+        job['error'] = error
+        job['finished'] = datetime.now().isoformat()
+
+    def _dispatch(self, worker):
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                break
+            with self.lock:
+                job = self.jobs[job_id]
+                if job['status'] != 'queued':
+                    continue
+                job['status'] = 'running'
+                job['started'] = datetime.now().isoformat()
+            pid = worker.process.pid
+            try:
+                worker.conn.send(job['params'])
+                status, value = self._wait_result(worker, job)
+            except (EOFError, OSError) as error:
+                status, value = 'failed', f'Worker error: {error!r}'
+            with self.lock:
+                if status == 'cancelled' or job['status'] == 'cancelling':
+                    self._set_finished(job, 'cancelled')
+                elif status == 'done':
+                    self._set_finished(job, status, result=value)
+                else:
+                    self._set_finished(job, 'failed', error=value)
+            if status == 'cancelled' or not worker.process.is_alive():
+                worker.restart()
+            if job['params'].get('profile_folder'):
+                # the trace of the job's worker process (also if cancelled)
+                trace_filename = merge_process_traces(job['params']['profile_folder'], 'convert', pid=pid,
+                                                      output_name=f'job-{job_id}')
+                with self.lock:
+                    job['trace'] = trace_filename
+            logging.info(f'Job {job_id} {job["status"]}')
+
+    def _wait_result(self, worker, job):
+        while True:
+            if worker.conn.poll(0.1):
+                status, value = worker.conn.recv()
+                if status != 'ready':
+                    return status, value
+            elif job['status'] == 'cancelling':
+                return 'cancelled', None
+            elif not worker.process.is_alive():
+                return 'failed', f'Worker process exited with code {worker.process.exitcode}'
@@ -1,10 +1,19 @@
+import pathlib
 import sqlite3
+import threading
 
 
 class DBReader:
-    def __init__(self, db_file):
-        self.conn = sqlite3.connect(db_file)
-        self.conn.row_factory = DBReader.dict_factory
+    # thread-safe: each thread reads with its own (read-only) connection, all closed together by close()
+    def __init__(self, db_file, read_only=True):
+        self.db_file = db_file
+        self.read_only = read_only
+        self.local = threading.local()
+        self.connections = []
+        self.query_cache = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.get_connection()
 
     @staticmethod
     def dict_factory(cursor, row):
@@ -13,15 +22,52 @@ class DBReader:
             dct[column[0]] = row[index]
         return dct
 
-    def fetch_all(self, query, params=(), return_dicts=True):
-        cursor = self.conn.cursor()
+    @property
+    def conn(self):
+        return self.get_connection()
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            with self.lock:
+                if self.closed:
+                    raise ValueError(f'Database {self.db_file} is closed')
+                if self.read_only:
+                    uri = pathlib.Path(self.db_file).absolute().as_uri() + '?mode=ro'
+                    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                else:
+                    conn = sqlite3.connect(self.db_file, check_same_thread=False)
+                conn.row_factory = DBReader.dict_factory
+                self.connections.append(conn)
+            self.local.conn = conn
+        return conn
+
+    def fetch_all(self, query, params=(), return_dicts=True, cache=False):
+        # cache: share the result of (metadata) queries between all threads; rows should not be modified
+        key = (query, tuple(params), return_dicts)
+        if cache:
+            with self.lock:
+                values = self.query_cache.get(key)
+            if values is not None:
+                return list(values)
+        cursor = self.get_connection().cursor()
         cursor.execute(query, params)
         dct = cursor.fetchall()
         if return_dicts:
             values = dct
         else:
             values = [list(row.values())[0] for row in dct]
+        if cache:
+            with self.lock:
+                self.query_cache[key] = values
+            values = list(values)
         return values
 
     def close(self):
-        self.conn.close()
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+            self.query_cache = {}
+            self.closed = True
+        self.local = threading.local()
@@ -0,0 +1,91 @@
+# Shares the data read from a source between several writers running in parallel:
+# each (well, field) is read once and kept until all writers have taken it.
+# Writers should request the data in the same order; the number of fields held is limited by max_pending.
+# Lazy (dask) fields are not materialised: their chunks are computed once and shared through a byte bounded cache,
+# as long as the writers read the chunks of a field at about the same time.
+
+import dask
+import dask.array as da
+import numpy as np
+import threading
+
+from src.LruCache import LruCache
+
+
+class FanOutSource(object):
+    def __init__(self, source, nconsumers, max_pending=2, cache_size=0):
+        self.source = source
+        self.nconsumers = nconsumers
+        self.max_pending = max_pending
+        self.pending = {}
+        self.nloads = 0
+        self.error = None
+        self.condition = threading.Condition()
+        # computed chunks of lazy fields (the last chunk is always kept)
+        self.chunk_cache = LruCache(cache_size)
+
+    def __getattr__(self, name):
+        # all other methods / attributes of the source
+        return getattr(self.source, name)
+
+    def get_data(self, well_id=None, field_id=None):
+        key = well_id, field_id
+        with self.condition:
+            while True:
+                if self.error is not None:
+                    raise RuntimeError(f'Aborted: another writer failed ({self.error!r})')
+                entry = self.pending.get(key)
+                if entry is not None or len(self.pending) < self.max_pending:
+                    break
+                # wait for the other writers to catch up
+                self.condition.wait()
+            if entry is None:
+                entry = {'data': None, 'loaded': threading.Event(), 'remaining': self.nconsumers}
+                self.pending[key] = entry
+                load = True
+            else:
+                load = False
+        if load:
+            try:
+                data = self.source.get_data(well_id, field_id)
+                if isinstance(data, da.Array) and self.nconsumers > 1:
+                    data = self._share_chunks(key, data)
+                entry['data'] = data
+                with self.condition:
+                    self.nloads += 1
+            except Exception as error:
+                self.abort(error)
+                raise
+            finally:
+                entry['loaded'].set()
+        entry['loaded'].wait()
+        with self.condition:
+            if self.error is not None:
+                raise RuntimeError(f'Aborted: another writer failed ({self.error!r})')
+            entry['remaining'] -= 1
+            if entry['remaining'] == 0:
+                del self.pending[key]
+                self.condition.notify_all()
+        return entry['data']
+
+    def _share_chunks(self, key, data):
+        # the same lazy array, with each chunk computed once for all writers
+        def load(region):
+            index = tuple(slice(start, stop) for start, stop in region)
+            return self.chunk_cache.get((key, region), lambda: np.asarray(data[index]))
+
+        chunks = np.empty(data.numblocks, dtype=object)
+        for block_index in np.ndindex(data.numblocks):
+            region = []
+            for dim, blocki in enumerate(block_index):
+                start = sum(data.chunks[dim][:blocki])
+                region.append((start, start + data.chunks[dim][blocki]))
+            shape = tuple(stop - start for start, stop in region)
+            chunks[block_index] = da.from_delayed(dask.delayed(load, pure=False)(tuple(region)), shape, data.dtype)
+        return da.block(chunks.tolist())
+
+    def abort(self, error):
+        # release writers waiting for data when one writer fails
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
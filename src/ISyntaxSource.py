@@ -6,8 +6,8 @@ from isyntax import ISyntax
 import numpy as np
 from xml.etree import ElementTree
 
-from ImageSource import ImageSource
-from util import get_filetitle, xml_content_to_dict
+from src.ImageSource import ImageSource
+from src.util import get_filetitle, get_slab_chunks, to_slice, xml_content_to_dict
 
 
 class ISyntaxSource(ImageSource):
@@ -65,8 +65,27 @@ class ISyntaxSource(ImageSource):
         return self.is_plate
 
     def get_data(self, well_id=None, field_id=None):
+        if self.max_memory and self.get_total_data_size() > self.max_memory:
+            import dask.array as da
+
+            chunks = get_slab_chunks((self.height, self.width), self.dtype,
+                                     self.max_memory // 8 // self.nchannels) + ((self.nchannels,),)
+
+            def read_block(block_info=None):
+                (y0, y1), (x0, x1), _ = block_info[None]['array-location']
+                return self.isyntax.read_region(x0, y0, x1 - x0, y1 - y0)
+
+            return da.map_blocks(read_block, chunks=chunks, dtype=self.dtype)
         return self.isyntax.read_region(0, 0, self.width, self.height)
 
+    def get_region(self, well_id=None, field_id=None, t=None, c=None, z=None, y=None, x=None, level=0):
+        # only the requested region is decoded, at the requested (factor 2) pyramid level
+        width, height = -(-self.width // 2 ** level), -(-self.height // 2 ** level)
+        y0, y1, ystep = to_slice(y).indices(height)
+        x0, x1, xstep = to_slice(x).indices(width)
+        data = self.isyntax.read_region(x0, y0, max(x1 - x0, 0), max(y1 - y0, 0), level=level)
+        return data[::ystep, ::xstep, to_slice(c)]
+
     def get_name(self):
         return get_filetitle(self.uri)
 
@@ -107,7 +126,7 @@ class ISyntaxSource(ImageSource):
         return []
 
     def get_total_data_size(self):
-        total_size = np.prod(self.shape)
+        total_size = np.prod(self.shape) * self.dtype.itemsize
         if self.is_plate:
             total_size *= len(self.get_wells()) * len(self.get_fields())
         return total_size
@@ -2,19 +2,37 @@
 # which is based on https://github.com/Cellular-Imaging-Amsterdam-UMC/crxReader
 # Screen Plate Well (SPW) - High Content Screening (HCS) https://ome-model.readthedocs.io/en/stable/developers/screen-plate-well.html
 
+import logging
 import numpy as np
 
 from src.DbReader import DBReader
+from src.checksum_util import hash_data
 from src.ImageSource import ImageSource
+from src.LruCache import LruCache
+from src.read_util import execute_reads
+from src.StagingCache import StagingCache
+from src.Timer import Timer
 from src.util import *
 
 
 class ImageDbSource(ImageSource):
-    def __init__(self, uri, metadata={}):
-        super().__init__(uri, metadata)
-        self.db = DBReader(self.uri)
-        self.data = None
-        self.data_well_id = None
+    def __init__(self, uri, metadata={}, max_memory=None, fuse_fields=False, selection=None, cache_size=None,
+                 staging_folder=None, staging_size=None):
+        super().__init__(uri, metadata, max_memory=max_memory)
+        # fuse_fields: a single field per well, the mosaic of all tiles placed at their recorded coordinates
+        self.fuse_fields = fuse_fields
+        # selection: subset of wells, fields, channels, time points, pyramid level and crop (see parse_selection)
+        self.selection = selection or {}
+        self.level = self.selection.get('level', 0)
+        # staging: local copies of the database files (on a network share), read instead of the originals
+        self.staging = StagingCache(staging_folder, staging_size) if staging_folder else None
+        self.db = DBReader(self.staging.get_path(self.uri) if self.staging else self.uri)
+        # assembled wells, least recently used evicted beyond the byte budget
+        # default 0: only the last well is kept (the newest entry always is), enough for writers reading a well's
+        # fields in order; a larger budget only helps when wells are revisited, e.g. by interleaved readers
+        self.cache = LruCache(cache_size or 0)
+        self.tile_hashes = None
+        self.well_shapes = {}
         self.metadata['dim_order'] = 'tczyx'
 
     def init_metadata(self):
@@ -22,18 +40,29 @@ class ImageDbSource(ImageSource):
         self._get_experiment_metadata()
         self._get_well_info()
         self._get_image_info()
+        self._get_occupancy()
         return self.metadata
 
     def _get_time_series_info(self):
         time_series_ids = sorted(self.db.fetch_all('SELECT DISTINCT TimeSeriesElementId FROM SourceImageBase', return_dicts=False))
+        if 'time_points' in self.selection:
+            start, end = self.selection['time_points']
+            time_series_ids = [time_series_id for time_series_id in time_series_ids if start <= time_series_id <= end]
+            if not time_series_ids:
+                raise ValueError(f'No time points in selected range {start}-{end}')
         self.metadata['time_points'] = time_series_ids
 
         level_ids = sorted(self.db.fetch_all('SELECT DISTINCT level FROM SourceImageBase', return_dicts=False))
+        if self.level not in level_ids:
+            raise ValueError(f'Invalid level: {self.level}. Available values: {level_ids}')
         self.metadata['levels'] = level_ids
 
         image_files = {time_series_id: os.path.join(os.path.dirname(self.uri), f'images-{time_series_id}.db')
                        for time_series_id in time_series_ids}
         self.metadata['image_files'] = image_files
+        if self.staging:
+            # copied in the background, in time point order: reads wait only for their own file
+            self.staging.prefetch(image_files.values())
 
     def _get_experiment_metadata(self):
         creation_info = self.db.fetch_all('SELECT DateCreated, Creator, Name FROM ExperimentBase')[0]
@@ -58,6 +87,11 @@ class ImageDbSource(ImageSource):
             FROM ImagechannelExp
             ORDER BY ChannelNumber
         ''')
+        if 'channels' in self.selection:
+            for channel in self.selection['channels']:
+                if not 0 <= channel < len(channel_infos):
+                    raise ValueError(f'Invalid channel: {channel}. Number of channels: {len(channel_infos)}')
+            channel_infos = [channel_infos[channel] for channel in self.selection['channels']]
         self.metadata['channels'] = channel_infos
         self.metadata['num_channels'] = len(channel_infos)
 
@@ -73,18 +107,48 @@ class ImageDbSource(ImageSource):
         well_info['columns'] = sorted(list(cols), key=lambda x: int(x))
         num_sites = well_info['SitesX'] * well_info['SitesY']
         well_info['num_sites'] = num_sites
-        well_info['fields'] = [f'{site_index}' for site_index in range(num_sites)]
+        site_ids = self.selection.get('fields', range(num_sites))
+        for site_id in site_ids:
+            if not 0 <= site_id < num_sites:
+                raise ValueError(f'Invalid field: {site_id}. Number of fields: {num_sites}')
+        well_info['fields'] = [f'{site_index}' for site_index in site_ids]
+
+        # tile size at the selected pyramid level
+        well_info['TileSizeXPixels'] = well_info['SensorSizeXPixels']
+        well_info['TileSizeYPixels'] = well_info['SensorSizeYPixels']
+        well_info['level_scale'] = 1
+        if self.level > 0:
+            level_tile = self.db.fetch_all('SELECT SizeX, SizeY FROM SourceImageBase WHERE level = ? LIMIT 1',
+                                           (self.level,))[0]
+            well_info['TileSizeXPixels'] = level_tile['SizeX']
+            well_info['TileSizeYPixels'] = level_tile['SizeY']
+            well_info['level_scale'] = well_info['SensorSizeXPixels'] / level_tile['SizeX']
 
         image_wells = self.db.fetch_all('SELECT Name, ZoneIndex, CoordX, CoordY FROM Well WHERE HasImages = 1')
+        if 'wells' in self.selection:
+            well_names = [strip_leading_zeros(well['Name']) for well in image_wells]
+            for well_id in self.selection['wells']:
+                if well_id not in well_names:
+                    raise ValueError(f'Invalid Well: {well_id}. Available values: {well_names}')
+            image_wells = [well for well, well_name in zip(image_wells, well_names) if well_name in self.selection['wells']]
         self.metadata['wells'] = dict(sorted({well['Name']: well for well in image_wells}.items(),
                                              key=lambda x: split_well_name(x[0], col_as_int=True)))
 
-        xmax, ymax = 0, 0
-        for well_id in self.metadata['wells']:
-            well_data = self._read_well_info(well_id)
-            xmax = max(xmax, np.max([info['CoordX'] + info['SizeX'] for info in well_data]))
-            ymax = max(ymax, np.max([info['CoordY'] + info['SizeY'] for info in well_data]))
-        pixel_size = well_info.get('PixelSizeUm', 1)
+        # extent over all (selected) wells, aggregated in the database
+        zone_indices = [well['ZoneIndex'] for well in self.metadata['wells'].values()]
+        query = ('SELECT MAX(CoordX + SizeX) AS xmax, MAX(CoordY + SizeY) AS ymax FROM SourceImageBase'
+                 f' WHERE level = ? AND ZoneIndex IN ({", ".join(["?"] * len(zone_indices))})')
+        params = [self.level] + zone_indices
+        if 'channels' in self.selection:
+            query += f' AND ChannelId IN ({", ".join(["?"] * len(self.selection["channels"]))})'
+            params += self.selection['channels']
+        query += f' AND TimeSeriesElementId IN ({", ".join(["?"] * len(self.metadata["time_points"]))})'
+        params += self.metadata['time_points']
+        extent = self.db.fetch_all(query, params)[0]
+        xmax, ymax = extent['xmax'] or 0, extent['ymax'] or 0
+        pixel_size = well_info.get('PixelSizeUm', 1) * well_info['level_scale']
+        well_info['max_sizex'] = int(xmax)
+        well_info['max_sizey'] = int(ymax)
         well_info['max_sizex_um'] = xmax * pixel_size
         well_info['max_sizey_um'] = ymax * pixel_size
 
@@ -99,13 +163,44 @@ class ImageDbSource(ImageSource):
         self.metadata['dtype'] = np.dtype(f'uint{bits_per_pixel}')
 
         well_info = self.metadata['well_info']
-        max_data_size = (well_info['SensorSizeXPixels'] * well_info['SensorSizeYPixels'] *
-                         len(self.metadata['wells']) * well_info['num_sites'] * self.metadata['num_channels'] *
+        sizex, sizey = well_info['TileSizeXPixels'], well_info['TileSizeYPixels']
+        if 'crop' in self.selection:
+            sizex, sizey = min(sizex, self.selection['crop'][2]), min(sizey, self.selection['crop'][3])
+        max_data_size = (sizex * sizey *
+                         len(self.metadata['wells']) * len(well_info['fields']) * self.metadata['num_channels'] *
                          len(self.metadata['time_points']) *
                          bits_per_pixel // 8)
         self.metadata['max_data_size'] = max_data_size
 
-    def _read_well_info(self, well_id, channel=None, time_point=None, level=0):
+    def _get_occupancy(self):
+        # tile presence (time point, well, field, channel) of the selection, from a single grouped query
+        well_info = self.metadata['well_info']
+        time_indices = {time_id: timei for timei, time_id in enumerate(self.metadata['time_points'])}
+        well_indices = {well['ZoneIndex']: welli for welli, well in enumerate(self.metadata['wells'].values())}
+        field_indices = {int(site_id): fieldi for fieldi, site_id in enumerate(well_info['fields'])}
+        channels = self.selection.get('channels', range(self.metadata['num_channels']))
+        channel_indices = {channel: channeli for channeli, channel in enumerate(channels)}
+        occupancy = np.zeros((len(time_indices), len(well_indices), len(field_indices), len(channel_indices)),
+                             dtype=bool)
+        # a row per (time point, well, site, channel): the site index from the tile position
+        sizex, sizey = well_info['TileSizeXPixels'], well_info['TileSizeYPixels']
+        rows = self.db.fetch_all('''
+            SELECT TimeSeriesElementId, ZoneIndex, ChannelId,
+                CAST(CoordY / ? AS INTEGER) * ? + CAST(CoordX / ? AS INTEGER) AS SiteId
+            FROM SourceImageBase
+            WHERE level = ?
+            GROUP BY TimeSeriesElementId, ZoneIndex, SiteId, ChannelId
+        ''', (sizey, well_info['SitesX'], sizex, self.level))
+        for row in rows:
+            indices = (time_indices.get(row['TimeSeriesElementId']), well_indices.get(row['ZoneIndex']),
+                       field_indices.get(row['SiteId']), channel_indices.get(row['ChannelId']))
+            if None not in indices:
+                occupancy[indices] = True
+        self.occupancy = occupancy
+        # exact size of the image data present (max_data_size: all combinations)
+        self.metadata['data_size'] = int(occupancy.sum()) * self.metadata['max_data_size'] // max(occupancy.size, 1)
+
+    def _read_well_info(self, well_id, channel=None, time_point=None, level=None):
         well_id = strip_leading_zeros(well_id)
         well_ids = self.metadata.get('wells', {})
 
@@ -113,89 +208,344 @@ class ImageDbSource(ImageSource):
             raise ValueError(f'Invalid Well: {well_id}. Available values: {well_ids}')
 
         zone_index = well_ids[well_id]['ZoneIndex']
-        well_info = self.db.fetch_all('''
-            SELECT *
-            FROM SourceImageBase
-            WHERE ZoneIndex = ? AND level = ?
-            ORDER BY CoordX ASC, CoordY ASC
-        ''', (zone_index, level))
-
-        if channel is not None:
-             well_info = [info for info in well_info if info['ChannelId'] == channel]
-        if time_point is not None:
-             well_info = [info for info in well_info if info['TimeSeriesElementId'] == time_point]
-        if not well_info:
-            raise ValueError(f'No data found for well {well_id}')
-        return well_info
+        if level is None:
+            level = self.level
+        # filter (selected) channels and time points in the query: tiles not selected are never read
+        channels = [channel] if channel is not None else self.selection.get('channels')
+        time_points = [time_point] if time_point is not None else self.metadata.get('time_points')
+        query = 'SELECT * FROM SourceImageBase WHERE ZoneIndex = ? AND level = ?'
+        params = [zone_index, level]
+        if channels is not None:
+            query += f' AND ChannelId IN ({", ".join(["?"] * len(channels))})'
+            params += channels
+        if time_points is not None:
+            query += f' AND TimeSeriesElementId IN ({", ".join(["?"] * len(time_points))})'
+            params += time_points
+        query += ' ORDER BY CoordX ASC, CoordY ASC'
+        # not cached: a row per tile, for every well; none for wells not imaged (at the selected time points)
+        return self.db.fetch_all(query, params)
+
+    def _get_image_shape(self, well_info):
+        # the same shape for all wells, also if tiles (sites, channels or time points) are missing
+        plate_info = self.metadata.get('well_info', {})
+        xmax = max([info['CoordX'] + info['SizeX'] for info in well_info] + [plate_info.get('max_sizex', 0)])
+        ymax = max([info['CoordY'] + info['SizeY'] for info in well_info] + [plate_info.get('max_sizey', 0)])
+        zmax = max([info.get('CoordZ', 0) + info.get('SizeZ', 1) for info in well_info], default=1)
+        if 'channels' in self.selection:
+            nc = len(self.selection['channels'])
+        else:
+            nc = max([info['ChannelId'] + 1 for info in well_info] + [self.metadata.get('num_channels', 0)])
+        nt = len(self.metadata['time_points'])
+        return nt, nc, zmax, ymax, xmax
+
+    def _get_well_shape(self, well_id, well_info=None):
+        # computed once per well (from its tile rows, if not given)
+        shape = self.well_shapes.get(well_id)
+        if shape is None:
+            if well_info is None:
+                well_info = self._read_well_info(well_id)
+            shape = self._get_image_shape(well_info)
+            self.well_shapes[well_id] = shape
+        return shape
+
+    def _get_field_region(self, shape, field_id=None):
+        if field_id is None:
+            window = [slice(0, size) for size in shape[2:]]
+        elif 0 <= field_id < self.metadata['well_info']['num_sites']:
+            window = [slice(slice1.start, min(slice1.stop, size))
+                      for slice1, size in zip(self._get_site_window(field_id), shape[2:])]
+        else:
+            raise ValueError(f'Invalid site: {field_id}')
+        if 'crop' in self.selection:
+            x, y, width, height = self.selection['crop']
+            for dim, start, size in [(-2, y, height), (-1, x, width)]:
+                window[dim] = slice(min(window[dim].start + start, window[dim].stop),
+                                    min(window[dim].start + start + size, window[dim].stop))
+        return [slice(0, shape[0]), slice(0, shape[1])] + window
+
+    def _get_site_id(self, field_id=None):
+        # field index (in the selected fields) to site id
+        if field_id is None or field_id < 0:
+            return field_id
+        fields = self.metadata['well_info']['fields']
+        if field_id >= len(fields):
+            raise ValueError(f'Invalid field: {field_id}. Number of fields: {len(fields)}')
+        return int(fields[field_id])
+
+    def _get_channel_index(self, channel_id):
+        if 'channels' in self.selection:
+            return self.selection['channels'].index(channel_id)
+        return channel_id
 
     def _assemble_image_data(self, well_info):
+        if self.fuse_fields or not ('fields' in self.selection or 'crop' in self.selection):
+            return self._read_region(well_info)
+        # only read the selected fields
+        shape = self._get_image_shape(well_info)
+        data = np.zeros(shape, dtype=self.metadata['dtype'])
+        for field in self.metadata['well_info']['fields']:
+            region = tuple(self._get_field_region(shape, int(field)))
+            data[region] = self._read_region(well_info, region)
+        return data
+
+    def _read_region(self, well_info, region=None):
+        # region: slices (t, c, z, y, x) in well image coordinates; only overlapping tile rows are read
         dtype = self.metadata['dtype']
-        well_info = np.asarray(well_info)
-        xmax = np.max([info['CoordX'] + info['SizeX'] for info in well_info])
-        ymax = np.max([info['CoordY'] + info['SizeY'] for info in well_info])
-        zmax = np.max([info.get('CoordZ', 0) + info.get('SizeZ', 1) for info in well_info])
-        nc = len(set([info['ChannelId'] for info in well_info]))
-        nt = len(self.metadata['time_points'])
-        data = np.zeros((nt, nc, zmax, ymax, xmax), dtype=dtype)
-
-        for timei, time_id in enumerate(self.metadata['time_points']):
-            image_file = self.metadata['image_files'][time_id]
-            with open(image_file, 'rb') as fid:
-                for info in well_info:
-                    if info['TimeSeriesElementId'] == time_id:
-                        fid.seek(info['ImageIndex'])
-                        coordx, coordy, coordz = info['CoordX'], info['CoordY'], info.get('CoordZ', 0)
-                        sizex, sizey, sizez = info['SizeX'], info['SizeY'], info.get('SizeZ', 1)
-                        channeli = info['ChannelId']
-                        tile = np.fromfile(fid, dtype=dtype, count=sizez * sizey * sizex)
-                        data[timei, channeli, coordz:coordz + sizez, coordy:coordy + sizey, coordx:coordx + sizex] = tile.reshape((sizez, sizey, sizex))
-
-        self.data = data
-
-    def _extract_site(self, site_id=None):
+        shape = self._get_image_shape(well_info)
+        if region is None:
+            region = [slice(None)] * len(shape)
+        starts, ends = [], []
+        for slice1, size in zip(region, shape):
+            start, end, _ = slice1.indices(size)
+            starts.append(start)
+            ends.append(end)
+        t0, c0, z0, y0, x0 = starts
+        t1, c1, z1, y1, x1 = ends
+        data = np.zeros([end - start for start, end in zip(starts, ends)], dtype=dtype)
+
+        # plan all tile (row) reads: sorted by file offset and merged into sequential reads per images file
+        time_indices = {time_id: timei for timei, time_id in enumerate(self.metadata['time_points'])}
+        file_reads = {}
+        for info in well_info:
+            timei = time_indices.get(info['TimeSeriesElementId'])
+            channeli = self._get_channel_index(info['ChannelId'])
+            if timei is None or not t0 <= timei < t1 or not c0 <= channeli < c1:
+                continue
+            coordx, coordy, coordz = info['CoordX'], info['CoordY'], info.get('CoordZ', 0)
+            sizex, sizey, sizez = info['SizeX'], info['SizeY'], info.get('SizeZ', 1)
+            tz0, tz1 = max(coordz, z0), min(coordz + sizez, z1)
+            ty0, ty1 = max(coordy, y0), min(coordy + sizey, y1)
+            tx0, tx1 = max(coordx, x0), min(coordx + sizex, x1)
+            if tz0 >= tz1 or ty0 >= ty1 or tx0 >= tx1:
+                continue
+            if ty0 == coordy and ty1 == coordy + sizey:
+                # all rows of the overlapping z planes are contiguous: read and place them at once
+                z_ranges = [(tz0, tz1)]
+            else:
+                z_ranges = [(z, z + 1) for z in range(tz0, tz1)]
+            image_file = self.metadata['image_files'][info['TimeSeriesElementId']]
+            if self.staging:
+                image_file = self.staging.get_path(image_file)
+            for za, zb in z_ranges:
+                # tile pixels are stored row-major: read the overlapping (full width) rows in one go
+                offset = ((za - coordz) * sizey + (ty0 - coordy)) * sizex
+                rows_shape = (zb - za, ty1 - ty0, sizex)
+                target = (timei - t0, channeli - c0, slice(za - z0, zb - z0), slice(ty0 - y0, ty1 - y0),
+                          slice(tx0 - x0, tx1 - x0))
+                tile_key = None
+                if rows_shape == (sizez, sizey, sizex):
+                    tile_key = (os.path.basename(image_file), info['ImageIndex'])
+                file_reads.setdefault(image_file, []).append(
+                    (info['ImageIndex'] + offset * dtype.itemsize, int(np.prod(rows_shape)) * dtype.itemsize,
+                     (target, rows_shape, slice(tx0 - coordx, tx1 - coordx), tile_key)))
+
+        def place(key, buffer):
+            target, rows_shape, source_x, tile_key = key
+            data[target] = np.frombuffer(buffer, dtype=dtype).reshape(rows_shape)[..., source_x]
+            if self.tile_hashes is not None and tile_key is not None:
+                # content hash of the complete source tile as read
+                self.tile_hashes[tile_key] = hash_data(buffer)
+
+        execute_reads(file_reads, place)
+        return data
+
+    def _get_site_window(self, site_id):
         well_info = self.metadata['well_info']
         sitesx = well_info['SitesX']
         sitesy = well_info['SitesY']
-        sitesz = well_info.get('SitesZ', 1)
-        num_sites = well_info['num_sites']
-        sizex = well_info['SensorSizeXPixels']
-        sizey = well_info['SensorSizeYPixels']
+        sizex = well_info['TileSizeXPixels']
+        sizey = well_info['TileSizeYPixels']
         sizez = well_info.get('SensorSizeZPixels', 1)
-
-        if site_id is None:
-            # Return full image data
-            return self.data
-        if site_id < 0:
-            # Return list of all fields
-            data = []
-            for zi in range(sitesz):
-                for yi in range(sitesy):
-                    for xi in range(sitesx):
-                        startx = xi * sizex
-                        starty = yi * sizey
-                        startz = zi * sizez
-                        data.append(self.data[..., startz:startz + sizez, starty:starty + sizey, startx:startx + sizex])
-            return data
-        elif 0 <= site_id < num_sites:
-            # Return specific site
-            xi = site_id % sitesx
-            yi = (site_id // sitesx) % sitesy
-            zi = site_id // sitesx // sitesy
-            startx = xi * sizex
-            starty = yi * sizey
-            startz = zi * sizez
-            return self.data[..., startz:startz + sizez, starty:starty + sizey, startx:startx + sizex]
-        else:
-            raise ValueError(f'Invalid site: {site_id}')
+        xi = site_id % sitesx
+        yi = (site_id // sitesx) % sitesy
+        zi = site_id // sitesx // sitesy
+        return (slice(zi * sizez, (zi + 1) * sizez), slice(yi * sizey, (yi + 1) * sizey),
+                slice(xi * sizex, (xi + 1) * sizex))
+
+    def _get_data_tiled(self, well_id, field_id=None, well_info=None):
+        # assemble (part of) a well within the memory budget, lazily in slabs if needed
+        import dask.array as da
+
+        if well_info is None:
+            well_info = self._read_well_info(well_id)
+        if field_id is not None and field_id < 0:
+            return [self._get_data_tiled(well_id, int(site_id), well_info)
+                    for site_id in self.metadata['well_info']['fields']]
+        dtype = self.metadata['dtype']
+        region = self._get_field_region(self._get_well_shape(well_id, well_info), field_id)
+        region_shape = [slice1.stop - slice1.start for slice1 in region]
+        if np.prod(region_shape) * dtype.itemsize <= self.max_memory:
+            return self._read_region(well_info, region)
+
+        chunks = get_slab_chunks(region_shape, dtype, self.max_memory // 8,
+                                 tile_size=self.metadata['well_info']['TileSizeYPixels'])
+        logging.info(f'Reading well {well_id} field {field_id} in slabs of {chunks_to_shape(chunks)}')
+
+        def read_block(block_info=None):
+            location = block_info[None]['array-location']
+            block_region = [slice(slice1.start + start, slice1.start + end)
+                            for slice1, (start, end) in zip(region, location)]
+            return self._read_region(well_info, block_region)
+
+        return da.map_blocks(read_block, chunks=chunks, dtype=dtype)
+
+    def _extract_site(self, data, site_id=None):
+        if site_id is not None and site_id < 0:
+            # Return list of all (selected) fields
+            return [self._extract_site(data, int(site_id)) for site_id in self.metadata['well_info']['fields']]
+        # Return full image data (site_id None) or specific site, cropped if selected
+        return data[tuple(self._get_field_region(data.shape, site_id))]
+
+    def _load_well_data(self, well_id, well_info=None):
+        with Timer(f'read well {well_id}', verbose=False, category='read', args={'well': well_id}):
+            if well_info is None:
+                well_info = self._read_well_info(well_id)
+            return self._assemble_image_data(well_info)
 
     def is_screen(self):
         return len(self.metadata['wells']) > 0
 
     def get_data(self, well_id=None, field_id=None):
-        if well_id != self.data_well_id:
-            self._assemble_image_data(self._read_well_info(well_id))
-            self.data_well_id = well_id
-        return self._extract_site(field_id)
+        if self.fuse_fields and field_id is not None:
+            if field_id < 0:
+                return [self.get_data(well_id)]
+            field_id = None
+        field_id = self._get_site_id(field_id)
+        well_info = None
+        if self.max_memory:
+            # the tile rows are queried once, for the well size and for reading
+            if well_id not in self.well_shapes:
+                well_info = self._read_well_info(well_id)
+            if self.get_well_data_size(well_id, well_info) > self.max_memory:
+                return self._get_data_tiled(well_id, field_id, well_info)
+        data = self.cache.get(well_id, lambda: self._load_well_data(well_id, well_info))
+        return self._extract_site(data, field_id)
+
+    def _get_level_tile_size(self, level):
+        well_info = self.metadata['well_info']
+        if level == 0:
+            return well_info['SensorSizeXPixels'], well_info['SensorSizeYPixels']
+        level_tile = self.db.fetch_all('SELECT SizeX, SizeY FROM SourceImageBase WHERE level = ? LIMIT 1',
+                                       (level,), cache=True)[0]
+        return level_tile['SizeX'], level_tile['SizeY']
+
+    def get_region(self, well_id=None, field_id=None, t=None, c=None, z=None, y=None, x=None, level=None):
+        # only the tiles overlapping the region, at the requested pyramid level, are read (not cached)
+        if level is None:
+            level = self.level
+        if level not in self.metadata['levels']:
+            raise ValueError(f'Invalid level: {level}. Available values: {self.metadata["levels"]}')
+        site_id = None if self.fuse_fields else self._get_site_id(field_id)
+        window = self._get_field_region(self._get_well_shape(well_id), site_id)
+        # field window of the selected level, scaled to the requested level
+        well_info = self.metadata['well_info']
+        level_sizex, level_sizey = self._get_level_tile_size(level)
+        scales = [1, 1, 1, level_sizey / well_info['TileSizeYPixels'], level_sizex / well_info['TileSizeXPixels']]
+        region, steps = [], []
+        for slice1, scale, value in zip(window, scales, [t, c, z, y, x]):
+            start, stop = round(slice1.start * scale), round(slice1.stop * scale)
+            start1, stop1, step = to_slice(value).indices(stop - start)
+            if step < 1:
+                raise ValueError(f'Unsupported region step: {step}')
+            region.append(slice(start + start1, start + max(start1, stop1)))
+            steps.append(slice(None, None, step))
+        data = self._read_region(self._read_well_info(well_id, level=level), region)
+        return data[tuple(steps)]
+
+    def get_preview(self, well_id=None, field_id=None, downscale=1):
+        # read from the coarsest stored pyramid level that is not coarser than the preview
+        well_info = self.metadata['well_info']
+        site_id = None if self.fuse_fields else self._get_site_id(field_id)
+        window = self._get_field_region(self._get_well_shape(well_id), site_id)
+        sizey, sizex = [slice1.stop - slice1.start for slice1 in window[-2:]]
+        preview_level, preview_scale = self.level, 1
+        for level in self.metadata['levels']:
+            scale = well_info['TileSizeXPixels'] / self._get_level_tile_size(level)[0]
+            if preview_scale < scale <= downscale and scale.is_integer() and downscale % scale == 0:
+                preview_level, preview_scale = level, int(scale)
+        if downscale > 1 and preview_scale == 1:
+            # no stored level coarser than the data read
+            return None
+        step = downscale // preview_scale
+        return self.get_region(well_id, field_id, y=slice(0, sizey // downscale * step, step),
+                               x=slice(0, sizex // downscale * step, step), level=preview_level)
+
+    def get_cache_stats(self):
+        return self.cache.get_stats()
+
+    def _get_field_tiles(self, well_id=None, field_id=None):
+        # tiles overlapping the field, with their box (t, c, z, y, x slices relative to the field),
+        # and whether the tile is completely inside the field
+        field_id = None if self.fuse_fields else self._get_site_id(field_id)
+        well_info = self._read_well_info(well_id)
+        region = self._get_field_region(self._get_well_shape(well_id, well_info), field_id)
+        time_points = self.metadata['time_points']
+        tiles = []
+        for info in well_info:
+            timei = time_points.index(info['TimeSeriesElementId'])
+            channeli = self._get_channel_index(info['ChannelId'])
+            tile = [slice(timei, timei + 1), slice(channeli, channeli + 1),
+                    slice(info.get('CoordZ', 0), info.get('CoordZ', 0) + info.get('SizeZ', 1)),
+                    slice(info['CoordY'], info['CoordY'] + info['SizeY']),
+                    slice(info['CoordX'], info['CoordX'] + info['SizeX'])]
+            box = [slice(max(slice1.start, window.start) - window.start, min(slice1.stop, window.stop) - window.start)
+                   for slice1, window in zip(tile, region)]
+            if all(slice1.start < slice1.stop for slice1 in box):
+                inside = all(slice1.stop - slice1.start == tile1.stop - tile1.start for slice1, tile1 in zip(box, tile))
+                tiles.append((info, tuple(box), inside))
+        return tiles
+
+    def get_coverage(self, well_id=None, field_id=None):
+        # boxes (t, c, z, y, x slices relative to the field) of the image tiles present
+        return [box for _, box, _ in self._get_field_tiles(well_id, field_id)]
+
+    def enable_tile_hashes(self):
+        self.tile_hashes = {}
+        return True
+
+    def get_tile_hashes(self, well_id=None, field_id=None):
+        if self.tile_hashes is None:
+            return []
+        dtype = self.metadata['dtype']
+        tiles = []
+        for info, box, inside in self._get_field_tiles(well_id, field_id):
+            image_file = os.path.basename(self.metadata['image_files'][info['TimeSeriesElementId']])
+            tile_hash = self.tile_hashes.get((image_file, info['ImageIndex']))
+            if inside and tile_hash is not None:
+                size = info['SizeX'] * info['SizeY'] * info.get('SizeZ', 1) * dtype.itemsize
+                tiles.append({'file': image_file, 'offset': info['ImageIndex'], 'size': size,
+                              'region': [[slice1.start, slice1.stop] for slice1 in box], 'hash': tile_hash})
+        return tiles
+
+    def get_tile_references(self, well_id=None, field_id=None):
+        # a field is a single (sensor) tile for each t, c at each level, stored raw in the images files:
+        # None if fields are not tile aligned (fused or cropped)
+        if self.fuse_fields or 'crop' in self.selection:
+            return None
+        well_info = self.metadata['well_info']
+        site_id = self._get_site_id(field_id)
+        xi = site_id % well_info['SitesX']
+        yi = (site_id // well_info['SitesX']) % well_info['SitesY']
+        time_indices = {time_id: timei for timei, time_id in enumerate(self.metadata['time_points'])}
+        itemsize = self.metadata['dtype'].itemsize
+        levels = []
+        for level in self.metadata['levels']:
+            if level < self.level:
+                continue
+            sizex, sizey = self._get_level_tile_size(level)
+            tiles = []
+            for info in self._read_well_info(well_id, level=level):
+                if info['CoordX'] != xi * sizex or info['CoordY'] != yi * sizey:
+                    continue
+                if info['SizeX'] != sizex or info['SizeY'] != sizey or info.get('SizeZ', 1) != 1:
+                    return None
+                tiles.append({'index': (time_indices[info['TimeSeriesElementId']],
+                                        self._get_channel_index(info['ChannelId']), 0),
+                              'file': self.metadata['image_files'][info['TimeSeriesElementId']],
+                              'offset': info['ImageIndex'], 'size': sizex * sizey * itemsize})
+            shape = len(self.metadata['time_points']), self.get_nchannels(), 1, sizey, sizex
+            levels.append({'shape': shape, 'tiles': tiles})
+        return levels
 
     def get_name(self):
         name = self.metadata.get('Name')
@@ -216,8 +566,14 @@ class ImageDbSource(ImageSource):
         return self.metadata['time_points']
 
     def get_fields(self):
+        if self.fuse_fields:
+            return ['0']
         return self.metadata['well_info']['fields']
 
+    def get_tile_size(self):
+        well_info = self.metadata['well_info']
+        return {'x': well_info['TileSizeXPixels'], 'y': well_info['TileSizeYPixels']}
+
     def get_dim_order(self):
         return self.metadata.get('dim_order', 'tczyx')
 
@@ -225,7 +581,7 @@ class ImageDbSource(ImageSource):
         return self.metadata.get('dtype')
 
     def get_pixel_size_um(self):
-        pixel_size = self.metadata['well_info'].get('PixelSizeUm', 1)
+        pixel_size = self.metadata['well_info'].get('PixelSizeUm', 1) * self.metadata['well_info']['level_scale']
         return {'x': pixel_size, 'y': pixel_size}
 
     def get_position_um(self, well_id=None):
@@ -260,8 +616,17 @@ class ImageDbSource(ImageSource):
             })
         return acquisitions
 
+    def get_occupancy(self):
+        # bitmap (time point, well, field, channel) in the order of get_time_points / get_wells / get_fields
+        if self.fuse_fields:
+            return self.occupancy.any(axis=2, keepdims=True)
+        return self.occupancy
+
     def get_total_data_size(self):
-        return self.metadata['max_data_size']
+        return self.metadata['data_size']
+
+    def get_well_data_size(self, well_id, well_info=None):
+        return int(np.prod(self._get_well_shape(well_id, well_info))) * self.metadata['dtype'].itemsize
 
     def print_well_matrix(self):
         s = ''
@@ -291,14 +656,9 @@ class ImageDbSource(ImageSource):
         wells = [well for well in self.metadata['wells']]
 
         well_matrix = []
-        for timepoint in time_points:
-            wells_at_timepoint = self.db.fetch_all('''
-                SELECT DISTINCT Well.Name FROM SourceImageBase
-                JOIN Well ON SourceImageBase.ZoneIndex = Well.ZoneIndex
-                WHERE TimeSeriesElementId = ?
-            ''', (timepoint,), return_dicts=False)
-
-            row = ['+' if well in wells_at_timepoint else ' ' for well in wells]
+        occupied = self.occupancy.any(axis=(2, 3))
+        for timei in range(len(time_points)):
+            row = ['+' if occupied[timei, welli] else ' ' for welli in range(len(wells))]
             well_matrix.append(row)
 
         header = ' '.join([pad_leading_zero(well) for well in wells])
@@ -308,4 +668,9 @@ class ImageDbSource(ImageSource):
         return s
 
     def close(self):
+        logging.info(f'Well cache: {self.cache.get_stats()}')
         self.db.close()
+        if self.staging:
+            logging.info(f'Staging: {self.staging.get_stats()}')
+            self.staging.close()
+        self.cache.clear()
@@ -1,10 +1,13 @@
 from abc import ABC
 
+from src.util import get_region_index
+
 
 class ImageSource(ABC):
-    def __init__(self, uri, metadata={}):
+    def __init__(self, uri, metadata={}, max_memory=None):
         self.uri = uri
-        self.metadata = metadata
+        self.metadata = dict(metadata)     # not shared between sources (mutable default)
+        self.max_memory = max_memory
 
     def init_metadata(self):
         raise NotImplementedError("The 'init_metadata' method must be implemented by subclasses.")
@@ -15,6 +18,42 @@ class ImageSource(ABC):
     def get_data(self, well_id=None, field_id=None):
         raise NotImplementedError("The 'get_data' method must be implemented by subclasses.")
 
+    def get_region(self, well_id=None, field_id=None, t=None, c=None, z=None, y=None, x=None, level=0):
+        # part of a field, in dimension order (all dimensions kept): t, c, z, y, x are an index, slice or None (all)
+        if level != 0:
+            raise ValueError(f'Level {level} not supported for {type(self).__name__}')
+        data = self.get_data(well_id, field_id)
+        return data[get_region_index(self.get_dim_order(), t=t, c=c, z=z, y=y, x=x)]
+
+    def get_preview(self, well_id=None, field_id=None, downscale=1):
+        # field downscaled in y and x (size // downscale), from stored pyramid levels; None: not available without
+        # reading the full resolution data
+        return None
+
+    def get_coverage(self, well_id=None, field_id=None):
+        # boxes (slices in dimension order) of the regions containing image data; None: fully covered
+        return None
+
+    def enable_tile_hashes(self):
+        # record content hashes of source tiles as they are read; False: not supported
+        return False
+
+    def get_tile_hashes(self, well_id=None, field_id=None):
+        # tiles read completely: hash, file, offset, size and region (t, c, z, y, x ranges) in the field
+        return []
+
+    def get_occupancy(self):
+        # bitmap (time point, well, field, channel) of the image data present; None: unknown
+        return None
+
+    def get_tile_references(self, well_id=None, field_id=None):
+        # per pyramid level: field shape and byte ranges of the uncompressed tiles; None: not supported
+        return None
+
+    def get_tile_size(self):
+        # size of the source image tiles, to align chunks to; None: not tiled
+        return None
+
     def get_name(self):
         raise NotImplementedError("The 'get_name' method must be implemented by subclasses.")
 
@@ -59,3 +98,9 @@ class ImageSource(ABC):
 
     def close(self):
         pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
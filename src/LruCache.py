@@ -0,0 +1,62 @@
+# Thread-safe least recently used cache with a byte budget, for (assembled) image data
+
+from collections import OrderedDict
+import threading
+
+
+class LruCache(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.loading = {}
+
+    def get(self, key, load):
+        # returns the cached value, or loads it once: concurrent requests for the same key wait for a single load
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return self.entries[key]
+                self.misses += 1
+            try:
+                value = load()
+                with self.lock:
+                    self._put(key, value)
+            finally:
+                # also on a failed load: a later request retries
+                with self.lock:
+                    self.loading.pop(key, None)
+        return value
+
+    def _put(self, key, value):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        # the newest entry is always kept, also if it exceeds the budget by itself
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+            self.evictions += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
@@ -1,33 +1,64 @@
-# TODO: requires proper implementation including ome xml metadata
+# TODO: plate (SPW) ome xml metadata; a plate is written as one image series per well field
 
 import logging
-import os
+import numpy as np
 from tifffile import tifffile
 
 from src.OmeWriter import OmeWriter
 from src.util import *
 
 
+TILE_SIZE = 256
+
+
 class OmeTiffWriter(OmeWriter):
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, max_memory=None):
         super().__init__()
         self.verbose = verbose
+        self.max_memory = max_memory
 
-    def write(self, filename, source, name=None, well_id=None, field_id=None, tiff_compression=None, **kwargs):
-        filepath, filename = os.path.split(filename)
-        filetitle, ext = os.path.splitext(filename)
-
-        filename = f'{filetitle}'
-        filename += f'_{pad_leading_zero(well_id)}'
-        if field_id is not None and field_id >= 0:
-            filename += f'_{pad_leading_zero(field_id)}'
+    def write(self, filename, source, name=None, tiff_compression=None, **kwargs):
+        total_size = 0
+        with tifffile.TiffWriter(filename, bigtiff=True, ome=True) as tif:
+            if source.is_screen():
+                data = None
+                for well_id in source.get_wells():
+                    for field_index, field in enumerate(source.get_fields()):
+                        empty_data = self._get_empty_field(source, well_id, field_index, data)
+                        data = empty_data if empty_data is not None else source.get_data(well_id, field_index)
+                        total_size += self._write_image(tif, data, source, f'{well_id} field {field}',
+                                                        tiff_compression)
+            else:
+                total_size += self._write_image(tif, source.get_data(), source, name or source.get_name(),
+                                                tiff_compression)
 
-        filename = os.path.join(filepath, filename + ext)
-
-        data = source.get_data(well_id, field_id)
+        logging.info(f'Image saved as {filename}')
+        if self.verbose:
+            print(f'Total data written: {print_hbytes(total_size)}')
 
-        if ext.lower() in ['.tif', '.tiff']:
-            with tifffile.TiffWriter(filename) as tif:
-                tif.write(data, compression=tiff_compression, dtype=source.metadata['dtype'])
+    def _write_image(self, tif, data, source, name, tiff_compression=None):
+        pixel_size = source.get_pixel_size_um()
+        metadata = {'axes': source.get_dim_order().upper(), 'Name': name,
+                    'PhysicalSizeX': pixel_size.get('x', 1), 'PhysicalSizeXUnit': 'µm',
+                    'PhysicalSizeY': pixel_size.get('y', 1), 'PhysicalSizeYUnit': 'µm'}
+        if source.get_dim_order().endswith('yx') and min(data.shape[-2:]) >= TILE_SIZE:
+            # tiles are read block by block from the (lazy) data
+            tif.write(self._iterate_tiles(data), shape=data.shape, dtype=data.dtype, compression=tiff_compression,
+                      tile=(TILE_SIZE, TILE_SIZE), metadata=metadata)
+        else:
+            tif.write(np.asarray(data), compression=tiff_compression, metadata=metadata)
+        return int(np.prod(data.shape)) * data.dtype.itemsize
 
-        logging.info(f'Image saved as {filename}')
+    def _iterate_tiles(self, data):
+        # tiles of all planes in tiff order, from bands of tile rows within the memory budget
+        sizey, sizex = data.shape[-2:]
+        band_height = sizey
+        if self.max_memory:
+            band_height = max(self.max_memory // 2 // (sizex * data.dtype.itemsize) // TILE_SIZE, 1) * TILE_SIZE
+        for plane_index in np.ndindex(data.shape[:-2]):
+            for y0 in range(0, sizey, band_height):
+                band = np.asarray(data[plane_index + (slice(y0, y0 + band_height),)])
+                for ty in range(0, band.shape[0], TILE_SIZE):
+                    for tx in range(0, sizex, TILE_SIZE):
+                        # edge tiles are padded by tifffile
+                        yield band[ty:ty + TILE_SIZE, tx:tx + TILE_SIZE]
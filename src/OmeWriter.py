@@ -1,6 +1,18 @@
 from abc import ABC
+import dask.array as da
 
 
 class OmeWriter(ABC):
+    # False for writers that only use the source metadata
+    reads_data = True
+
     def write(self, filename, source, name=None, verbose=False, **kwargs):
         raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def _get_empty_field(self, source, well_id, field_index, template):
+        # a field without any image data (source occupancy) is not read: zeros in the shape of a field read before
+        occupancy = source.get_occupancy()
+        if occupancy is None or template is None or \
+                occupancy[:, source.get_wells().index(well_id), field_index].any():
+            return None
+        return da.zeros(template.shape, dtype=template.dtype)
@@ -0,0 +1,88 @@
+# Virtual OME-Zarr: zarr v2 / ome 0.4 metadata plus byte range references to the uncompressed source tiles,
+# as a kerchunk reference file (version 1); no pixel data is copied.
+# Read e.g. with zarr.open_group('reference://', storage_options={'fo': filename})
+
+import json
+import logging
+import numpy as np
+import os
+import warnings
+from ome_zarr.format import FormatV04
+from ome_zarr.writer import write_multiscales_metadata, write_plate_metadata, write_well_metadata
+import zarr
+from zarr.storage import MemoryStore
+
+from src.OmeWriter import OmeWriter
+from src.ome_zarr_util import create_axes_metadata, create_channel_metadata, create_transformation_metadata
+from src.parameters import VERSION
+from src.storage_util import write_text
+from src.util import split_well_name
+
+
+class OmeZarrReferenceWriter(OmeWriter):
+    reads_data = False
+
+    def __init__(self, verbose=False, storage_options=None):
+        super().__init__()
+        self.ome_format = FormatV04()
+        self.verbose = verbose
+        self.storage_options = storage_options
+
+    def write(self, filename, source, name=None, **kwargs):
+        # metadata is created with the regular zarr / ome_zarr api in memory, then exported as references
+        store_dict = {}
+        zarr_root = zarr.open_group(MemoryStore(store_dict=store_dict), mode='w', zarr_format=2)
+        chunk_refs = {}
+        if source.is_screen():
+            field_paths = source.get_fields()
+            for well_id in source.get_wells():
+                row, col = split_well_name(well_id)
+                well_group = zarr_root.require_group(str(row)).require_group(str(col))
+                for field_index, field in enumerate(field_paths):
+                    image_group = well_group.require_group(str(field))
+                    self._write_references(image_group, source, chunk_refs, well_id, field_index)
+                write_well_metadata(well_group, field_paths, fmt=self.ome_format)
+        else:
+            self._write_references(zarr_root, source, chunk_refs)
+
+        zarr_root.attrs['omero'] = create_channel_metadata(source.get_dtype(), source.get_channels(),
+                                                           source.get_nchannels(), self.ome_format.version)
+        zarr_root.attrs['_creator'] = {'name': 'OmeZarrReferenceWriter', 'version': VERSION}
+        if source.is_screen():
+            well_paths = ['/'.join(split_well_name(well)) for well in source.get_wells()]
+            write_plate_metadata(zarr_root, source.get_rows(), source.get_columns(), well_paths, name=name,
+                                 field_count=len(source.get_fields()), acquisitions=source.get_acquisitions(),
+                                 fmt=self.ome_format)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=UserWarning)
+            zarr.consolidate_metadata(zarr_root.store, zarr_format=2)
+
+        refs = {key: value.to_bytes().decode() for key, value in store_dict.items()}
+        refs.update(chunk_refs)
+        write_text(filename, json.dumps({'version': 1, 'refs': refs}), storage_options=self.storage_options)
+        logging.info(f'Virtual ome-zarr {filename}: {len(chunk_refs)} tile references')
+        if self.verbose:
+            print(f'Tile references written: {len(chunk_refs)}')
+
+    def _write_references(self, group, source, chunk_refs, well_id=None, field_index=None):
+        levels = source.get_tile_references(well_id, field_index)
+        if levels is None:
+            raise ValueError('Virtual ome-zarr output is not supported for this input (or fused / cropped fields)')
+        dim_order = source.get_dim_order()
+        # raw source tiles are little endian
+        dtype = np.dtype(source.get_dtype()).newbyteorder('<')
+        datasets = []
+        for leveli, level in enumerate(levels):
+            shape = level['shape']
+            # one chunk per tile: the complete (z, y, x) field for each t, c
+            array = group.create_array(str(leveli), shape=shape, chunks=(1, 1) + tuple(shape[2:]), dtype=dtype,
+                                       compressors=None, fill_value=0,
+                                       chunk_key_encoding=self.ome_format.chunk_key_encoding)
+            for tile in level['tiles']:
+                key = '/'.join([array.path] + [str(index) for index in tile['index']] + ['0', '0'])
+                chunk_refs[key] = [os.path.abspath(tile['file']), tile['offset'], tile['size']]
+            scale = shape[-1] / levels[0]['shape'][-1]
+            datasets.append({'path': str(leveli),
+                             'coordinateTransformations': create_transformation_metadata(
+                                 dim_order, source.get_pixel_size_um(), scale, source.get_position_um(well_id))})
+        write_multiscales_metadata(group, datasets, fmt=self.ome_format, axes=create_axes_metadata(dim_order))
@@ -1,18 +1,29 @@
 # https://ome-zarr.readthedocs.io/en/stable/python.html#writing-hcs-datasets-to-ome-ngff
 
 #from ome_zarr.io import parse_url
+import dask.array as da
+import json
+import logging
+import os
+import warnings
 from ome_zarr.scale import Scaler
-from ome_zarr.writer import write_image, write_plate_metadata, write_well_metadata
+from ome_zarr.writer import write_multiscales_metadata, write_plate_metadata, write_well_metadata
 import zarr
+from zarr.errors import ContainsGroupError
 
+from src.ChannelStatistics import ChannelStatistics
+from src.checksum_util import ChecksumManifest
 from src.OmeWriter import OmeWriter
 from src.ome_zarr_util import *
 from src.parameters import VERSION
-from src.util import split_well_name, print_hbytes
+from src.storage_util import create_store, delete_path, join_path, read_text, write_text
+from src.Timer import Timer
+from src.util import split_well_name, print_hbytes, chunks_to_shape
 
 
 class OmeZarrWriter(OmeWriter):
-    def __init__(self, zarr_version=2, ome_version='0.4', verbose=False):
+    def __init__(self, zarr_version=2, ome_version='0.4', verbose=False, max_memory=None,
+                 storage_options=None, concurrency=None, retries=3, checksums=False, progressive=False):
         super().__init__()
         self.zarr_version = zarr_version
         self.ome_version = ome_version
@@ -25,90 +36,355 @@ class OmeZarrWriter(OmeWriter):
         else:
             self.ome_format = None
         self.verbose = verbose
+        self.max_memory = max_memory
+        self.storage_options = storage_options
+        self.concurrency = concurrency
+        self.retries = retries
+        self.checksums = checksums
+        # progressive: a preview of the whole plate (coarsest level only) is written first
+        self.progressive = progressive
+        self.channel_statistics = None
+        self.checksum_manifest = None
 
     def write(self, filename, source, name=None, **kwargs):
+        with shared_zarr_config(self._get_config()):
+            self._write(filename, source, name=name, **kwargs)
+
+    def write_part(self, filename, source, part_index, part_count, name=None):
+        # distributed conversion: wells part_index, part_index + part_count, ... of the plate,
+        # written into the shared output; the plate is completed by finalize() once all parts are written
+        if not source.is_screen():
+            raise ValueError('Only plates can be converted in parts')
+        with shared_zarr_config(self._get_config()):
+            zarr_root = self._open_part_root(filename)
+            self._init_collectors(source)
+            wells = source.get_wells()[part_index::part_count]
+            total_size, plate_index = self._write_screen(zarr_root, source, wells=wells)
+        part = {'part_index': part_index, 'part_count': part_count, 'total_size': total_size,
+                'plate_index': plate_index, 'channel_statistics': self.channel_statistics.to_dict(),
+                'checksums': self.checksum_manifest.to_dict() if self.checksum_manifest is not None else None}
+        write_text(join_path(get_parts_path(filename), f'part-{part_index}.json'), json.dumps(part),
+                   storage_options=self.storage_options)
+        logging.info(f'Part {part_index + 1}/{part_count} of {filename}: {len(wells)} wells')
+
+    def init_parts(self, filename, source):
+        # root, row and well groups shared by the parts (not created concurrently); no results of previous parts
+        with shared_zarr_config(self._get_config()):
+            zarr_root = self._open_root(filename, mode='a')
+            for well_id in source.get_wells():
+                row, col = split_well_name(well_id)
+                zarr_root.require_group(str(row)).require_group(str(col))
+        delete_path(get_parts_path(filename), storage_options=self.storage_options)
+
+    def finalize(self, filename, source, name=None):
+        # combine the parts: plate index, channel statistics and checksums, then write the plate metadata
+        parts_path = get_parts_path(filename)
+        parts = [self._read_part(filename, 0)]
+        part_count = parts[0]['part_count']
+        for part_index in range(1, part_count):
+            parts.append(self._read_part(filename, part_index, part_count))
+        self._init_collectors(source, enable_tile_hashes=False)
+        well_order = ['/'.join(split_well_name(well_id)) for well_id in source.get_wells()]
+        plate_index = dict(parts[0]['plate_index'], wells={}, missing=[])
+        total_size = 0
+        for part in parts:
+            plate_index['wells'].update(part['plate_index']['wells'])
+            plate_index['missing'] += part['plate_index']['missing']
+            self.channel_statistics.update_from_dict(part['channel_statistics'])
+            if self.checksum_manifest is not None and part['checksums'] is not None:
+                self.checksum_manifest.update_from_dict(part['checksums'])
+            total_size += part['total_size']
+        plate_index['wells'] = {well: plate_index['wells'][well] for well in well_order
+                                if well in plate_index['wells']}
+        plate_index['missing'].sort(key=lambda plane: well_order.index(plane['well']))
+        plate_index['total_size'] = total_size
+        with shared_zarr_config(self._get_config()):
+            zarr_root = self._open_root(filename, mode='a')
+            self._write_root_metadata(zarr_root, filename, source, name, plate_index)
+        delete_path(parts_path, storage_options=self.storage_options)
+        logging.info(f'Finalized {filename} from {part_count} parts: {print_hbytes(total_size)}')
+        if self.verbose:
+            print(f'Total data written: {print_hbytes(total_size)}')
+
+    def _read_part(self, filename, part_index, part_count=None):
+        try:
+            return json.loads(read_text(join_path(get_parts_path(filename), f'part-{part_index}.json'),
+                                        storage_options=self.storage_options))
+        except FileNotFoundError:
+            raise ValueError(f'Part {part_index + 1}/{part_count or "?"} of {filename} not (yet) written')
+
+    def _open_part_root(self, filename):
+        # parts may start at the same time: the root group is created by one of them, and opened by the others
+        try:
+            return self._open_root(filename, mode='a')
+        except ContainsGroupError:
+            return self._open_root(filename, mode='r+')
+
+    def _get_config(self):
+        config = {}
+        if self.concurrency:
+            # number of concurrent chunk reads/writes (uploads for object storage)
+            config['async.concurrency'] = self.concurrency
+        return config
+
+    def _open_root(self, filename, mode='w'):
+        zarr_location = create_store(filename, storage_options=self.storage_options, retries=self.retries)
+        return zarr.open_group(zarr_location, mode=mode, zarr_format=self.zarr_version)
+
+    def _init_collectors(self, source, enable_tile_hashes=True):
+        self.channel_statistics = ChannelStatistics(source.get_dtype(), source.get_nchannels())
+        if self.checksums:
+            # chunk checksums (and source tile checksums) are computed from the data while writing
+            self.checksum_manifest = ChecksumManifest()
+            if enable_tile_hashes and not source.enable_tile_hashes():
+                logging.warning('Source tile checksums are not supported for this input format')
+
+    def _write(self, filename, source, name=None, **kwargs):
+        zarr_root = self._open_root(filename, mode='w')
+        self._init_collectors(source)
+
         if source.is_screen():
-            zarr_root, total_size = self._write_screen(filename, source, name, **kwargs)
+            if self.progressive:
+                self._write_screen_preview(zarr_root, source, name)
+            total_size, plate_index = self._write_screen(zarr_root, source, **kwargs)
         else:
-            zarr_root, total_size = self._write_image(filename, source)
+            total_size, plate_index = self._write_image(zarr_root, source), None
+        self._write_root_metadata(zarr_root, filename, source, name, plate_index)
+
+        if self.verbose:
+            print(f'Total data written: {print_hbytes(total_size)}')
 
+    def _write_root_metadata(self, zarr_root, filename, source, name=None, plate_index=None):
+        # root/plate metadata is written last, so an incomplete (e.g. partially uploaded) plate is not recognised
         dtype = source.get_dtype()
         channels = source.get_channels()
         nchannels = source.get_nchannels()
 
-        zarr_root.attrs['omero'] = create_channel_metadata(dtype, channels, nchannels, self.ome_version)
+        zarr_root.attrs['omero'] = create_channel_metadata(dtype, channels, nchannels, self.ome_version,
+                                                           self.channel_statistics)
         zarr_root.attrs['_creator'] = {'name': 'OmeZarrWriter', 'version': VERSION}
+        if plate_index is not None:
+            zarr_root.attrs['plate_index'] = plate_index
+        if self.checksum_manifest is not None:
+            self.checksum_manifest.write(filename, storage_options=self.storage_options)
+        if source.is_screen():
+            self._write_plate_metadata(zarr_root, source, name)
+        self._consolidate_metadata(zarr_root)
 
-        if self.verbose:
-            print(f'Total data written: {print_hbytes(total_size)}')
-
-
-    def _write_screen(self, filename, source, name=None, **kwargs):
-        #zarr_location = parse_url(filename, mode='w', fmt=self.ome_format)
-        zarr_location = filename
-        zarr_root = zarr.open_group(zarr_location, mode='w', zarr_version=self.zarr_version)
+    def _consolidate_metadata(self, zarr_root):
+        # all group / array metadata in the root, readable in a single fetch (zarr v2 .zmetadata / v3 zarr.json)
+        with warnings.catch_warnings():
+            # consolidated metadata is not (yet) part of the zarr v3 specification
+            warnings.simplefilter('ignore', category=UserWarning)
+            zarr.consolidate_metadata(zarr_root.store, path=zarr_root.path, zarr_format=self.zarr_version)
 
+    def _write_plate_metadata(self, zarr_root, source, name=None):
         row_names = source.get_rows()
         col_names = source.get_columns()
-        wells = source.get_wells()
-        well_paths = ['/'.join(split_well_name(well)) for well in wells]
+        well_paths = ['/'.join(split_well_name(well)) for well in source.get_wells()]
         field_paths = source.get_fields()
-
         acquisitions = source.get_acquisitions()
         write_plate_metadata(zarr_root, row_names, col_names, well_paths,
                              name=name, field_count=len(field_paths), acquisitions=acquisitions,
                              fmt=self.ome_format)
+
+    def _write_screen(self, zarr_root, source, wells=None, **kwargs):
+        if wells is None:
+            wells = source.get_wells()
+        field_paths = source.get_fields()
+
+        # compact plate index: well -> field -> levels with array shapes
+        plate_index = {'axes': source.get_dim_order(), 'dtype': str(source.get_dtype()), 'wells': {}}
+        missing = []
         total_size = 0
+        data = None
         for well_id in wells:
-            row, col = split_well_name(well_id)
-            row_group = zarr_root.require_group(str(row))
-            well_group = row_group.require_group(str(col))
-            write_well_metadata(well_group, field_paths, fmt=self.ome_format)
+            with Timer(f'well {well_id}', verbose=False, category='well', args={'well': well_id}):
+                row, col = split_well_name(well_id)
+                row_group = zarr_root.require_group(str(row))
+                well_group = row_group.require_group(str(col))
+                well_index = plate_index['wells'].setdefault(f'{row}/{col}', {})
 
-            for field_index, field in enumerate(field_paths):
-                image_group = well_group.require_group(str(field))
-                data = source.get_data(well_id, field_index)
-                size = self._write_data(image_group, data, source, well_id)
-                total_size += size
+                for field_index, field in enumerate(field_paths):
+                    with Timer(f'field {well_id}/{field}', verbose=False, category='field',
+                               args={'well': well_id, 'field': field}):
+                        image_group = well_group.require_group(str(field))
+                        empty_data = self._get_empty_field(source, well_id, field_index, data)
+                        if empty_data is not None:
+                            data, coverage = empty_data, []
+                        else:
+                            data = source.get_data(well_id, field_index)
+                            coverage = source.get_coverage(well_id, field_index)
+                        size, levels = self._write_data(image_group, data, source, well_id, coverage)
+                        if self.checksum_manifest is not None and empty_data is None:
+                            self.checksum_manifest.add_source_tiles(image_group.path,
+                                                                    source.get_tile_hashes(well_id, field_index))
+                        well_index[str(field)] = levels
+                        total_size += size
+                        for t, c in get_missing_planes(data.shape, source.get_dim_order(), coverage):
+                            missing.append({'well': f'{row}/{col}', 'field': str(field), 't': t, 'c': c})
+                write_well_metadata(well_group, field_paths, fmt=self.ome_format)
 
-        return zarr_root, total_size
+        if missing:
+            logging.info(f'{len(missing)} image planes without data (well, field, t, c) are not stored')
+        # (well, field, t, c) combinations without any image data; these are not stored
+        plate_index['missing'] = missing
+        plate_index['total_size'] = int(total_size)
+        return total_size, plate_index
 
-    def _write_image(self, filename, source):
-        #zarr_location = parse_url(filename, mode='w', fmt=self.ome_format)
-        zarr_location = filename
-        zarr_root = zarr.open_group(zarr_location, mode='w', zarr_version=self.zarr_version)
+    def _write_screen_preview(self, zarr_root, source, name=None):
+        # the coarsest pyramid level of all wells (from the stored source levels where available) with plate
+        # metadata, readable before the full conversion; replaced by the complete pyramids as they are written.
+        # The plate index is written only when complete.
+        dim_order = source.get_dim_order()
+        axes = create_axes_metadata(dim_order)
+        field_paths = source.get_fields()
+        statistics = ChannelStatistics(source.get_dtype(), source.get_nchannels())
+        channel_axis = dim_order.find('c') if 'c' in dim_order else None
+        with Timer('preview', verbose=self.verbose):
+            for well_id in source.get_wells():
+                row, col = split_well_name(well_id)
+                well_group = zarr_root.require_group(str(row)).require_group(str(col))
+                for field_index, field in enumerate(field_paths):
+                    image_group = well_group.require_group(str(field))
+                    pixel_size_scales, scaler = self._create_scale_metadata(source, dim_order,
+                                                                            source.get_position_um(well_id))
+                    level = scaler.max_layer
+                    data = source.get_preview(well_id, field_index, scaler.downscale ** level)
+                    if data is None:
+                        # the full resolution data would be read twice
+                        logging.info(f'No preview: {type(source).__name__} has no stored pyramid levels')
+                        return
+                    chunks, blocks = self._get_chunk_shapes(data.shape, data.dtype)
+                    array = self._create_level_array(image_group, level, data.shape, data.dtype, axes, chunks,
+                                                     blocks)[0]
+                    array[...] = data
+                    statistics.update(data, channel_axis)
+                    write_multiscales_metadata(image_group, [{'path': str(level),
+                                                              'coordinateTransformations': pixel_size_scales[level]}],
+                                               fmt=self.ome_format, axes=axes)
+                write_well_metadata(well_group, field_paths, fmt=self.ome_format)
+            zarr_root.attrs['omero'] = create_channel_metadata(source.get_dtype(), source.get_channels(),
+                                                               source.get_nchannels(), self.ome_version, statistics)
+            zarr_root.attrs['_creator'] = {'name': 'OmeZarrWriter', 'version': VERSION}
+            self._write_plate_metadata(zarr_root, source, name)
+            self._consolidate_metadata(zarr_root)
+        logging.info(f'Preview of {len(source.get_wells())} wells written')
 
+    def _write_image(self, zarr_root, source):
         data = source.get_data()
-        size = self._write_data(zarr_root, data, source)
-        return zarr_root, size
+        size, _ = self._write_data(zarr_root, data, source)
+        if self.checksum_manifest is not None:
+            self.checksum_manifest.add_source_tiles(zarr_root.path, source.get_tile_hashes())
+        return size
 
-    def _write_data(self, group, data, source, well_id=None):
+    def _write_data(self, group, data, source, well_id=None, coverage=None):
         dim_order = source.get_dim_order()
         if dim_order[-1] == 'c':
             dim_order = 'c' + dim_order[:-1]
             data = np.moveaxis(data, -1, 0)
+            if coverage is not None:
+                coverage = [tuple(box[-1:]) + tuple(box[:-1]) for box in coverage]
         axes = create_axes_metadata(dim_order)
         pixel_size_scales, scaler = self._create_scale_metadata(source, dim_order, source.get_position_um(well_id))
 
-        if self.zarr_version >= 3:
-            shards = []
-            chunks = []
-            # TODO: don't redefine chunks for dask/+ arrays
-            for n in data.shape:
-                if n > 10:
-                    shards += [10240]
-                    chunks += [1024]
+        chunks, blocks = self._get_chunk_shapes(data.shape, data.dtype, source.get_tile_size())
+        if isinstance(data, da.Array) and self.max_memory:
+            # data is assembled lazily in slabs: limit the number of slabs in memory at the same time
+            block_size = np.prod(chunks_to_shape(data.chunks)) * data.dtype.itemsize
+            num_workers = int(max(min(self.max_memory // (4 * block_size), os.cpu_count()), 1))
+        else:
+            num_workers = os.cpu_count()
+        levels = self._write_pyramid(group, data, axes, pixel_size_scales, scaler, chunks, blocks,
+                                     channel_axis=dim_order.find('c') if 'c' in dim_order else None,
+                                     coverage=coverage, num_workers=num_workers)
+        size = data.size * data.dtype.itemsize
+        return size, levels
+
+    def _get_chunk_shapes(self, shape, dtype, tile_size=None):
+        # zarr v3: shards of chunks; zarr v2: groups of chunks assembled in memory (still a file per chunk)
+        # with tile_size, x/y chunks are aligned to the source tiles: each chunk is filled from a single tile
+        tile_sizes = [None] * len(shape)
+        if tile_size:
+            tile_sizes[-2:] = tile_size.get('y'), tile_size.get('x')
+        chunks = []
+        blocks = []
+        for n, tile in zip(shape, tile_sizes):
+            if n > 10:
+                if tile:
+                    chunk = min(tile // int(np.ceil(tile / 1024)), n)
                 else:
-                    shards += [1]
-                    chunks += [1]
-            storage_options = {'chunks': chunks, 'shards': shards}
+                    chunk = min(n, 1024)
+                chunks += [chunk]
+                blocks += [min(int(np.ceil(n / chunk)), 10) * chunk]
+            else:
+                chunks += [1]
+                blocks += [1]
+        if self.max_memory:
+            # keep blocks (assembled in memory before writing) well within the memory budget
+            for dim in [-2, -1]:
+                while np.prod(blocks) * dtype.itemsize > self.max_memory // 4 and blocks[dim] > chunks[dim]:
+                    blocks[dim] = max(blocks[dim] // chunks[dim] // 2, 1) * chunks[dim]
+        return chunks, blocks
+
+    def _write_pyramid(self, group, data, axes, pixel_size_scales, scaler, chunks, blocks, channel_axis=None,
+                       coverage=None, num_workers=None):
+        # Each block (a zarr v3 shard or a group of zarr v2 chunks) is assembled in memory and written at once:
+        # for v3 all inner chunks and the shard index are encoded together in one sequential write,
+        # avoiding read-modify-write cycles of partially written shards.
+        # zarr v2 has no such gain: every chunk is still a separate file (store operation); blocks only bound the
+        # data in memory and let zarr write the chunks of a block concurrently, as it does for any larger region.
+        # Blocks without image data (coverage) are not read nor written, and empty chunks are not stored.
+        if isinstance(data, da.Array):
+            pyramid = None
         else:
-            storage_options = None
+            pyramid = scaler.func(data)
 
-        write_image(image=data, group=group, axes=axes, coordinate_transformations=pixel_size_scales,
-                    scaler=scaler, fmt=self.ome_format, storage_options=storage_options)
-        size = data.size * data.dtype.itemsize
-        return size
+        datasets = []
+        levels = []
+        level_data = data
+        for level in range(scaler.max_layer + 1):
+            if pyramid is not None:
+                level_data = pyramid[level]
+            elif level > 0:
+                # downscale from the previous level as written, instead of re-reading the source
+                level_data = scaler.resize_image(da.from_zarr(array))
+            level_coverage = scale_coverage(coverage, [axis['name'] for axis in axes], scaler.downscale ** level)
+            array, level_chunks, level_blocks = self._create_level_array(group, level, level_data.shape,
+                                                                         level_data.dtype, axes, chunks, blocks)
+            for region in iterate_blocks(level_data.shape, level_blocks):
+                if level_coverage is not None and not overlaps_any(region, level_coverage):
+                    continue
+                block = level_data[region]
+                if isinstance(block, da.Array):
+                    # scheduler per call: writers run concurrently in threads (dask.config is process wide)
+                    block = block.compute(scheduler='threads', num_workers=num_workers)
+                array[region] = block
+                if self.checksum_manifest is not None:
+                    self.checksum_manifest.add_block(array.path, level_data.shape, level_chunks, region, block)
+                if level == 0 and self.channel_statistics is not None:
+                    # intensity statistics from the full resolution blocks already in memory
+                    channel_offset = region[channel_axis].start if channel_axis is not None else 0
+                    self.channel_statistics.update(block, channel_axis, channel_offset)
+            datasets.append({'path': str(level), 'coordinateTransformations': pixel_size_scales[level]})
+            levels.append({'path': str(level), 'shape': list(level_data.shape)})
+
+        write_multiscales_metadata(group, datasets, fmt=self.ome_format, axes=axes)
+        return levels
+
+    def _create_level_array(self, group, level, shape, dtype, axes, chunks, blocks):
+        level_chunks = [min(chunk, max(n, 1)) for chunk, n in zip(chunks, shape)]
+        level_blocks = [min(block, int(np.ceil(n / chunk)) * chunk)
+                        for block, chunk, n in zip(blocks, level_chunks, shape)]
+        options = {'chunk_key_encoding': self.ome_format.chunk_key_encoding}
+        if self.zarr_version >= 3:
+            options['shards'] = level_blocks
+            options['dimension_names'] = [axis['name'] for axis in axes]
+        else:
+            options['compressors'] = [create_blosc_compressor()]
+        array = group.create_array(str(level), shape=shape, dtype=dtype, chunks=level_chunks, fill_value=0,
+                                   config={'write_empty_chunks': False}, overwrite=True, **options)
+        return array, level_chunks, level_blocks
 
     def _create_scale_metadata(self, source, dim_order, translation, scaler=None):
         if scaler is None:
@@ -121,3 +397,8 @@ class OmeZarrWriter(OmeWriter):
                                                scale, translation))
             scale /= scaler.downscale
         return pixel_size_scales, scaler
+
+
+def get_parts_path(filename):
+    # results of the separately written parts, next to the output
+    return str(filename).rstrip('/') + '.parts'
@@ -0,0 +1,164 @@
+# Local (SSD) copies of input files on network shares, reused across runs:
+# files are copied with large sequential reads in background threads, least recently used files are evicted
+# beyond the byte budget. A copy is valid while the size and modification time of the original are unchanged.
+# Files in use are leased (a shared lock on <file>.lease until close): they are not evicted by any process
+# sharing the folder.
+
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    # Windows: files still open by a reader can not be removed
+    fcntl = None
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+
+class StagingCache(object):
+    def __init__(self, folder, max_bytes=None, nthreads=4, block_size=16 * 1024 * 1024):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix='staging')
+        self.futures = {}
+        # leases (open lock files) of the files used by this instance
+        self.leases = {}
+        self.copied_bytes = 0
+        self.reused = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def prefetch(self, paths):
+        # start staging the files, in order
+        for path in paths:
+            self._submit(path)
+
+    def get_path(self, path):
+        # local path of the staged copy, waiting until the file is staged
+        return self._submit(path).result()
+
+    def _submit(self, path):
+        path = os.path.abspath(path)
+        with self.lock:
+            future = self.futures.get(path)
+            if future is None:
+                future = self.executor.submit(self._stage, path)
+                self.futures[path] = future
+            return future
+
+    def _get_local_path(self, path):
+        # files with the same name in different folders (e.g. images-0.db) do not collide
+        key = hashlib.sha1(path.encode()).hexdigest()[:16]
+        return os.path.join(self.folder, key, os.path.basename(path))
+
+    def _stage(self, path):
+        local_path = self._get_local_path(path)
+        info_path = local_path + '.json'
+        stat = os.stat(path)
+        info = {'source': path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        self._lease(local_path)
+        if os.path.exists(local_path) and os.path.exists(info_path):
+            try:
+                with open(info_path) as file:
+                    valid = json.load(file) == info
+            except ValueError:
+                valid = False
+            if valid:
+                # the info file modification time marks the last use
+                os.utime(info_path)
+                with self.lock:
+                    self.reused += 1
+                logging.info(f'Staging: reusing {local_path}')
+                self._evict(0)
+                return local_path
+
+        self._evict(stat.st_size)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        # copy to a temporary file: concurrent runs never see a partial copy
+        temp_path = f'{local_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        start = time.perf_counter()
+        try:
+            with open(path, 'rb') as src, open(temp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, self.block_size)
+            os.replace(temp_path, local_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with open(info_path, 'w') as file:
+            json.dump(info, file)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.copied_bytes += stat.st_size
+        logging.info(f'Staging: copied {path} to {local_path} ({stat.st_size / 1e6:.1f}MB in {elapsed:.2f}s)')
+        return local_path
+
+    def _lease(self, local_path):
+        # shared lock, waiting while another process evicts the file; lease files are kept (not removed)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        lease = open(local_path + '.lease', 'a')
+        if fcntl is not None:
+            fcntl.flock(lease, fcntl.LOCK_SH)
+        with self.lock:
+            self.leases[local_path] = lease
+
+    def _remove_unused(self, local_path):
+        # removed only if no process holds a lease
+        with open(local_path + '.lease', 'a') as lease:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lease, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return False
+            try:
+                # the data first: fails while open on Windows
+                os.remove(local_path)
+                os.remove(local_path + '.json')
+            except OSError:
+                return False
+        return True
+
+    def _get_entries(self):
+        entries = []
+        for key in os.listdir(self.folder):
+            subfolder = os.path.join(self.folder, key)
+            if not os.path.isdir(subfolder):
+                continue
+            for filename in os.listdir(subfolder):
+                if filename.endswith('.json'):
+                    info_path = os.path.join(subfolder, filename)
+                    local_path = info_path[:-len('.json')]
+                    if os.path.exists(local_path):
+                        entries.append((os.path.getmtime(info_path), local_path, os.path.getsize(local_path)))
+        return entries
+
+    def _evict(self, size):
+        # make room for a new file of this size, removing the least recently used files first
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            entries = sorted(self._get_entries())
+            total_size = sum(entry[2] for entry in entries)
+            for _, local_path, file_size in entries:
+                if total_size + size <= self.max_bytes:
+                    break
+                if local_path in self.leases or not self._remove_unused(local_path):
+                    continue
+                total_size -= file_size
+                logging.info(f'Staging: evicted {local_path}')
+
+    def get_stats(self):
+        with self.lock:
+            return {'staged': len(self.futures), 'reused': self.reused, 'copied_bytes': self.copied_bytes}
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            for lease in self.leases.values():
+                # releases the lock
+                lease.close()
+            self.leases = {}
@@ -0,0 +1,191 @@
+# Plate from a folder of single plane tiff files (per well / field / channel / time point / z),
+# indexed once from the file names (relative to the folder) and read in parallel
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import numpy as np
+import os
+import re
+from tifffile import imread
+
+from src.ImageSource import ImageSource
+from src.TiffSource import TiffSource
+from src.util import split_well_name
+
+
+# named groups: well or row + col, and optionally field, channel, time, z
+FILENAME_PATTERNS = [
+    # Operetta / Opera Phenix: r02c03f01p01-ch1sk1fk1fl1.tiff
+    r'r(?P<row>\d+)c(?P<col>\d+)f(?P<field>\d+)p(?P<z>\d+)-ch(?P<channel>\d+)sk(?P<time>\d+)[^/\\]*\.tiff?$',
+    # ImageXpress: [TimePoint_1/][ZStep_1/]plate_B02_s1_w1.tif
+    r'(?:TimePoint_(?P<time>\d+)[/\\])?(?:ZStep_(?P<z>\d+)[/\\])?[^/\\]*_(?P<well>[A-Z]{1,2}\d{2})'
+    r'(?:_s(?P<field>\d+))?(?:_w(?P<channel>\d+))?[^/\\]*\.tiff?$',
+]
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+
+class TiffFolderSource(ImageSource):
+    def __init__(self, uri, metadata={}, max_memory=None, pattern=None, nthreads=8):
+        super().__init__(uri, metadata, max_memory=max_memory)
+        self.patterns = [re.compile(pattern)] if pattern else [re.compile(pattern1) for pattern1 in FILENAME_PATTERNS]
+        self.executor = ThreadPoolExecutor(max_workers=nthreads, thread_name_prefix='tiff_folder')
+
+    def init_metadata(self):
+        filenames = []
+        for folder, _, folder_filenames in os.walk(self.uri):
+            for filename in folder_filenames:
+                if filename.lower().endswith(TIFF_EXTENSIONS):
+                    filenames.append(os.path.relpath(os.path.join(folder, filename), self.uri))
+        filenames.sort()
+        if not filenames:
+            raise ValueError(f'No tiff files found in {self.uri}')
+        pattern = self._get_pattern(filenames)
+
+        # index: (time point, well, field, channel, z) -> file
+        entries = []
+        for filename in filenames:
+            match = pattern.search(filename.replace(os.sep, '/'))
+            if match is None:
+                logging.warning(f'Skipping {filename}: file name does not match the pattern')
+                continue
+            values = match.groupdict()
+            if values.get('well'):
+                row, col = split_well_name(values['well'])
+            else:
+                row, col = chr(ord('A') + int(values['row']) - 1), str(int(values['col']))
+            entries.append(((int(values.get('time') or 0), f'{row}{col}', int(values.get('field') or 0),
+                             int(values.get('channel') or 0), int(values.get('z') or 0)), filename))
+        keys = [key for key, _ in entries]
+        time_points, wells, fields, channels, zs = [sorted(set(values)) for values in zip(*keys)]
+        wells = sorted(wells, key=lambda well: split_well_name(well, col_as_int=True))
+        indices = [{value: index for index, value in enumerate(values)}
+                   for values in [time_points, wells, fields, channels, zs]]
+        self.files = {tuple(index[value] for index, value in zip(indices, key)): filename
+                      for key, filename in entries}
+
+        # plane shape, data type and pixel size from the first file
+        first = TiffSource(os.path.join(self.uri, entries[0][1]))
+        first.init_metadata()
+        self.plane_shape = first.tiff.pages.first.shape
+        if len(self.plane_shape) != 2 or len(first.tiff.pages) != 1:
+            raise ValueError(f'Only single plane (y, x) tiff files are supported: {entries[0][1]}')
+        self.dtype = first.get_dtype()
+        self.pixel_size = first.get_pixel_size_um()
+        first.close()
+
+        self.time_points = time_points
+        self.wells = wells
+        self.fields = [str(fieldi) for fieldi in range(len(fields))]
+        self.channel_ids = channels
+        self.nz = len(zs)
+        self.rows = sorted({split_well_name(well)[0] for well in wells})
+        self.columns = sorted({split_well_name(well)[1] for well in wells}, key=int)
+        self.occupancy = np.zeros((len(time_points), len(wells), len(fields), len(channels)), dtype=bool)
+        for t, well, field, channel, _ in self.files:
+            self.occupancy[t, well, field, channel] = True
+        self.metadata = {'pattern': pattern.pattern, 'files': len(self.files), 'wells': len(wells),
+                         'fields': len(fields), 'channels': len(channels), 'time_points': len(time_points),
+                         'z': self.nz, 'plane_shape': self.plane_shape, 'dtype': str(self.dtype)}
+        logging.info(f'Tiff folder {self.uri}: {len(self.files)} files')
+        return self.metadata
+
+    def _get_pattern(self, filenames):
+        # the first pattern matching the (first) files
+        for pattern in self.patterns:
+            if pattern.search(filenames[0].replace(os.sep, '/')):
+                return pattern
+        raise ValueError(f'Unsupported file names: {filenames[0]}. Supported patterns: {FILENAME_PATTERNS}')
+
+    def is_screen(self):
+        return True
+
+    def _get_field_files(self, well_id, field_id):
+        welli = self.wells.index(well_id)
+        return {(t, c, z): self.files.get((t, welli, field_id, c, z))
+                for t in range(len(self.time_points)) for c in range(len(self.channel_ids)) for z in range(self.nz)}
+
+    def _read_plane(self, filename):
+        data = imread(os.path.join(self.uri, filename))
+        if data.shape != self.plane_shape:
+            raise ValueError(f'Unexpected image shape {data.shape} in {filename}, expected {self.plane_shape}')
+        return data
+
+    def get_data(self, well_id=None, field_id=None):
+        shape = len(self.time_points), len(self.channel_ids), self.nz, *self.plane_shape
+        field_files = self._get_field_files(well_id, field_id)
+        if self.max_memory and np.prod(shape) * self.dtype.itemsize > self.max_memory:
+            # planes are read when needed (in slabs)
+            import dask
+            import dask.array as da
+
+            planes = {}
+            for index, filename in field_files.items():
+                if filename is not None:
+                    planes[index] = da.from_delayed(dask.delayed(self._read_plane)(filename), self.plane_shape,
+                                                    self.dtype)
+                else:
+                    planes[index] = da.zeros(self.plane_shape, dtype=self.dtype)
+            return da.stack([da.stack([da.stack([planes[(t, c, z)] for z in range(shape[2])])
+                                       for c in range(shape[1])]) for t in range(shape[0])])
+
+        # all planes of the field read in parallel
+        data = np.zeros(shape, dtype=self.dtype)
+        indices = [index for index, filename in field_files.items() if filename is not None]
+        for index, plane in zip(indices, self.executor.map(self._read_plane,
+                                                           [field_files[index] for index in indices])):
+            data[index] = plane
+        return data
+
+    def get_coverage(self, well_id=None, field_id=None):
+        # planes present
+        sizey, sizex = self.plane_shape
+        return [(slice(t, t + 1), slice(c, c + 1), slice(z, z + 1), slice(0, sizey), slice(0, sizex))
+                for (t, c, z), filename in self._get_field_files(well_id, field_id).items() if filename is not None]
+
+    def get_occupancy(self):
+        return self.occupancy
+
+    def get_name(self):
+        return os.path.basename(os.path.normpath(self.uri))
+
+    def get_dim_order(self):
+        return 'tczyx'
+
+    def get_dtype(self):
+        return self.dtype
+
+    def get_pixel_size_um(self):
+        return self.pixel_size
+
+    def get_position_um(self, well_id=None):
+        return {}
+
+    def get_channels(self):
+        return [{'label': f'Channel {channel_id}', 'color': 'FFFFFF'} for channel_id in self.channel_ids]
+
+    def get_nchannels(self):
+        return len(self.channel_ids)
+
+    def get_rows(self):
+        return self.rows
+
+    def get_columns(self):
+        return self.columns
+
+    def get_wells(self):
+        return self.wells
+
+    def get_time_points(self):
+        return self.time_points
+
+    def get_fields(self):
+        return self.fields
+
+    def get_acquisitions(self):
+        return []
+
+    def get_total_data_size(self):
+        return len(self.files) * int(np.prod(self.plane_shape)) * self.dtype.itemsize
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -3,14 +3,14 @@ import numpy as np
 import os
 from tifffile import TiffFile, xml2dict
 
-from ome_zarr_util import int_to_hexrgb
+from src.ome_zarr_util import int_to_hexrgb
 from src.ImageSource import ImageSource
-from src.util import convert_to_um, ensure_list
+from src.util import convert_to_um, ensure_list, get_region_index, get_slab_chunks
 
 
 class TiffSource(ImageSource):
-    def __init__(self, uri, metadata={}):
-        super().__init__(uri, metadata)
+    def __init__(self, uri, metadata={}, max_memory=None):
+        super().__init__(uri, metadata, max_memory=max_memory)
         self.tiff = TiffFile(uri)
 
     def init_metadata(self):
@@ -46,11 +46,11 @@ class TiffSource(ImageSource):
             self.shape = pixels.get('SizeT'), pixels.get('SizeC'), pixels.get('SizeZ'), pixels.get('SizeY'), pixels.get('SizeX')
             self.dim_order = ''.join(reversed(pixels['DimensionOrder'].lower()))
             self.dtype = np.dtype(pixels['Type'])
-            if 'PositionX' in pixels:
+            if 'PhysicalSizeX' in pixels:
                 pixel_size['x'] = convert_to_um(float(pixels.get('PhysicalSizeX')), pixels.get('PhysicalSizeXUnit'))
-            if 'PositionY' in pixels:
+            if 'PhysicalSizeY' in pixels:
                 pixel_size['y'] = convert_to_um(float(pixels.get('PhysicalSizeY')), pixels.get('PhysicalSizeYUnit'))
-            if 'PositionZ' in pixels:
+            if 'PhysicalSizeZ' in pixels:
                 pixel_size['z'] = convert_to_um(float(pixels.get('PhysicalSizeZ')), pixels.get('PhysicalSizeZUnit'))
             plane = pixels.get('Plane')
             if plane:
@@ -115,11 +115,45 @@ class TiffSource(ImageSource):
         return self.is_plate
 
     def get_data(self, well_id=None, field_id=None):
-        data = self.tiff.asarray()
+        if self.max_memory and self.get_total_data_size() > self.max_memory:
+            # read lazily in slabs through the tiff zarr interface
+            import dask.array as da
+            import zarr
+
+            data = da.from_zarr(zarr.open(self.tiff.aszarr(), mode='r'))
+            data = data.rechunk(get_slab_chunks(data.shape, self.dtype, self.max_memory // 8))
+        else:
+            data = self.tiff.asarray()
+        return self._expand_dims(data)
+
+    def _get_axes(self):
+        if self.tiff.series:
+            return self.tiff.series[0].axes.lower().replace('s', 'c')
+        return self.dim_order
+
+    def _expand_dims(self, data):
+        if self.tiff.series and data.ndim < len(self.dim_order):
+            # insert missing dimensions in the right position
+            axes = self._get_axes()
+            for index, dim in enumerate(self.dim_order):
+                if dim not in axes:
+                    data = np.expand_dims(data, index)
+                    axes = axes[:index] + dim + axes[index:]
         while data.ndim < len(self.dim_order):
             data = np.expand_dims(data, 0)
         return data
 
+    def get_region(self, well_id=None, field_id=None, t=None, c=None, z=None, y=None, x=None, level=0):
+        # only the tiff tiles / strips overlapping the region are read, through the tiff zarr interface
+        import zarr
+
+        nlevels = len(self.tiff.series[0].levels) if self.tiff.series else 1
+        if not 0 <= level < nlevels:
+            raise ValueError(f'Invalid level: {level}. Number of levels: {nlevels}')
+        data = zarr.open(self.tiff.aszarr(level=level), mode='r')
+        data = data[get_region_index(self._get_axes(), t=t, c=c, z=z, y=y, x=x)]
+        return self._expand_dims(data)
+
     def get_name(self):
         return self.name
 
@@ -168,7 +202,7 @@ class TiffSource(ImageSource):
         return []
 
     def get_total_data_size(self):
-        total_size = np.prod(self.shape)
+        total_size = np.prod(self.shape) * self.dtype.itemsize
         if self.is_plate:
             total_size *= len(self.get_wells()) * len(self.get_fields())
         return total_size
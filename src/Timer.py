@@ -1,20 +1,43 @@
 # https://www.geeksforgeeks.org/time-process_time-function-in-python/
+# Trace files use the Chrome trace event format (chrome://tracing, https://ui.perfetto.dev)
+# https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
 
+import cProfile
+import glob
+import json
 import logging
+import os
+import threading
 import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from src.util import print_hbytes
 
 
 class Timer(object):
-    def __init__(self, title, auto_unit=True, verbose=True):
+    def __init__(self, title, auto_unit=True, verbose=True, category='stage', args=None):
         self.title = title
         self.auto_unit = auto_unit
         self.verbose = verbose
+        self.category = category
+        self.args = args
+        self.span = None
 
     def __enter__(self):
         self.ptime_start = time.process_time()
         self.time_start = time.time()
+        if profiler.enabled:
+            self.span = profiler.begin(self.title, self.category, self.args)
+        return self
 
     def __exit__(self, type, value, traceback):
+        if self.span is not None:
+            profiler.end(self.span, error=value)
         if self.verbose:
             ptime_end = time.process_time()
             time_end = time.time()
@@ -29,4 +52,179 @@ class Timer(object):
                     pelapsed /= 60
                     elapsed /= 60
                     unit = 'hours'
-            logging.info(f'Time {self.title}: {elapsed:.1f} ({pelapsed:.1f}) {unit}')
+            message = f'Time {self.title}: {elapsed:.1f} ({pelapsed:.1f}) {unit}'
+            if self.span is not None:
+                message += f' peak memory: {print_hbytes(self.span["peak_memory"])}'
+                message += f' peak rss: {print_hbytes(self.span["peak_rss"])}'
+            logging.info(message)
+
+
+class Profiler(object):
+    # Events are streamed to disk as they complete, so the trace survives the process being killed (e.g. OOM).
+    # The trace uses the JSON array format, which trace viewers accept without the closing bracket.
+    def __init__(self):
+        self.enabled = False
+        self.output_folder = None
+        self.name = None
+        self.trace_memory = False
+        self.cprofile = None
+        self.cprofile_depth = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.trace_file = None
+        self.trace_filename = None
+        self.is_main = False
+        self.nsessions = 0
+
+    def enable(self, output_folder, name='profile', use_cprofile=False, trace_memory=True, is_main=True):
+        # is_main: merge the traces of all processes on disable; only for the coordinating process
+        if self.enabled:
+            return
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        self.output_folder = output_folder
+        self.name = name
+        self.is_main = is_main
+        self.local = threading.local()
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if use_cprofile:
+            self.cprofile = cProfile.Profile()
+        # a process can be profiled several times (e.g. a worker converting several jobs)
+        self.nsessions += 1
+        self.trace_filename = os.path.join(output_folder, f'{name}-{os.getpid()}-{self.nsessions}.trace.json')
+        self.trace_file = open(self.trace_filename, 'w')
+        self.trace_file.write('[\n')
+        self._write_event({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                           'args': {'name': f'{name} ({os.getpid()})'}})
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return None
+        self.enabled = False
+        with self.lock:
+            self.trace_file.close()
+            self.trace_file = None
+        if self.cprofile is not None:
+            self.cprofile.dump_stats(os.path.join(self.output_folder, f'{self.name}-{os.getpid()}.prof'))
+            self.cprofile = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if self.is_main:
+            return merge_process_traces(self.output_folder, self.name)
+        return self.trace_filename
+
+    def begin(self, title, category='stage', args=None):
+        stack = self._get_stack()
+        span = {'name': title, 'cat': category, 'args': dict(args) if args else {},
+                'start': time.perf_counter_ns(), 'peak_memory': 0, 'peak_rss': 0}
+        if self.trace_memory and tracemalloc.is_tracing():
+            # tracemalloc tracks a single process-wide peak: hand the current peak to the parent span and restart
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1]['peak_memory'] = max(stack[-1]['peak_memory'], peak)
+            tracemalloc.reset_peak()
+            span['start_memory'] = current
+        span['start_rss'] = get_rss()
+        if self.cprofile is not None and category == 'stage' and threading.current_thread() is threading.main_thread():
+            if self.cprofile_depth == 0:
+                self.cprofile.enable()
+            self.cprofile_depth += 1
+            span['cprofile'] = True
+        stack.append(span)
+        return span
+
+    def end(self, span, error=None):
+        stack = self._get_stack()
+        if span in stack:
+            stack.remove(span)
+        if span.pop('cprofile', False):
+            self.cprofile_depth -= 1
+            if self.cprofile_depth == 0:
+                self.cprofile.disable()
+        end = time.perf_counter_ns()
+        if self.trace_memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            span['peak_memory'] = max(span['peak_memory'], peak)
+            if stack:
+                stack[-1]['peak_memory'] = max(stack[-1]['peak_memory'], span['peak_memory'])
+            span['args']['memory_delta'] = current - span.pop('start_memory', 0)
+        rss = get_rss()
+        span['peak_rss'] = get_peak_rss()
+        span['args'].update({'peak_memory': span['peak_memory'], 'rss': rss,
+                             'rss_delta': rss - span.pop('start_rss', 0), 'peak_rss': span['peak_rss']})
+        if error is not None:
+            span['args']['error'] = repr(error)
+        pid, tid = os.getpid(), threading.get_ident()
+        self._write_event({'name': span['name'], 'cat': span['cat'], 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': span['start'] / 1000, 'dur': (end - span['start']) / 1000, 'args': span['args']})
+        self._write_event({'name': 'memory', 'ph': 'C', 'pid': pid, 'tid': tid, 'ts': end / 1000,
+                           'args': {'rss': rss, 'traced': span['peak_memory']}})
+        return span
+
+    def _get_stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+            self._write_event({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                               'args': {'name': threading.current_thread().name}})
+        return self.local.stack
+
+    def _write_event(self, event):
+        with self.lock:
+            if self.trace_file is not None:
+                self.trace_file.write(json.dumps(event, default=str) + ',\n')
+                self.trace_file.flush()
+
+
+def merge_process_traces(output_folder, name, pid=None, output_name=None):
+    # merges (and removes) the traces of all processes, or of a single process, profiled with this name
+    pattern = f'{name}-{pid}-*.trace.json' if pid is not None else f'{name}-*.trace.json'
+    filenames = glob.glob(os.path.join(output_folder, pattern))
+    output_filename = os.path.join(output_folder, f'{output_name or name}.trace.json')
+    merge_traces(filenames, output_filename)
+    for filename in filenames:
+        os.remove(filename)
+    return output_filename
+
+
+def merge_traces(filenames, output_filename):
+    events = []
+    for filename in sorted(filenames):
+        if os.path.abspath(filename) == os.path.abspath(output_filename):
+            continue
+        events.extend(read_trace(filename))
+    with open(output_filename, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+    return output_filename
+
+
+def read_trace(filename):
+    # also reads unterminated traces of processes that did not finish
+    with open(filename) as file:
+        content = file.read().strip()
+    if content.startswith('{'):
+        return json.loads(content).get('traceEvents', [])
+    content = content.rstrip(',')
+    if not content.endswith(']'):
+        content += ']'
+    return json.loads(content)
+
+
+def get_rss():
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return get_peak_rss()
+
+
+def get_peak_rss():
+    if resource is None:
+        return 0
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+profiler = Profiler()
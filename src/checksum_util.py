@@ -0,0 +1,129 @@
+# Content checksums of written chunks and source tiles (manifest), and verification of the output against them
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import random
+import threading
+import zarr
+
+from src.ome_zarr_util import iterate_blocks
+from src.storage_util import create_store, join_path, read_text, write_text
+
+
+MANIFEST_FILENAME = 'checksums.json'
+HASH_ALGORITHM = 'blake2b-128'
+
+
+def hash_data(data):
+    # hash of the (uncompressed) pixel values in C order
+    if isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def get_chunk_key(start, chunks):
+    return '/'.join(str(index // chunk) for index, chunk in zip(start, chunks))
+
+
+def get_chunk_region(key, chunks, shape):
+    indices = [int(index) for index in key.split('/')]
+    return tuple(slice(index * chunk, min((index + 1) * chunk, size))
+                 for index, chunk, size in zip(indices, chunks, shape))
+
+
+class ChecksumManifest:
+    def __init__(self):
+        self.arrays = {}
+        self.source_tiles = {}
+        self.lock = threading.Lock()
+
+    def add_block(self, array_path, shape, chunks, region, block):
+        # hashes of all chunks in a written block
+        hashes = {}
+        for chunk_region in iterate_blocks(block.shape, chunks):
+            start = [slice0.start + slice1.start for slice0, slice1 in zip(region, chunk_region)]
+            hashes[get_chunk_key(start, chunks)] = hash_data(block[chunk_region])
+        with self.lock:
+            array = self.arrays.setdefault(array_path, {'shape': list(shape), 'chunks': list(chunks), 'hashes': {}})
+            array['hashes'].update(hashes)
+
+    def add_source_tiles(self, image_path, tiles):
+        if tiles:
+            with self.lock:
+                self.source_tiles.setdefault(image_path, []).extend(tiles)
+
+    def update_from_dict(self, manifest):
+        with self.lock:
+            for array_path, array in manifest['arrays'].items():
+                self.arrays.setdefault(array_path, {'shape': array['shape'], 'chunks': array['chunks'],
+                                                    'hashes': {}})['hashes'].update(array['hashes'])
+            for image_path, tiles in manifest['source_tiles'].items():
+                self.source_tiles.setdefault(image_path, []).extend(tiles)
+
+    def to_dict(self):
+        return {'algorithm': HASH_ALGORITHM, 'arrays': self.arrays, 'source_tiles': self.source_tiles}
+
+    def write(self, output_path, storage_options=None):
+        write_text(join_path(output_path, MANIFEST_FILENAME), json.dumps(self.to_dict()),
+                   storage_options=storage_options)
+
+
+def read_manifest(output_path, storage_options=None):
+    return json.loads(read_text(join_path(output_path, MANIFEST_FILENAME), storage_options=storage_options))
+
+
+def verify_output(output_path, source_folder=None, nsamples=100, max_workers=None, storage_options=None, seed=0):
+    # check all chunks against the manifest, and a random sample of source tiles against the (level 0) output
+    # and, with source_folder, against the (re-read) source files; memory is bounded by one chunk / tile per worker
+    manifest = read_manifest(output_path, storage_options=storage_options)
+    if manifest.get('algorithm') != HASH_ALGORITHM:
+        raise ValueError(f'Unsupported checksum algorithm: {manifest.get("algorithm")}')
+    zarr_root = zarr.open_group(create_store(output_path, storage_options=storage_options), mode='r')
+    arrays = {}
+
+    def get_array(array_path):
+        if array_path not in arrays:
+            arrays[array_path] = zarr_root[array_path]
+        return arrays[array_path]
+
+    def check_chunk(array_path, key, expected_hash):
+        array = get_array(array_path)
+        region = get_chunk_region(key, array.chunks, array.shape)
+        if hash_data(array[region]) != expected_hash:
+            return f'{array_path} chunk {key}: checksum mismatch'
+        return None
+
+    def check_tile(image_path, tile):
+        array = get_array(f'{image_path}/0'.lstrip('/'))
+        region = tuple(slice(start, end) for start, end in tile['region'])
+        if hash_data(array[region]) != tile['hash']:
+            return f'{image_path} tile {tile["region"]}: output does not match source'
+        if source_folder is not None:
+            with open(os.path.join(source_folder, tile['file']), 'rb') as file:
+                file.seek(tile['offset'])
+                if hash_data(file.read(tile['size'])) != tile['hash']:
+                    return f'{image_path} tile {tile["region"]}: source file {tile["file"]} changed'
+        return None
+
+    chunk_tasks = [(array_path, key, expected_hash)
+                   for array_path, array in manifest['arrays'].items()
+                   for key, expected_hash in array['hashes'].items()]
+    tiles = [(image_path, tile) for image_path, image_tiles in manifest['source_tiles'].items()
+             for tile in image_tiles]
+    if nsamples is not None and nsamples < len(tiles):
+        tiles = random.Random(seed).sample(tiles, nsamples)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors = list(executor.map(lambda task: check_chunk(*task), chunk_tasks))
+        errors += list(executor.map(lambda task: check_tile(*task), tiles))
+    errors = [error for error in errors if error is not None]
+    for error in errors:
+        logging.error(error)
+    result = {'chunks': len(chunk_tasks), 'source_tiles': len(tiles), 'errors': errors, 'valid': not errors}
+    logging.info(f'Verified {len(chunk_tasks)} chunks and {len(tiles)} source tiles of {output_path}: '
+                 f'{len(errors)} errors')
+    return result
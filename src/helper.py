@@ -1,25 +1,43 @@
+import logging
 import os
 
 
-def create_source(filename):
+def create_source(filename, max_memory=None, fuse_fields=False, selection=None, cache_size=None,
+                  staging_folder=None, staging_size=None):
     input_ext = os.path.splitext(filename)[1].lower()
 
-    if input_ext == '.db':
+    if os.path.isdir(filename):
+        # folder of tiff files
+        from src.TiffFolderSource import TiffFolderSource
+        source = TiffFolderSource(filename, max_memory=max_memory)
+        input_ext = 'tiff folder'
+    elif input_ext == '.db':
         from src.ImageDbSource import ImageDbSource
-        source = ImageDbSource(filename)
+        source = ImageDbSource(filename, max_memory=max_memory, fuse_fields=fuse_fields, selection=selection,
+                               cache_size=cache_size, staging_folder=staging_folder, staging_size=staging_size)
     elif input_ext == '.isyntax':
         from src.ISyntaxSource import ISyntaxSource
-        source = ISyntaxSource(filename)
+        source = ISyntaxSource(filename, max_memory=max_memory)
     elif 'tif' in input_ext:
         from src.TiffSource import TiffSource
-        source = TiffSource(filename)
+        source = TiffSource(filename, max_memory=max_memory)
     else:
         raise ValueError(f'Unsupported input file format: {input_ext}')
+    if staging_folder and input_ext != '.db':
+        logging.warning(f'Staging is not supported for {input_ext} input: reading the original file')
+    if selection and input_ext != '.db':
+        logging.warning(f'Subset selection is not supported for {input_ext} input: converting all data')
     return source
 
 
-def create_writer(output_format, verbose=False):
-    if 'zar' in output_format:
+def create_writer(output_format, verbose=False, max_memory=None, storage_options=None, concurrency=None,
+                  checksums=False, progressive=False):
+    if 'ref' in output_format:
+        # virtual ome-zarr: references to the source tiles
+        from src.OmeZarrReferenceWriter import OmeZarrReferenceWriter
+        writer = OmeZarrReferenceWriter(verbose=verbose, storage_options=storage_options)
+        ext = '.ome.zarr.json'
+    elif 'zar' in output_format:
         if '3' in output_format:
             zarr_version = 3
             ome_version = '0.5'
@@ -27,11 +45,13 @@ def create_writer(output_format, verbose=False):
             zarr_version = 2
             ome_version = '0.4'
         from src.OmeZarrWriter import OmeZarrWriter
-        writer = OmeZarrWriter(zarr_version=zarr_version, ome_version=ome_version, verbose=verbose)
+        writer = OmeZarrWriter(zarr_version=zarr_version, ome_version=ome_version, verbose=verbose,
+                               max_memory=max_memory, storage_options=storage_options, concurrency=concurrency,
+                               checksums=checksums, progressive=progressive)
         ext = '.ome.zarr'
     elif 'tif' in output_format:
         from src.OmeTiffWriter import OmeTiffWriter
-        writer = OmeTiffWriter(verbose=verbose)
+        writer = OmeTiffWriter(verbose=verbose, max_memory=max_memory)
         ext = '.ome.tiff'
     else:
         raise ValueError(f'Unsupported output format: {output_format}')
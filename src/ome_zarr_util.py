@@ -1,4 +1,14 @@
+from contextlib import contextmanager
+import itertools
 import numpy as np
+import threading
+import zarr
+
+
+# zarr.config is process wide: set once while (concurrent) writers use it, restored after the last one;
+# concurrent writers should use the same configuration
+zarr_config_lock = threading.Lock()
+zarr_config_state = {'users': 0, 'context': None, 'config': None}
 
 
 def create_axes_metadata(dimension_order):
@@ -43,7 +53,7 @@ def create_transformation_metadata(dimension_order, pixel_size_um, scale, transl
     return metadata
 
 
-def create_channel_metadata(dtype, channels, nchannels, ome_version):
+def create_channel_metadata(dtype, channels, nchannels, ome_version, statistics=None):
     if len(channels) < nchannels:
         labels = []
         colors = []
@@ -65,7 +75,11 @@ def create_channel_metadata(dtype, channels, nchannels, ome_version):
             info = np.iinfo(dtype)
             start, end = info.min, info.max
         min, max = start, end
-        channel['window'] = {'start': start, 'end': end, 'min': min, 'max': max}
+        window = {'start': start, 'end': end, 'min': min, 'max': max}
+        if statistics is not None:
+            # intensity range of the data written, collected while writing
+            window = statistics.get_window(channeli) or window
+        channel['window'] = window
         omezarr_channels.append(channel)
 
     metadata = {
@@ -75,6 +89,56 @@ def create_channel_metadata(dtype, channels, nchannels, ome_version):
     return metadata
 
 
+def create_blosc_compressor():
+    # same as ome_zarr default for zarr v2
+    from numcodecs import Blosc
+    return Blosc(cname='zstd', clevel=5, shuffle=Blosc.SHUFFLE)
+
+
+def iterate_blocks(shape, block_shape):
+    ranges = [range(0, size, block_size) for size, block_size in zip(shape, block_shape)]
+    for starts in itertools.product(*ranges):
+        yield tuple(slice(start, min(start + block_size, size))
+                    for start, block_size, size in zip(starts, block_shape, shape))
+
+
+def overlaps_any(region, boxes):
+    return any(all(slice1.start < box_slice.stop and box_slice.start < slice1.stop
+                   for slice1, box_slice in zip(region, box))
+               for box in boxes)
+
+
+def scale_coverage(coverage, dimension_order, scale):
+    # coverage boxes at a pyramid level downscaled in x and y
+    if coverage is None or scale == 1:
+        return coverage
+    scaled_coverage = []
+    for box in coverage:
+        scaled_box = []
+        for dimension, slice1 in zip(dimension_order, box):
+            if dimension in 'xy':
+                slice1 = slice(int(slice1.start // scale), int(np.ceil(slice1.stop / scale)))
+            scaled_box.append(slice1)
+        scaled_coverage.append(tuple(scaled_box))
+    return scaled_coverage
+
+
+def get_missing_planes(shape, dimension_order, coverage):
+    # (t, c) combinations without any coverage
+    if coverage is None:
+        return []
+    nt = shape[dimension_order.index('t')] if 't' in dimension_order else 1
+    nc = shape[dimension_order.index('c')] if 'c' in dimension_order else 1
+    present = set()
+    for box in coverage:
+        t_range = box[dimension_order.index('t')] if 't' in dimension_order else slice(0, 1)
+        c_range = box[dimension_order.index('c')] if 'c' in dimension_order else slice(0, 1)
+        for t in range(t_range.start, t_range.stop):
+            for c in range(c_range.start, c_range.stop):
+                present.add((t, c))
+    return [(t, c) for t in range(nt) for c in range(nc) if (t, c) not in present]
+
+
 def scale_dimensions_xy(shape0, dimension_order, scale):
     shape = []
     if scale == 1:
@@ -104,3 +168,24 @@ def int_to_hexrgb(intrgb):
         rgb[-1] = 1
     hexrgb = ''.join([hex(int(x * 255))[2:].upper().zfill(2) for x in rgb])
     return hexrgb
+
+
+@contextmanager
+def shared_zarr_config(config):
+    with zarr_config_lock:
+        if zarr_config_state['users'] == 0:
+            zarr_config_state['context'] = zarr.config.set(config)
+            zarr_config_state['config'] = dict(config)
+        elif config != zarr_config_state['config']:
+            raise ValueError(f'Conflicting zarr configuration {config}: '
+                             f'{zarr_config_state["config"]} is in use by a concurrent writer')
+        zarr_config_state['users'] += 1
+    try:
+        yield
+    finally:
+        with zarr_config_lock:
+            zarr_config_state['users'] -= 1
+            if zarr_config_state['users'] == 0:
+                zarr_config_state['context'].__exit__(None, None, None)
+                zarr_config_state['context'] = None
+                zarr_config_state['config'] = None
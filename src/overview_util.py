@@ -0,0 +1,148 @@
+# Plate overview and well thumbnails (PNG), rendered from the coarsest source pyramid level
+
+import json
+import logging
+import numpy as np
+import os
+import struct
+import zlib
+
+from src.ChannelStatistics import ChannelStatistics
+from src.helper import create_source
+from src.Timer import Timer
+from src.util import split_well_name
+
+
+def write_png(filename, rgb):
+    # minimal 8-bit RGB png writer (no filtering)
+    height, width = rgb.shape[:2]
+    rows = np.zeros((height, 1 + width * 3), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(chunk_type, content):
+        return (struct.pack('>I', len(content)) + chunk_type + content +
+                struct.pack('>I', zlib.crc32(chunk_type + content) & 0xFFFFFFFF))
+
+    with open(filename, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+        file.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        file.write(chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)))
+        file.write(chunk(b'IEND', b''))
+
+
+def get_channel_planes(data, dim_order):
+    # (c, y, x): first time point, maximum projection over z
+    data = np.asarray(data)
+    for dim in reversed(dim_order):
+        axis = dim_order.index(dim)
+        if dim == 't':
+            data = data.take(0, axis=axis)
+        elif dim == 'z':
+            data = data.max(axis=axis)
+    dims = ''.join(dim for dim in dim_order if dim in 'cyx')
+    if 'c' not in dims:
+        data = data[np.newaxis]
+        dims = 'c' + dims
+    return np.moveaxis(data, [dims.index(dim) for dim in 'cyx'], [0, 1, 2])
+
+
+def hex_to_rgb(color):
+    color = (color or 'FFFFFF').lstrip('#')[-6:].rjust(6, 'F')
+    return np.array([int(color[index:index + 2], 16) for index in range(0, 6, 2)], dtype=np.float32) / 255
+
+
+def render_rgb(planes, colors, windows):
+    # additive composite of the channels, each scaled to its window and colored
+    rgb = np.zeros(planes.shape[1:] + (3,), dtype=np.float32)
+    for plane, color, window in zip(planes, colors, windows):
+        if window is None:
+            continue
+        start, end = window['start'], window['end']
+        scaled = np.clip((plane.astype(np.float32) - start) / max(end - start, 1e-6), 0, 1)
+        rgb += scaled[..., np.newaxis] * color
+    return (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+
+def resize_to_fit(image, max_size):
+    # nearest neighbour downscale so that the largest dimension fits max_size
+    scale = max(image.shape[:2]) / max_size
+    if scale <= 1:
+        return image
+    ys = (np.arange(int(image.shape[0] / scale)) * scale).astype(int)
+    xs = (np.arange(int(image.shape[1] / scale)) * scale).astype(int)
+    return image[ys][:, xs]
+
+
+def create_overview(source, output_folder, thumbnail_size=256, max_size=4096, gap=2, info=None):
+    # writes overview.png (wells placed in the plate grid), thumbnails/<well>.png and overview.json;
+    # the wells without image data are listed in empty_wells
+    dim_order = source.get_dim_order()
+    channels = source.get_channels()
+    nchannels = source.get_nchannels()
+    wells = source.get_wells() if source.is_screen() else [None]
+    # wells without any image data at the (first) time point are left blank, not read
+    occupancy = source.get_occupancy() if source.is_screen() else None
+    empty_wells = [well_id for welli, well_id in enumerate(wells)
+                   if occupancy is not None and not occupancy[0, welli].any()]
+    well_planes = {well_id: get_channel_planes(source.get_data(well_id), dim_order)
+                   for well_id in wells if well_id not in empty_wells}
+    if not well_planes:
+        raise ValueError(f'No image data in {source.uri}')
+
+    statistics = ChannelStatistics(source.get_dtype(), nchannels)
+    for planes in well_planes.values():
+        statistics.update(planes, channel_axis=0)
+    windows = [statistics.get_window(channeli) for channeli in range(nchannels)]
+    colors = [hex_to_rgb(channels[channeli].get('color') if channeli < len(channels) else None)
+              for channeli in range(nchannels)]
+    well_images = {well_id: render_rgb(planes, colors, windows) for well_id, planes in well_planes.items()}
+
+    os.makedirs(os.path.join(output_folder, 'thumbnails'), exist_ok=True)
+    index = {'name': source.get_name(), 'windows': windows, 'wells': {}, 'empty_wells': empty_wells}
+    index.update(info or {})
+    if source.is_screen():
+        rows, columns = source.get_rows(), source.get_columns()
+        celly = max(image.shape[0] for image in well_images.values()) + gap
+        cellx = max(image.shape[1] for image in well_images.values()) + gap
+        overview = np.zeros((len(rows) * celly, len(columns) * cellx, 3), dtype=np.uint8)
+        for well_id, image in well_images.items():
+            row, column = split_well_name(well_id)
+            y, x = rows.index(row) * celly, columns.index(column) * cellx
+            overview[y:y + image.shape[0], x:x + image.shape[1]] = image
+            thumbnail = resize_to_fit(image, thumbnail_size)
+            thumbnail_filename = os.path.join('thumbnails', f'{well_id}.png')
+            write_png(os.path.join(output_folder, thumbnail_filename), thumbnail)
+            index['wells'][well_id] = {'row': row, 'column': column, 'thumbnail': thumbnail_filename,
+                                       'region': [y, y + image.shape[0], x, x + image.shape[1]]}
+    else:
+        overview = well_images[None]
+    # well regions are in (coarsest level) pixels, before fitting the overview to max_size
+    index['overview'] = 'overview.png'
+    index['overview_scale'] = min(max_size / max(overview.shape[:2]), 1)
+    overview = resize_to_fit(overview, max_size)
+    write_png(os.path.join(output_folder, 'overview.png'), overview)
+    with open(os.path.join(output_folder, 'overview.json'), 'w') as file:
+        json.dump(index, file, indent=2)
+    return index
+
+
+def create_plate_overview(input_filename, output_folder, thumbnail_size=256, max_size=4096, time_point=None,
+                          verbose=False):
+    # db input: only the coarsest pyramid level of a single time point is read, level 0 is never assembled
+    with Timer(f'overview {input_filename}', verbose=verbose):
+        source = create_source(input_filename)
+        metadata = source.init_metadata()
+        info = {}
+        if 'levels' in metadata:
+            if time_point is None:
+                time_point = metadata['time_points'][0]
+            info = {'level': max(metadata['levels']), 'time_point': time_point}
+            source.close()
+            source = create_source(input_filename, selection={'level': info['level'],
+                                                              'time_points': (time_point, time_point)})
+            source.init_metadata()
+        with source:
+            index = create_overview(source, output_folder, thumbnail_size=thumbnail_size, max_size=max_size,
+                                    info=info)
+    logging.info(f'Overview of {input_filename} written to {output_folder}')
+    return index
@@ -0,0 +1,166 @@
+# Conversion plan (dry run): output size, peak memory and runtime estimates from the metadata and a sample of wells,
+# with the recommended number of workers (processes, see convert_parts) and memory budget
+
+import logging
+import numpy as np
+import os
+import time
+from ome_zarr.scale import Scaler
+
+from src.ome_zarr_util import create_blosc_compressor, iterate_blocks
+from src.util import print_hbytes
+
+
+def get_physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_compressor(output_format):
+    # the codecs used by the writers (see create_writer): None for uncompressed output
+    if 'ref' in output_format or 'tif' in output_format:
+        return None
+    if '3' in output_format:
+        from numcodecs import Zstd
+        return Zstd(level=0)    # zarr v3 default
+    return create_blosc_compressor()
+
+
+def sample_wells(wells, nsamples):
+    # spread over the plate
+    step = max(len(wells) // nsamples, 1)
+    return wells[::step][:nsamples]
+
+
+def read_samples(source, wells, field_indices, max_bytes):
+    # bounded (y, x) regions of a few fields, all other dimensions complete; the number of values per (y, x)
+    # position is read first from a single pixel
+    itemsize = np.dtype(source.get_dtype()).itemsize
+    probe = np.asarray(source.get_region(wells[0], field_indices[0], y=slice(0, 1), x=slice(0, 1)))
+    size = int(np.clip(np.sqrt(max_bytes / (probe.size * itemsize)), 16, 1024))
+    samples = []
+    seconds = 0
+    for well_id in wells:
+        for field_index in field_indices[:2]:
+            start = time.perf_counter()
+            samples.append(np.asarray(source.get_region(well_id, field_index, y=slice(0, size), x=slice(0, size))))
+            seconds += time.perf_counter() - start
+    return probe, samples, seconds
+
+
+def measure_encoding(compressor, samples, chunks):
+    nbytes = 0
+    compressed_size = 0
+    start = time.perf_counter()
+    for data in samples:
+        for region in iterate_blocks(data.shape, chunks):
+            chunk = np.ascontiguousarray(data[region])
+            nbytes += chunk.nbytes
+            compressed_size += len(compressor.encode(chunk))
+    return compressed_size / max(nbytes, 1), nbytes / max(time.perf_counter() - start, 1e-6)
+
+
+def create_plan(source, output_formats, writers, max_memory=None, nsamples=2, max_sample_bytes=16 * 1024 ** 2,
+                nworkers=None):
+    # nworkers: number of worker processes to estimate the runtime for (default: recommended)
+    scaler = Scaler()
+    # pyramid levels add 1/4 + 1/16 + ... of the full resolution size
+    pyramid_factor = sum(1 / scaler.downscale ** (2 * level) for level in range(scaler.max_layer + 1))
+    total_size = source.get_total_data_size()
+    field_indices = list(range(len(source.get_fields()))) if source.is_screen() else [None]
+    wells = source.get_wells() if source.is_screen() else [None]
+    occupancy = source.get_occupancy()
+    ntiles = int(np.sum(occupancy)) if occupancy is not None else None
+    dim_order = source.get_dim_order()
+    dtype = np.dtype(source.get_dtype())
+
+    # small regions only, within the memory budget: the plan should not need the memory of the conversion
+    if max_memory:
+        max_sample_bytes = min(max_sample_bytes, max_memory // 8)
+    probe, samples, read_seconds = read_samples(source, sample_wells(wells, nsamples), field_indices,
+                                                max_sample_bytes)
+    read_bytes = sum(data.nbytes for data in samples)
+    read_rate = read_bytes / max(read_seconds, 1e-6)
+    read_time = total_size / read_rate
+    # average field (and well) size from the data size; the field shape (y = x) from the values per pixel
+    field_size = total_size / (len(wells) * len(field_indices))
+    well_size = field_size * len(field_indices)
+    field_shape = list(probe.shape)
+    field_shape[dim_order.index('y')] = field_shape[dim_order.index('x')] = \
+        max(int(np.sqrt(field_size / (probe.size * dtype.itemsize))), 1)
+
+    ncpus = os.cpu_count() or 1
+    formats = {}
+    # the assembled well (cache) is shared by all formats
+    peak_memory = well_size if any(writer.reads_data for writer, _ in writers) else 0
+    encode_time = 0
+    for output_format, (writer, _) in zip(output_formats, writers):
+        compressor = get_compressor(output_format)
+        # field in memory (assembled in slabs beyond the memory budget), its pyramid and the blocks written
+        field_memory = field_size if not max_memory else min(field_size, max_memory)
+        block_size = 0
+        if hasattr(writer, '_get_chunk_shapes'):
+            chunks, blocks = writer._get_chunk_shapes(field_shape, dtype, source.get_tile_size())
+            block_size = int(np.prod(blocks)) * dtype.itemsize
+        else:
+            chunks = field_shape
+        if 'ref' in output_format:
+            # only metadata and tile references (~100 bytes each) are written; no pixel data is read
+            output_size = 100 * (ntiles or 0)
+            ratio, encode_rate, format_encode_time, memory = None, None, 0, 0
+        else:
+            if compressor is not None:
+                ratio, encode_rate = measure_encoding(compressor, samples, chunks)
+            else:
+                ratio, encode_rate = 1, None
+            if 'tif' in output_format:
+                output_size = total_size * ratio
+                memory = field_memory
+            else:
+                output_size = total_size * pyramid_factor * ratio
+                memory = field_memory * pyramid_factor + block_size * ncpus
+            # encoding runs in parallel threads on all cpus
+            format_encode_time = total_size * pyramid_factor / encode_rate / ncpus if encode_rate else 0
+        peak_memory += memory
+        encode_time += format_encode_time
+        formats[output_format] = {'output_size': print_hbytes(output_size),
+                                  'compression_ratio': round(ratio, 3) if ratio is not None else None,
+                                  'encode_rate': print_hbytes(encode_rate) + '/s' if encode_rate else None,
+                                  'encode_seconds': round(format_encode_time, 1),
+                                  'writer_memory': print_hbytes(memory)}
+
+    # workers: each converts a part of the wells in its own process
+    physical_memory = get_physical_memory()
+    recommended_workers = min(ncpus, len(wells))
+    if physical_memory:
+        recommended_workers = min(recommended_workers, int(physical_memory * 0.8 // max(peak_memory, 1)))
+    recommended_workers = max(recommended_workers, 1)
+    if nworkers is None:
+        nworkers = recommended_workers
+    # margin for python / library overhead
+    memory_budget = int(peak_memory * 1.5) + 256 * 1024 ** 2
+
+    plan = {
+        'input': source.uri,
+        'wells': len(wells) if source.is_screen() else None,
+        'fields': len(field_indices) if source.is_screen() else None,
+        'data_size': print_hbytes(total_size),
+        'sampled_bytes': print_hbytes(read_bytes),
+        'read_rate': print_hbytes(read_rate) + '/s',
+        'formats': formats,
+        'peak_memory': print_hbytes(peak_memory),
+        # several formats are written from a single read (fan-out)
+        'read_seconds': round(read_time, 1),
+        'encode_seconds': round(encode_time, 1),
+        'estimated_seconds': round(read_time + encode_time, 1),
+        'recommended_workers': recommended_workers,
+        'recommended_memory_per_worker': print_hbytes(memory_budget),
+        'recommended_memory': print_hbytes(memory_budget * recommended_workers),
+        'workers': nworkers,
+        # reads are sequential per worker, encoding already uses all cpus
+        'estimated_seconds_with_workers': round(read_time / nworkers + encode_time, 1),
+    }
+    logging.info(f'Plan: {plan}')
+    return plan
@@ -0,0 +1,64 @@
+# Planned bulk reads: byte ranges sorted by file offset, merged into large sequential reads,
+# with different files read concurrently
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import threading
+
+
+MAX_GAP = 256 * 1024                # read through gaps up to this size instead of seeking
+MAX_READ_SIZE = 64 * 1024 * 1024    # maximum size of a single merged read
+MAX_FILE_WORKERS = 8
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # shared thread pool for concurrent file reads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_FILE_WORKERS, thread_name_prefix='read')
+    return _executor
+
+
+def plan_reads(reads, max_gap=MAX_GAP, max_size=MAX_READ_SIZE):
+    # reads: (offset, size, key); returns [start, end, reads] runs of merged sequential reads in file order
+    runs = []
+    for read in sorted(reads, key=lambda read: read[0]):
+        offset, size, _ = read
+        if runs and offset - runs[-1][1] <= max_gap and max(runs[-1][1], offset + size) - runs[-1][0] <= max_size:
+            runs[-1][1] = max(runs[-1][1], offset + size)
+            runs[-1][2].append(read)
+        else:
+            runs.append([offset, offset + size, [read]])
+    return runs
+
+
+def read_runs(filename, runs, place):
+    with open(filename, 'rb') as fid:
+        for start, end, reads in runs:
+            fid.seek(start)
+            buffer = np.empty(end - start, dtype=np.uint8)
+            if fid.readinto(buffer) < len(buffer):
+                raise EOFError(f'Unexpected end of file reading {filename} at {start}-{end}')
+            view = memoryview(buffer)
+            for offset, size, key in reads:
+                place(key, view[offset - start:offset - start + size])
+
+
+def execute_reads(file_reads, place, concurrent=True, max_gap=MAX_GAP, max_size=MAX_READ_SIZE):
+    # file_reads: {filename: [(offset, size, key)]}; place(key, buffer) is called for each read
+    plans = [(filename, plan_reads(reads, max_gap=max_gap, max_size=max_size))
+             for filename, reads in file_reads.items() if reads]
+    if concurrent and len(plans) > 1:
+        # the last file is read in the calling thread
+        futures = [get_executor().submit(read_runs, filename, runs, place) for filename, runs in plans[:-1]]
+        read_runs(*plans[-1], place)
+        for future in futures:
+            future.result()
+    else:
+        for filename, runs in plans:
+            read_runs(filename, runs, place)
+    return sum(len(runs) for _, runs in plans)
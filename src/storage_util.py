@@ -0,0 +1,123 @@
+# Output storage: local paths or fsspec urls (s3://, gs://, ...)
+# https://zarr.readthedocs.io/en/stable/user-guide/storage.html#remote-store
+
+import asyncio
+import logging
+import os
+import shutil
+from zarr.storage import FsspecStore, WrapperStore
+
+
+def is_url(path):
+    path = str(path)
+    return '://' in path and not path.startswith('file://')
+
+
+def join_path(folder, filename):
+    if is_url(folder):
+        return str(folder).rstrip('/') + '/' + filename
+    return os.path.join(folder, filename)
+
+
+def create_store(path, storage_options=None, retries=None):
+    if is_url(path):
+        store = FsspecStore.from_url(path, storage_options=storage_options)
+        if retries:
+            store = RetryStore(store, retries=retries)
+    else:
+        store = str(path).removeprefix('file://')
+    return store
+
+
+def write_text(path, text, storage_options=None):
+    if is_url(path):
+        from fsspec.core import url_to_fs
+        fs, path = url_to_fs(str(path), **(storage_options or {}))
+        with fs.open(path, 'w') as file:
+            file.write(text)
+    else:
+        path = str(path).removeprefix('file://')
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(text)
+
+
+def read_text(path, storage_options=None):
+    if is_url(path):
+        from fsspec.core import url_to_fs
+        fs, path = url_to_fs(str(path), **(storage_options or {}))
+        with fs.open(path, 'r') as file:
+            return file.read()
+    with open(str(path).removeprefix('file://')) as file:
+        return file.read()
+
+
+def delete_path(path, storage_options=None):
+    if is_url(path):
+        from fsspec.core import url_to_fs
+        fs, path = url_to_fs(str(path), **(storage_options or {}))
+        if fs.exists(path):
+            fs.rm(path, recursive=True)
+    else:
+        shutil.rmtree(str(path).removeprefix('file://'), ignore_errors=True)
+
+
+def copy_output(source_path, target_path, recursive=True, storage_options=None):
+    if not is_url(source_path) and not is_url(target_path):
+        if recursive:
+            shutil.copytree(source_path, target_path, dirs_exist_ok=True)
+        else:
+            shutil.copy2(source_path, target_path)
+        return
+
+    from fsspec.core import url_to_fs
+
+    if not is_url(source_path):
+        target_fs, target = url_to_fs(str(target_path), **(storage_options or {}))
+        target_fs.put(str(source_path), target, recursive=recursive)
+    elif not is_url(target_path):
+        source_fs, source = url_to_fs(str(source_path), **(storage_options or {}))
+        source_fs.get(source, str(target_path), recursive=recursive)
+    else:
+        source_fs, source = url_to_fs(str(source_path), **(storage_options or {}))
+        target_fs, target = url_to_fs(str(target_path), **(storage_options or {}))
+        if type(source_fs) is not type(target_fs):
+            raise ValueError(f'Copying between different file systems is not supported: {source_path} {target_path}')
+        source_fs.copy(source, target, recursive=recursive)
+
+
+class RetryStore(WrapperStore):
+    # retries transient object storage errors with exponential backoff
+    no_retry_exceptions = (FileNotFoundError, PermissionError, IsADirectoryError, NotADirectoryError)
+
+    def __init__(self, store, retries=3, backoff=0.5):
+        super().__init__(store)
+        self.retries = retries
+        self.backoff = backoff
+
+    def _with_store(self, store):
+        return type(self)(store, retries=self.retries, backoff=self.backoff)
+
+    async def _retry(self, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return await func(*args)
+            except self.no_retry_exceptions:
+                raise
+            except (OSError, TimeoutError, ConnectionError) as error:
+                if attempt >= self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logging.warning(f'Storage error ({error!r}), retry {attempt + 1}/{self.retries} in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+    async def get(self, key, prototype, byte_range=None):
+        return await self._retry(self._store.get, key, prototype, byte_range)
+
+    async def set(self, key, value):
+        return await self._retry(self._store.set, key, value)
+
+    async def delete(self, key):
+        return await self._retry(self._store.delete, key)
@@ -0,0 +1,184 @@
+# Synthetic ImageXpress / CellReporterXpress style experiment generator
+# Writes experiment.db (sqlite metadata) and images-{t}.db (raw tile data) in the layout read by ImageDbSource
+
+from datetime import datetime
+import numpy as np
+import os
+import sqlite3
+
+from src.util import split_well_name
+
+
+DEFAULT_CHANNELS = [
+    {'Dye': 'DAPI', 'Emission': 470, 'Excitation': 387, 'Color': '1CA9C9'},
+    {'Dye': 'FITC', 'Emission': 525, 'Excitation': 485, 'Color': '00FF00'},
+    {'Dye': 'TRITC', 'Emission': 590, 'Excitation': 555, 'Color': 'FF0000'},
+    {'Dye': 'Cy5', 'Emission': 680, 'Excitation': 640, 'Color': 'FF00FF'},
+]
+
+
+def convert_datetime_to_dotnet_ticks(dt):
+    delta = dt - datetime(1, 1, 1)
+    return (delta.days * 86400 + delta.seconds) * 10 ** 7 + delta.microseconds * 10
+
+
+def create_well_names(nwells, nrows=16, ncols=24):
+    # fill a 384-well plate row by row, skipping the outer (edge) wells as is common in screens
+    well_names = []
+    for rowi in range(1, nrows - 1):
+        for col in range(2, ncols):
+            if len(well_names) < nwells:
+                well_names.append(f'{chr(ord("A") + rowi)}{col}')
+    return well_names
+
+
+def create_tile(shape, dtype, bits_per_pixel, seed):
+    # smooth background with bright blobs, roughly compressible like real microscopy data
+    rng = np.random.default_rng(seed)
+    sizey, sizex = shape
+    max_value = 2 ** bits_per_pixel - 1
+    y, x = np.mgrid[0:sizey, 0:sizex]
+    tile = np.full(shape, max_value * 0.05, dtype=np.float32)
+    for _ in range(8):
+        cy, cx = rng.uniform(0, sizey), rng.uniform(0, sizex)
+        radius = rng.uniform(0.03, 0.1) * max(sizey, sizex)
+        tile += max_value * 0.6 * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * radius ** 2))
+    tile += rng.normal(0, max_value * 0.01, shape)
+    return np.clip(tile, 0, max_value).astype(dtype)
+
+
+def create_image_db(folder, nwells=4, sites_x=2, sites_y=1, nchannels=2, ntime_points=1,
+                    bits_per_pixel=12, tile_size=256, nlevels=3, pixel_size=0.69, missing=None,
+                    name='Synthetic', seed=0):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    filename = os.path.join(folder, 'experiment.db')
+    if os.path.exists(filename):
+        os.remove(filename)
+    if missing is None:
+        missing = set()
+
+    nbytes = int(np.ceil(bits_per_pixel / 8))
+    if nbytes == 3:
+        nbytes = 4
+    dtype = np.dtype(f'uint{nbytes * 8}')
+    ticks = convert_datetime_to_dotnet_ticks(datetime(2024, 1, 1, 12))
+
+    conn = sqlite3.connect(filename)
+    conn.executescript('''
+        CREATE TABLE ExperimentBase (DateCreated INTEGER, Creator TEXT, Name TEXT);
+        CREATE TABLE AcquisitionExp (Name TEXT, Description TEXT, DateCreated INTEGER, DateModified INTEGER,
+                                     SensorSizeYPixels INTEGER, SensorSizeXPixels INTEGER, Objective REAL,
+                                     PixelSizeUm REAL, SensorBitness INTEGER);
+        CREATE TABLE AutomaticZonesParametersExp (SitesX INTEGER, SitesY INTEGER);
+        CREATE TABLE ImagechannelExp (ChannelNumber INTEGER, Emission INTEGER, Excitation INTEGER, Dye TEXT,
+                                      Color TEXT);
+        CREATE TABLE Well (Name TEXT, ZoneIndex INTEGER, CoordX INTEGER, CoordY INTEGER, HasImages INTEGER);
+        CREATE TABLE SourceImageBase (ZoneIndex INTEGER, level INTEGER, TimeSeriesElementId INTEGER,
+                                      ChannelId INTEGER, CoordX INTEGER, CoordY INTEGER, SizeX INTEGER,
+                                      SizeY INTEGER, ImageIndex INTEGER, BitsPerPixel INTEGER);
+    ''')
+    conn.execute('INSERT INTO ExperimentBase VALUES (?, ?, ?)', (ticks, 'Synthetic', name))
+    conn.execute('INSERT INTO AcquisitionExp VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (name, 'Synthetic test data', ticks, ticks, tile_size, tile_size, 10.0, pixel_size,
+                  bits_per_pixel))
+    conn.execute('INSERT INTO AutomaticZonesParametersExp VALUES (?, ?)', (sites_x, sites_y))
+    for channeli in range(nchannels):
+        channel = DEFAULT_CHANNELS[channeli % len(DEFAULT_CHANNELS)]
+        # duplicate channel entries also occur in real data
+        for _ in range(2):
+            conn.execute('INSERT INTO ImagechannelExp VALUES (?, ?, ?, ?, ?)',
+                         (channeli, channel['Emission'], channel['Excitation'], channel['Dye'], channel['Color']))
+
+    well_names = create_well_names(nwells)
+    zone_indices = {}
+    for well_name in well_names:
+        row, col = split_well_name(well_name, col_as_int=True)
+        rowi = ord(row) - ord('A')
+        zone_index = rowi * 24 + col
+        zone_indices[well_name] = zone_index
+        conn.execute('INSERT INTO Well VALUES (?, ?, ?, ?, ?)', (well_name, zone_index, col - 1, rowi, 1))
+
+    tile_cache = {}
+    for time_point in range(ntime_points):
+        image_filename = os.path.join(folder, f'images-{time_point}.db')
+        with open(image_filename, 'wb') as fid:
+            for welli, well_name in enumerate(well_names):
+                for channeli in range(nchannels):
+                    for site in range(sites_x * sites_y):
+                        if (time_point, well_name, site, channeli) in missing:
+                            continue
+                        xi, yi = site % sites_x, site // sites_x
+                        tile_key = (welli + time_point + site) % 7, channeli
+                        if tile_key not in tile_cache:
+                            tile_cache[tile_key] = create_tile((tile_size, tile_size), dtype, bits_per_pixel,
+                                                               seed + hash(tile_key) % 1000)
+                        tile = tile_cache[tile_key]
+                        for level in range(nlevels):
+                            scale = 2 ** level
+                            level_tile = tile[::scale, ::scale]
+                            sizey, sizex = level_tile.shape
+                            conn.execute('INSERT INTO SourceImageBase VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                         (zone_indices[well_name], level, time_point, channeli,
+                                          xi * sizex, yi * sizey, sizex, sizey, fid.tell(), bits_per_pixel))
+                            fid.write(np.ascontiguousarray(level_tile).tobytes())
+    conn.commit()
+    conn.close()
+    return filename
+
+
+def create_ome_tiff(filename, shape=(1, 2, 1, 512, 512), dtype='uint16', pixel_size=0.5, name='Synthetic',
+                    seed=0):
+    from tifffile import tifffile
+
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    dtype = np.dtype(dtype)
+    bits_per_pixel = dtype.itemsize * 8
+    data = np.zeros(shape, dtype=dtype)
+    for ti in range(shape[0]):
+        for ci in range(shape[1]):
+            for zi in range(shape[2]):
+                data[ti, ci, zi] = create_tile(shape[-2:], dtype, bits_per_pixel, seed + ti * 100 + ci * 10 + zi)
+    metadata = {'axes': 'TCZYX', 'Name': name,
+                'PhysicalSizeX': pixel_size, 'PhysicalSizeXUnit': 'µm',
+                'PhysicalSizeY': pixel_size, 'PhysicalSizeYUnit': 'µm'}
+    tifffile.imwrite(filename, data, ome=True, metadata=metadata, tile=(256, 256))
+    return filename
+
+
+def create_dataset(folder, nwells=4, sites_x=2, sites_y=1, nchannels=2, ntime_points=1, bits_per_pixel=12,
+                   tile_size=256, nlevels=3, pixel_size=0.69, name='Synthetic', seed=0):
+    # image db set plus an OME-TIFF with the dimensions of a single field
+    db_filename = create_image_db(folder, nwells=nwells, sites_x=sites_x, sites_y=sites_y, nchannels=nchannels,
+                                  ntime_points=ntime_points, bits_per_pixel=bits_per_pixel, tile_size=tile_size,
+                                  nlevels=nlevels, pixel_size=pixel_size, name=name, seed=seed)
+    nbytes = int(np.ceil(bits_per_pixel / 8))
+    if nbytes == 3:
+        nbytes = 4
+    tiff_filename = create_ome_tiff(os.path.join(folder, f'{name}.ome.tiff'),
+                                    shape=(ntime_points, nchannels, 1, tile_size, tile_size),
+                                    dtype=f'uint{nbytes * 8}', pixel_size=pixel_size, name=name, seed=seed)
+    return db_filename, tiff_filename
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Create synthetic experiment / image db and ome-tiff test data')
+    parser.add_argument('--outputfolder', required=True, help='output folder')
+    parser.add_argument('--wells', type=int, default=4)
+    parser.add_argument('--sitesx', type=int, default=2)
+    parser.add_argument('--sitesy', type=int, default=1)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--timepoints', type=int, default=1)
+    parser.add_argument('--bits', type=int, default=12, help='bits per pixel')
+    parser.add_argument('--tilesize', type=int, default=256)
+    parser.add_argument('--levels', type=int, default=3)
+    args = parser.parse_args()
+
+    for filename in create_dataset(args.outputfolder, nwells=args.wells, sites_x=args.sitesx, sites_y=args.sitesy,
+                                   nchannels=args.channels, ntime_points=args.timepoints,
+                                   bits_per_pixel=args.bits, tile_size=args.tilesize, nlevels=args.levels):
+        print(filename)
@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+import numpy as np
 import os
 import re
 
@@ -9,6 +10,19 @@ def ensure_list(item):
     return item
 
 
+def to_slice(value):
+    # None: all, int: single index (dimension kept)
+    if value is None:
+        return slice(None)
+    if isinstance(value, slice):
+        return value
+    return slice(int(value), int(value) + 1)
+
+
+def get_region_index(dim_order, **dim_values):
+    return tuple(to_slice(dim_values.get(dim)) for dim in dim_order)
+
+
 def get_filetitle(filename):
     return os.path.basename(os.path.splitext(filename)[0])
 
@@ -151,3 +165,101 @@ def print_hbytes(nbytes):
     else:
         e = f'e{exp * 3}'
     return f'{nbytes:.1f}{e}B'
+
+
+def parse_hbytes(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    exps = ['', 'K', 'M', 'G', 'T', 'P', 'E']
+    matches = re.findall(r'^\s*([\d.]+)\s*([A-Za-z]?)i?B?\s*$', value)
+    if not matches:
+        raise ValueError(f'Invalid size: {value}. Expected format like 512M, 4G, 1.5GB')
+    number, unit = matches[0]
+    return int(float(number) * 1024 ** exps.index(unit.upper()))
+
+
+def parse_int_list(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = [item for item in re.split(r'[,\s]+', value) if item]
+    return [int(item) for item in ensure_list(value)]
+
+
+def parse_range(value):
+    # '2' or '0-3' (inclusive) or (start, end)
+    if value is None:
+        return None
+    if isinstance(value, str):
+        parts = [int(part) for part in value.split('-')]
+    else:
+        parts = [int(part) for part in ensure_list(value)]
+    if len(parts) == 1:
+        parts = parts * 2
+    if len(parts) != 2 or parts[0] > parts[1]:
+        raise ValueError(f'Invalid range: {value}. Expected format like 2 or 0-3')
+    return parts
+
+
+def parse_selection(wells=None, fields=None, channels=None, time_points=None, level=None, crop=None):
+    # subset to convert: wells ('B2,B3'), fields / channels (indices '0,2'), time point range ('0-3'),
+    # pyramid level and x/y crop within each field ('x,y,width,height' in pixels)
+    selection = {}
+    if wells:
+        if isinstance(wells, str):
+            wells = [well for well in re.split(r'[,\s]+', wells) if well]
+        selection['wells'] = [strip_leading_zeros(well) for well in wells]
+    if fields is not None:
+        selection['fields'] = parse_int_list(fields)
+    if channels is not None:
+        selection['channels'] = parse_int_list(channels)
+    if time_points is not None:
+        selection['time_points'] = parse_range(time_points)
+    if level:
+        selection['level'] = int(level)
+    if crop is not None:
+        crop = parse_int_list(crop)
+        if len(crop) != 4 or crop[2] <= 0 or crop[3] <= 0:
+            raise ValueError(f'Invalid crop: {crop}. Expected x,y,width,height')
+        selection['crop'] = crop
+    return selection
+
+
+def parse_part(value):
+    # part of a distributed conversion: 'index/count' (e.g. 0/4) or (index, count)
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        matches = re.findall(r'^\s*(\d+)\s*/\s*(\d+)\s*$', value)
+        if not matches:
+            raise ValueError(f'Invalid part: {value}. Expected format like 0/4')
+        value = matches[0]
+    index, count = int(value[0]), int(value[1])
+    if not 0 <= index < count:
+        raise ValueError(f'Invalid part: {index}/{count}')
+    return index, count
+
+
+def get_slab_chunks(shape, dtype, max_size, tile_size=None):
+    # split an array (leading dimensions first, then y, then x) into blocks of at most max_size bytes
+    itemsize = np.dtype(dtype).itemsize
+    chunk = list(shape)
+    for dim in range(len(shape) - 2):
+        if np.prod(chunk) * itemsize > max_size:
+            chunk[dim] = 1
+    for dim in [-2, -1]:
+        other_size = int(np.prod(chunk)) // chunk[dim] * itemsize
+        if other_size * chunk[dim] > max_size:
+            size = max(max_size // other_size, 1)
+            if dim == -2 and tile_size and size >= tile_size:
+                size = size // tile_size * tile_size
+            chunk[dim] = min(size, shape[dim])
+    chunks = []
+    for size, chunk_size in zip(shape, chunk):
+        chunk_size = max(chunk_size, 1)
+        chunks.append(tuple([chunk_size] * (size // chunk_size) + ([size % chunk_size] if size % chunk_size else [])))
+    return tuple(chunks)
+
+
+def chunks_to_shape(chunks):
+    return tuple(max(dim_chunks) for dim_chunks in chunks)
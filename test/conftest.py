@@ -0,0 +1,19 @@
+import pytest
+
+from src.synthetic_data import create_dataset
+
+
+@pytest.fixture(scope='session')
+def synthetic_dataset(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('synthetic')
+    return create_dataset(str(folder), nwells=4, sites_x=2, sites_y=1, nchannels=2, ntime_points=2)
+
+
+@pytest.fixture(scope='session')
+def synthetic_db(synthetic_dataset):
+    return synthetic_dataset[0]
+
+
+@pytest.fixture(scope='session')
+def synthetic_tiff(synthetic_dataset):
+    return synthetic_dataset[1]
@@ -0,0 +1,95 @@
+# Performance benchmarks on synthetic data, compared against stored baselines; wall clock measurements depend on
+# the machine, so they only run with BENCHMARK=1
+# BENCHMARK_RESULTS: file the current results are written to (default in the temp folder); copy them to
+# benchmark_baselines.json to refresh the baselines
+# BENCHMARK_TOLERANCE sets the allowed relative regression (default 0.5)
+
+import json
+import os
+import pytest
+import tempfile
+import time
+
+from converter import convert
+from src.helper import create_source
+from src.synthetic_data import create_image_db
+from src.Timer import Timer, profiler
+
+
+BASELINES_FILENAME = os.path.join(os.path.dirname(__file__), 'benchmark_baselines.json')
+RESULTS_FILENAME = os.environ.get('BENCHMARK_RESULTS') or os.path.join(tempfile.gettempdir(), 'benchmark_results.json')
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', 0.5))
+ENABLED = os.environ.get('BENCHMARK', '').lower() in ('1', 'true', 'yes')
+
+pytestmark = pytest.mark.skipif(not ENABLED, reason='benchmarks run with BENCHMARK=1')
+
+DATASETS = {
+    'plate_small': {'nwells': 8, 'sites_x': 2, 'sites_y': 2, 'nchannels': 2, 'ntime_points': 1, 'tile_size': 256},
+    'plate_timeseries': {'nwells': 4, 'sites_x': 2, 'sites_y': 1, 'nchannels': 3, 'ntime_points': 4,
+                         'tile_size': 256},
+}
+
+
+def load_results(filename):
+    if os.path.exists(filename):
+        with open(filename) as file:
+            return json.load(file)
+    return {}
+
+
+def save_result(key, result):
+    results = load_results(RESULTS_FILENAME)
+    results[key] = result
+    with open(RESULTS_FILENAME, 'w') as file:
+        json.dump(dict(sorted(results.items())), file, indent=4)
+
+
+def check_regression(key, result):
+    save_result(key, result)
+    baseline = load_results(BASELINES_FILENAME).get(key)
+    if baseline is None:
+        return []
+    regressions = []
+    if result['init_seconds'] > baseline['init_seconds'] / (1 - TOLERANCE) + 0.01:
+        regressions.append(f"metadata init {result['init_seconds']:.3f}s > baseline {baseline['init_seconds']:.3f}s")
+    if result['mb_per_second'] < baseline['mb_per_second'] * (1 - TOLERANCE):
+        regressions.append(f"throughput {result['mb_per_second']:.1f}MB/s < baseline {baseline['mb_per_second']:.1f}MB/s")
+    if result['peak_memory_mb'] > baseline['peak_memory_mb'] * (1 + TOLERANCE):
+        regressions.append(f"peak memory {result['peak_memory_mb']:.1f}MB > baseline {baseline['peak_memory_mb']:.1f}MB")
+    return regressions
+
+
+@pytest.fixture(scope='module', params=list(DATASETS))
+def dataset(request, tmp_path_factory):
+    folder = tmp_path_factory.mktemp(request.param)
+    return request.param, create_image_db(str(folder), **DATASETS[request.param])
+
+
+@pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3', 'ometiff'])
+def test_benchmark(tmp_path, dataset, output_format):
+    dataset_name, input_filename = dataset
+
+    source = create_source(input_filename)
+    start = time.perf_counter()
+    source.init_metadata()
+    init_seconds = time.perf_counter() - start
+    total_size = source.get_total_data_size()
+    source.close()
+
+    profiler.enable(str(tmp_path / 'profile'), name='benchmark')
+    try:
+        with Timer(f'benchmark {dataset_name} {output_format}', verbose=False) as timer:
+            start = time.perf_counter()
+            convert(input_filename, str(tmp_path), output_format=output_format)
+            seconds = time.perf_counter() - start
+    finally:
+        profiler.disable()
+
+    result = {
+        'init_seconds': round(init_seconds, 4),
+        'mb_per_second': round(total_size / 1024 / 1024 / seconds, 2),
+        'peak_memory_mb': round(timer.span['peak_memory'] / 1024 / 1024, 2),
+    }
+    print(f'{dataset_name} {output_format}: {result}')
+    regressions = check_regression(f'{dataset_name}-{output_format}', result)
+    assert not regressions, f'{dataset_name} {output_format} regression: ' + ', '.join(regressions)
@@ -1,18 +1,32 @@
+import json
+import numpy as np
 from ome_zarr.io import parse_url
 from ome_zarr.reader import Reader
 import os
 import pytest
+import struct
 import tempfile
+import tifffile
+import zarr
+import zlib
 
-from converter import init_logging, convert
-from src.helper import create_source
+from converter import init_logging, convert, convert_parts
+from src.checksum_util import read_manifest, verify_output
+from src.helper import create_source, create_writer
+from src.ImageDbSource import ImageDbSource
+from src.overview_util import create_plate_overview
+from src.plan_util import create_plan
+from src.synthetic_data import create_image_db
+from src.TiffFolderSource import TiffFolderSource
 from src.Timer import Timer
-from src.util import print_dict
+from src.util import parse_hbytes, print_dict, split_well_name
 
 
 class TestConvert:
+    # set TEST_DATA_DIR to convert real data, otherwise synthetic data is generated
+    basedir = os.environ.get('TEST_DATA_DIR')
     #basedir = 'C:/Project/slides/DB/'
-    basedir = 'D:/slides/DB/'
+    #basedir = 'D:/slides/DB/'
     #basedir = 'C:/Project/slides/Ome-tiff/'
     #basedir = 'E:/Personal/Crick/slides/test_images/'
     #basedir = 'D:/slides/isyntax/'
@@ -29,21 +43,15 @@ class TestConvert:
     #filename = 'small.isyntax'
     #filename = 'test-isyntax.isyntax'
 
-    input_filename = basedir + filename
-
-    @pytest.mark.parametrize(
-        "input_filename, output_format",
-        [
-            (
-                input_filename,
-                'omezarr2',
-            ),
-            (
-                input_filename,
-                'omezarr3',
-            ),
-        ],
-    )
+    @pytest.fixture(params=['db', 'tiff'])
+    def input_filename(self, request):
+        if self.basedir:
+            if request.param != 'db':
+                pytest.skip('real test data only for db input')
+            return os.path.join(self.basedir, self.filename)
+        return request.getfixturevalue(f'synthetic_{request.param}')
+
+    @pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3'])
     def test_convert(self, tmp_path, input_filename, output_format, show_progess=True, verbose=True):
         init_logging('log/db_to_zarr.log', verbose=verbose)
         with Timer(f'convert {input_filename} to {output_format}'):
@@ -87,12 +95,423 @@ class TestConvert:
             if source.is_screen():
                 assert wells == source_wells
 
+    @pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3', 'ometiff'])
+    def test_convert_max_memory(self, tmp_path, synthetic_db, output_format):
+        # a budget below the size of a single field forces assembly and writing in slabs
+        convert(synthetic_db, tmp_path / 'full', output_format=output_format)
+        convert(synthetic_db, tmp_path / 'tiled', output_format=output_format, max_memory='100K')
+
+        source = create_source(synthetic_db)
+        source.init_metadata()
+        if output_format == 'ometiff':
+            name = source.get_name() + '.ome.tiff'
+            with tifffile.TiffFile(tmp_path / 'full' / name) as full, \
+                    tifffile.TiffFile(tmp_path / 'tiled' / name) as tiled:
+                assert len(tiled.series) == len(source.get_wells()) * len(source.get_fields())
+                for full_series, tiled_series in zip(full.series, tiled.series):
+                    assert tiled_series.pages[0].is_tiled
+                    assert np.array_equal(full_series.asarray(), tiled_series.asarray())
+            source.close()
+            return
+        name = source.get_name() + '.ome.zarr'
+        for well_id in source.get_wells():
+            row, col = split_well_name(well_id)
+            for field in source.get_fields():
+                path = f'{row}/{col}/{field}/0'
+                full = zarr.open(str(tmp_path / 'full' / name / path), mode='r')
+                tiled = zarr.open(str(tmp_path / 'tiled' / name / path), mode='r')
+                assert np.array_equal(full[:], tiled[:])
+        source.close()
+
+    @pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3'])
+    def test_consolidated_metadata(self, tmp_path, synthetic_db, output_format):
+        convert(synthetic_db, tmp_path, output_format=output_format)
+        source = create_source(synthetic_db)
+        source.init_metadata()
+        zarr_root = zarr.open_consolidated(str(tmp_path / (source.get_name() + '.ome.zarr')), mode='r')
+
+        metadata = zarr_root.metadata.consolidated_metadata.flattened_metadata
+        plate_index = zarr_root.attrs['plate_index']
+        assert len(plate_index['wells']) == len(source.get_wells())
+        for well_path, fields in plate_index['wells'].items():
+            assert list(fields) == source.get_fields()
+            for field, levels in fields.items():
+                for level in levels:
+                    array_path = f'{well_path}/{field}/{level["path"]}'
+                    assert list(metadata[array_path].shape) == level['shape']
+        source.close()
+
+    @pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3'])
+    def test_channel_windows(self, tmp_path, synthetic_db, output_format):
+        convert(synthetic_db, tmp_path, output_format=output_format)
+        source = create_source(synthetic_db)
+        source.init_metadata()
+        zarr_root = zarr.open_group(str(tmp_path / (source.get_name() + '.ome.zarr')), mode='r')
+        channels = zarr_root.attrs['omero']['channels']
+
+        data = np.concatenate([zarr_root[f'{"/".join(split_well_name(well_id))}/{field}/0'][:]
+                               for well_id in source.get_wells() for field in source.get_fields()], axis=0)
+        for channeli, channel in enumerate(channels):
+            window = channel['window']
+            channel_data = data[:, channeli]
+            assert window['min'] == channel_data.min()
+            assert window['max'] == channel_data.max()
+            assert window['min'] <= window['start'] < window['end'] <= window['max']
+            assert window['end'] < 2 ** 12
+        source.close()
+
+    def test_convert_empty_field(self, tmp_path, monkeypatch):
+        # field 1 of well B3 is not imaged at all: it is not read, and stored empty
+        missing = {(t, 'B3', 1, c) for t in range(2) for c in range(2)}
+        input_filename = create_image_db(str(tmp_path / 'input'), nwells=2, sites_x=2, nchannels=2, ntime_points=2,
+                                         missing=missing)
+        reads = []
+        get_data = ImageDbSource.get_data
+        monkeypatch.setattr(ImageDbSource, 'get_data', lambda source, well_id=None, field_id=None:
+                            reads.append((well_id, field_id)) or get_data(source, well_id, field_id))
+        convert(input_filename, tmp_path, output_format='omezarr2,ometiff')
+        assert sorted(reads) == [('B2', 0), ('B2', 1), ('B3', 0)]
+
+        zarr_root = zarr.open_group(str(tmp_path / 'Synthetic.ome.zarr'), mode='r')
+        assert not np.any(zarr_root['B/3/1/0'][:])
+        assert zarr_root['B/3/1/0'].shape == zarr_root['B/3/0/0'].shape
+        assert sorted((plane['well'], plane['field']) for plane in zarr_root.attrs['plate_index']['missing']) == \
+               [('B/3', '1')] * 4
+        with tifffile.TiffFile(tmp_path / 'Synthetic.ome.tiff') as tif:
+            assert len(tif.series) == 4
+            assert not np.any(tif.series[3].asarray())
+
+    @pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3'])
+    def test_convert_sparse(self, tmp_path, output_format):
+        # time point 1 of well B3 site 1 channel 0 and all of well B2 channel 1 at time point 0 are not imaged
+        missing = {(1, 'B3', 1, 0), (0, 'B2', 0, 1), (0, 'B2', 1, 1)}
+        input_filename = create_image_db(str(tmp_path / 'input'), nwells=2, sites_x=2, nchannels=2, ntime_points=2,
+                                         missing=missing)
+        convert(input_filename, tmp_path, output_format=output_format)
+        zarr_root = zarr.open_group(str(tmp_path / 'Synthetic.ome.zarr'), mode='r')
+
+        missing_planes = zarr_root.attrs['plate_index']['missing']
+        assert sorted((plane['well'], plane['field'], plane['t'], plane['c']) for plane in missing_planes) == \
+               [('B/2', '0', 0, 1), ('B/2', '1', 0, 1), ('B/3', '1', 1, 0)]
+        for plane in missing_planes:
+            array = zarr_root[f'{plane["well"]}/{plane["field"]}/0']
+            assert not np.any(array[plane['t'], plane['c']])
+            # nothing is stored for missing planes
+            chunk_path = f'{plane["t"]}/{plane["c"]}' if output_format == 'omezarr2' else f'c/{plane["t"]}/{plane["c"]}'
+            assert not os.path.exists(tmp_path / 'Synthetic.ome.zarr' / array.path / chunk_path)
+        assert np.all(np.any(zarr_root['B/3/0/0'][:], axis=(2, 3, 4)))
+
+    @pytest.mark.parametrize('max_memory', [None, '100K'])
+    def test_convert_fused(self, tmp_path, synthetic_db, max_memory):
+        convert(synthetic_db, tmp_path / 'fields', output_format='omezarr3')
+        convert(synthetic_db, tmp_path / 'fused', output_format='omezarr3', fuse_fields=True, max_memory=max_memory)
+        fields = zarr.open_group(str(tmp_path / 'fields' / 'Synthetic.ome.zarr'), mode='r')
+        fused = zarr.open_group(str(tmp_path / 'fused' / 'Synthetic.ome.zarr'), mode='r')
+
+        # synthetic plate: 2 x 1 sites of 256 x 256 pixel tiles
+        for well in fields.attrs['ome']['plate']['wells']:
+            assert list(fused[well['path']].group_keys()) == ['0']
+            mosaic = fused[well['path'] + '/0/0']
+            assert mosaic.chunks[-2:] == (256, 256)
+            expected = np.concatenate([fields[well['path'] + f'/{field}/0'][:] for field in range(2)], axis=-1)
+            assert np.array_equal(mosaic[:], expected)
+        assert fused.attrs['ome']['plate']['field_count'] == 1
+
+    @pytest.mark.parametrize('max_memory', [None, '100K'])
+    def test_convert_subset(self, tmp_path, synthetic_db, max_memory):
+        convert(synthetic_db, tmp_path / 'full', output_format='omezarr3')
+        selection = {'wells': 'B3', 'fields': '1', 'channels': '1', 'time_points': '1-1', 'crop': '10,20,100,50'}
+        convert(synthetic_db, tmp_path / 'subset', output_format='omezarr3', selection=selection,
+                max_memory=max_memory)
+        full = zarr.open_group(str(tmp_path / 'full' / 'Synthetic.ome.zarr'), mode='r')
+        subset = zarr.open_group(str(tmp_path / 'subset' / 'Synthetic.ome.zarr'), mode='r')
+
+        assert [well['path'] for well in subset.attrs['ome']['plate']['wells']] == ['B/3']
+        assert list(subset['B/3'].group_keys()) == ['1']
+        assert len(subset.attrs['omero']['channels']) == 1
+        expected = full['B/3/1/0'][1:2, 1:2, :, 20:70, 10:110]
+        assert np.array_equal(subset['B/3/1/0'][:], expected)
+
+        source = create_source(synthetic_db, selection={'wells': ['B3'], 'channels': [1], 'time_points': [1, 1]})
+        source.init_metadata()
+        # selection is applied in the query: only tiles of the selected channel and time point
+        well_info = source._read_well_info('B3')
+        assert {(info['ChannelId'], info['TimeSeriesElementId']) for info in well_info} == {(1, 1)}
+        source.close()
+
+    def test_convert_level(self, tmp_path, synthetic_db):
+        convert(synthetic_db, tmp_path / 'full', output_format='omezarr2')
+        convert(synthetic_db, tmp_path / 'level', output_format='omezarr2', selection={'level': 1})
+        full = Reader(parse_url(str(tmp_path / 'full' / 'Synthetic.ome.zarr' / 'B' / '2' / '0')))
+        level = Reader(parse_url(str(tmp_path / 'level' / 'Synthetic.ome.zarr' / 'B' / '2' / '0')))
+        full_node, level_node = list(full())[0], list(level())[0]
+        assert level_node.data[0].shape[-2:] == tuple(size // 2 for size in full_node.data[0].shape[-2:])
+        full_scale = full_node.metadata['coordinateTransformations'][0][0]['scale']
+        level_scale = level_node.metadata['coordinateTransformations'][0][0]['scale']
+        assert level_scale[-2:] == [scale * 2 for scale in full_scale[-2:]]
+
+    @pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3'])
+    def test_convert_checksums(self, tmp_path, output_format):
+        input_filename = create_image_db(str(tmp_path / 'input'), nwells=2, sites_x=2, nchannels=2, ntime_points=2)
+        convert(input_filename, tmp_path, output_format=output_format, checksums=True)
+        output_path = str(tmp_path / 'Synthetic.ome.zarr')
+        manifest = read_manifest(output_path)
+        assert len(manifest['arrays']) == 2 * 2 * 5
+        # all source tiles: wells x sites x channels x time points
+        assert sum(len(tiles) for tiles in manifest['source_tiles'].values()) == 2 * 2 * 2 * 2
+
+        result = verify_output(output_path, source_folder=str(tmp_path / 'input'), nsamples=None)
+        assert result['valid'] and result['source_tiles'] == 16
+
+        # corrupt a single chunk in the output
+        array = zarr.open_array(output_path + '/B/3/1/0', mode='r+')
+        array[1, 0, 0, 0, 0] += 1
+        result = verify_output(output_path, nsamples=None)
+        assert not result['valid']
+        assert any('B/3/1/0 chunk 1/0/0/0/0' in error for error in result['errors'])
+        assert any('output does not match source' in error for error in result['errors'])
+
+        # change a source file
+        tile = manifest['source_tiles']['B/2/0'][0]
+        with open(tmp_path / 'input' / tile['file'], 'r+b') as file:
+            file.seek(tile['offset'])
+            file.write(b'\xff\xff')
+        result = verify_output(output_path, source_folder=str(tmp_path / 'input'), nsamples=None)
+        assert any('source file' in error for error in result['errors'])
+
+
+def test_plate_overview(tmp_path, synthetic_db):
+    index = create_plate_overview(synthetic_db, str(tmp_path))
+    assert index['level'] == 2
+    assert sorted(index['wells']) == ['B2', 'B3', 'B4', 'B5']
+    with open(tmp_path / 'overview.png', 'rb') as file:
+        content = file.read()
+    assert content.startswith(b'\x89PNG')
+    width, height = struct.unpack('>II', content[16:24])
+    # coarsest level (1/4 scale) wells of 2 x 1 fields of 256 pixels, in one plate row
+    assert (height, width) == (64 + 2, 4 * (128 + 2))
+    idat = content.index(b'IDAT')
+    length = struct.unpack('>I', content[idat - 4:idat])[0]
+    rows = np.frombuffer(zlib.decompress(content[idat + 4:idat + 4 + length]), dtype=np.uint8)
+    assert rows.reshape(height, 1 + width * 3)[:, 1:].max() > 0
+    for well in index['wells'].values():
+        assert os.path.exists(tmp_path / well['thumbnail'])
+
+
+def test_plate_overview_partial(tmp_path):
+    # well B2 is not imaged at the first time point: left blank
+    missing = {(0, 'B2', site, channel) for site in range(2) for channel in range(2)}
+    input_filename = create_image_db(str(tmp_path / 'input'), nwells=3, sites_x=2, nchannels=2, ntime_points=2,
+                                     missing=missing)
+    index = create_plate_overview(input_filename, str(tmp_path / 'overview'))
+    assert index['empty_wells'] == ['B2']
+    assert sorted(index['wells']) == ['B3', 'B4']
+    # the second time point of B2 is imaged
+    index = create_plate_overview(input_filename, str(tmp_path / 'overview1'), time_point=1)
+    assert index['empty_wells'] == []
+    assert sorted(index['wells']) == ['B2', 'B3', 'B4']
+
+
+def test_convert_virtual(tmp_path, synthetic_db):
+    result = json.loads(convert(synthetic_db, str(tmp_path), output_format='omezarr_ref'))[0]
+    output_path = result['full_path']
+    assert output_path.endswith('.ome.zarr.json')
+    zarr_root = zarr.open_group('reference://', storage_options={'fo': output_path}, mode='r')
+    assert 'plate' in zarr_root.attrs
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    for well_id in source.get_wells():
+        row, col = split_well_name(well_id)
+        for field_index, field in enumerate(source.get_fields()):
+            image_group = zarr_root[f'{row}/{col}/{field}']
+            assert len(image_group.attrs['multiscales'][0]['datasets']) == 3
+            assert np.array_equal(image_group['0'][:], source.get_data(well_id, field_index))
+            assert np.array_equal(image_group['2'][:], source.get_region(well_id, field_index, level=2))
+    source.close()
+
+
+@pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3'])
+def test_convert_parts(tmp_path, synthetic_db, output_format):
+    # distributed conversion (local processes) gives the same plate as a single conversion
+    convert(synthetic_db, str(tmp_path / 'single'), output_format=output_format)
+    with pytest.raises(ValueError):
+        convert(synthetic_db, str(tmp_path / 'parts'), output_format=output_format, part='2/2')
+    convert(synthetic_db, str(tmp_path / 'parts'), output_format=output_format, part='0/2')
+    with pytest.raises(ValueError):
+        # part 1/2 missing
+        convert(synthetic_db, str(tmp_path / 'parts'), output_format=output_format, finalize=True)
+    result = json.loads(convert_parts(synthetic_db, str(tmp_path / 'parts'), 2, output_format=output_format,
+                                      checksums=True))[0]
+    output_path = result['full_path']
+    assert not os.path.exists(output_path + '.parts')
+    single = zarr.open_group(str(tmp_path / 'single' / 'Synthetic.ome.zarr'), mode='r')
+    parts = zarr.open_group(output_path, mode='r')
+    assert parts.attrs.asdict() == single.attrs.asdict()
+    assert parts.attrs['plate_index']['total_size'] > 0
+    for well in single.attrs.get('ome', single.attrs)['plate']['wells']:
+        for field in ['0', '1']:
+            for level in ['0', '2']:
+                path = f'{well["path"]}/{field}/{level}'
+                assert np.array_equal(parts[path][:], single[path][:])
+    assert verify_output(output_path, nsamples=None)['valid']
+
+
+def test_convert_parts_fresh(tmp_path, synthetic_db):
+    # parts started at the same time on a new output folder
+    for run in range(3):
+        output_folder = str(tmp_path / f'parts{run}')
+        result = json.loads(convert_parts(synthetic_db, output_folder, 4, output_format='omezarr2'))[0]
+        parts = zarr.open_group(result['full_path'], mode='r')
+        assert len(parts.attrs['plate_index']['wells']) == 4
+    with pytest.raises(ValueError, match='not'):
+        convert(synthetic_db, str(tmp_path / 'empty'), output_format='omezarr2', finalize=True)
+
+
+def test_convert_fan_out(tmp_path, synthetic_db):
+    results = json.loads(convert(synthetic_db, str(tmp_path), output_format='omezarr2,ometiff,omezarr_ref'))
+    assert [os.path.basename(result['full_path']) for result in results] == \
+           ['Synthetic.ome.zarr', 'Synthetic.ome.tiff', 'Synthetic.ome.zarr.json']
+    zarr_root = zarr.open_group(results[0]['full_path'], mode='r')
+    with tifffile.TiffFile(results[1]['full_path']) as tif:
+        series = tif.series
+        assert len(series) == 4 * 2
+        index = 0
+        for well in zarr_root.attrs['plate']['wells']:
+            for field in ['0', '1']:
+                # tiff series are squeezed
+                assert np.array_equal(series[index].asarray(), np.squeeze(zarr_root[f'{well["path"]}/{field}/0']))
+                index += 1
+
+
+def test_convert_progressive(tmp_path, synthetic_db):
+    convert(synthetic_db, str(tmp_path / 'regular'), output_format='omezarr3')
+    convert(synthetic_db, str(tmp_path / 'progressive'), output_format='omezarr3', progressive=True)
+    regular = zarr.open_group(str(tmp_path / 'regular' / 'Synthetic.ome.zarr'), mode='r')
+    progressive = zarr.open_group(str(tmp_path / 'progressive' / 'Synthetic.ome.zarr'), mode='r')
+    # the complete output is the same
+    assert progressive.attrs.asdict() == regular.attrs.asdict()
+    for path, array in regular.arrays():
+        assert np.array_equal(progressive[path][:], array[:])
+
+    # preview: plate metadata and the coarsest level of each field, from the stored source levels
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    writer = create_writer('omezarr3')[0]
+    zarr_root = writer._open_root(str(tmp_path / 'preview.ome.zarr'))
+    writer._write_screen_preview(zarr_root, source, name='preview')
+    source.close()
+    preview = zarr.open_group(str(tmp_path / 'preview.ome.zarr'), mode='r')
+    assert len(preview.attrs['ome']['plate']['wells']) == 4
+    assert 'plate_index' not in preview.attrs
+    for well in preview.attrs['ome']['plate']['wells']:
+        for field in ['0', '1']:
+            group = preview[f'{well["path"]}/{field}']
+            assert [dataset['path'] for dataset in group.attrs['ome']['multiscales'][0]['datasets']] == ['4']
+            full = regular[f'{well["path"]}/{field}/4']
+            assert group['4'].shape == full.shape
+            assert abs(float(np.mean(group['4'][:])) - float(np.mean(full[:]))) < 0.1 * float(np.mean(full[:]))
+
+
+def test_convert_plan(tmp_path, synthetic_db):
+    plan = json.loads(convert(synthetic_db, str(tmp_path / 'output'), output_format='omezarr2,omezarr3,omezarr_ref',
+                              plan=True))
+    # dry run: nothing is written
+    assert not os.path.exists(tmp_path / 'output')
+    assert plan['wells'] == 4 and plan['fields'] == 2
+    assert list(plan['formats']) == ['omezarr2', 'omezarr3', 'omezarr_ref']
+    for format1 in ['omezarr2', 'omezarr3']:
+        assert 0 < plan['formats'][format1]['compression_ratio'] <= 1.1
+    assert plan['recommended_workers'] >= 1
+    assert parse_hbytes(plan['recommended_memory_per_worker']) > parse_hbytes(plan['peak_memory'])
+
+    convert(synthetic_db, str(tmp_path / 'output'), output_format='omezarr2')
+    output_size = sum(os.path.getsize(os.path.join(folder, filename))
+                      for folder, _, filenames in os.walk(tmp_path / 'output') for filename in filenames)
+    # estimate within a factor 2 of the output written
+    assert output_size / 2 < parse_hbytes(plan['formats']['omezarr2']['output_size']) < output_size * 2
+
+
+def test_plan_workers(synthetic_db, monkeypatch):
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    writers = [create_writer('omezarr2')]
+    max_memory = 1024 ** 2
+    plans = {nworkers: create_plan(source, ['omezarr2'], writers, max_memory=max_memory, nworkers=nworkers)
+             for nworkers in [1, 4]}
+    for nworkers, plan in plans.items():
+        # sampled regions within the memory budget
+        assert parse_hbytes(plan['sampled_bytes']) <= 4 * max_memory // 8
+        # only the reads are divided over the workers, encoding already runs on all cpus
+        assert plan['estimated_seconds_with_workers'] == \
+               pytest.approx(plan['read_seconds'] / nworkers + plan['encode_seconds'], abs=0.1)
+    assert plans[1]['estimated_seconds_with_workers'] == pytest.approx(plans[1]['estimated_seconds'], abs=0.1)
+
+    # no memory for more than one worker
+    monkeypatch.setattr('src.plan_util.get_physical_memory', lambda: 1)
+    assert create_plan(source, ['omezarr2'], writers)['recommended_workers'] == 1
+    source.close()
+
+
+def test_convert_tiff_folder(tmp_path, synthetic_db, monkeypatch):
+    # Operetta style file names, one tiff per plane; one plane is not imaged
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    folder = tmp_path / 'Folder'
+    folder.mkdir()
+    expected = {}
+    for well_id in source.get_wells():
+        row, col = split_well_name(well_id)
+        for field in range(2):
+            data = source.get_data(well_id, field)
+            expected[f'{row}/{col}/{field}'] = data.copy()
+            for t, c in np.ndindex(data.shape[:2]):
+                if (well_id, field, t, c) == (source.get_wells()[1], 1, 0, 0):
+                    expected[f'{row}/{col}/{field}'][t, c] = 0
+                    continue
+                filename = f'r{ord(row) - ord("A") + 1:02}c{int(col):02}f{field + 1:02}p01-ch{c + 1}sk{t + 1}fk1fl1.tiff'
+                tifffile.imwrite(folder / filename, data[t, c, 0])
+    source.close()
+
+    # no stored pyramid levels: no preview, each field is read once
+    reads = []
+    get_data = TiffFolderSource.get_data
+    monkeypatch.setattr(TiffFolderSource, 'get_data', lambda source, well_id=None, field_id=None:
+                        reads.append((well_id, field_id)) or get_data(source, well_id, field_id))
+    convert(str(folder), str(tmp_path), output_format='omezarr2', progressive=True)
+    assert len(reads) == len(expected)
+    zarr_root = zarr.open_group(str(tmp_path / 'Folder.ome.zarr'), mode='r')
+    assert len(zarr_root.attrs['plate']['wells']) == 4
+    for path, data in expected.items():
+        assert np.array_equal(zarr_root[f'{path}/0'][:], data)
+    assert [(plane['field'], plane['t'], plane['c']) for plane in zarr_root.attrs['plate_index']['missing']] == \
+           [('1', 0, 0)]
+
+    # ImageXpress style file names, time points in sub folders
+    folder = tmp_path / 'Xpress'
+    for t in [1, 2]:
+        (folder / f'TimePoint_{t}').mkdir(parents=True)
+        for well in ['B02', 'C10']:
+            for site in [1, 2, 3]:
+                tifffile.imwrite(folder / f'TimePoint_{t}' / f'plate_{well}_s{site}_w1.tif',
+                                 np.full((32, 48), t, dtype=np.uint16))
+    with create_source(str(folder)) as source:
+        source.init_metadata()
+        assert source.get_wells() == ['B2', 'C10']
+        assert source.get_fields() == ['0', '1', '2'] and source.get_nchannels() == 1
+        assert source.get_time_points() == [1, 2]
+        assert source.get_data('C10', 2).shape == (2, 1, 1, 32, 48)
+        assert source.get_data('C10', 2)[1].min() == 2
+
 
 if __name__ == '__main__':
     # Emulate pytest / fixtures
     from pathlib import Path
+    from src.synthetic_data import create_dataset
 
     test = TestConvert()
-    input_filename = test.input_filename
+    if test.basedir:
+        input_filename = os.path.join(test.basedir, test.filename)
+    else:
+        input_filename = create_dataset(tempfile.TemporaryDirectory().name)[0]
     test.test_convert(Path(tempfile.TemporaryDirectory().name), input_filename, 'omezarr2')
     test.test_convert(Path(tempfile.TemporaryDirectory().name), input_filename, 'omezarr3')
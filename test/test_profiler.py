@@ -0,0 +1,45 @@
+import json
+import os
+
+from converter import convert_parts
+from src.Timer import Timer, profiler, read_trace
+
+
+def test_profiler_spans(tmp_path):
+    profile_folder = str(tmp_path / 'profile')
+    profiler.enable(profile_folder, name='test')
+    with Timer('outer', verbose=False):
+        with Timer('inner', verbose=False, category='field', args={'field': 0}):
+            data = bytearray(1024 * 1024)
+        del data
+    # streamed trace (json array, not terminated) readable while profiling
+    events = read_trace(profiler.trace_filename)
+    assert [event['name'] for event in events if event['ph'] == 'X'] == ['inner', 'outer']
+    trace_filename = profiler.disable()
+    assert trace_filename == os.path.join(profile_folder, 'test.trace.json')
+    assert os.listdir(profile_folder) == ['test.trace.json']
+
+    with open(trace_filename) as file:
+        trace = json.load(file)
+    spans = {event['name']: event for event in trace['traceEvents'] if event['ph'] == 'X'}
+    inner, outer = spans['inner'], spans['outer']
+    # nested in time, on the same thread
+    assert outer['ts'] <= inner['ts'] and inner['ts'] + inner['dur'] <= outer['ts'] + outer['dur']
+    assert inner['tid'] == outer['tid'] and inner['cat'] == 'field' and inner['args']['field'] == 0
+    # peak memory of the inner span is included in the outer span
+    assert inner['args']['peak_memory'] >= 1024 * 1024
+    assert outer['args']['peak_memory'] >= inner['args']['peak_memory']
+    assert any(event['ph'] == 'M' and event['name'] == 'process_name' for event in trace['traceEvents'])
+
+
+def test_profiler_processes(tmp_path, synthetic_db):
+    # parts converted in separate processes: a single trace with the spans of all processes
+    profile_folder = str(tmp_path / 'profile')
+    convert_parts(synthetic_db, str(tmp_path / 'output'), 2, output_format='omezarr2', profile_folder=profile_folder)
+    assert os.listdir(profile_folder) == ['convert.trace.json']
+    with open(os.path.join(profile_folder, 'convert.trace.json')) as file:
+        events = json.load(file)['traceEvents']
+    well_pids = {event['pid'] for event in events if event['ph'] == 'X' and event['cat'] == 'well'}
+    assert well_pids and os.getpid() not in well_pids
+    assert len([event for event in events if event['ph'] == 'X' and event['cat'] == 'well']) == 4
+    assert any(event['name'] == 'convert 2 parts' and event['pid'] == os.getpid() for event in events)
@@ -0,0 +1,125 @@
+import json
+import multiprocessing
+import os
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from src.ConversionServer import ConversionServer, ConversionWorker
+from src.synthetic_data import create_image_db
+
+
+def request(server, method, path, params=None):
+    data = json.dumps(params).encode() if params is not None else None
+    req = urllib.request.Request(server.address + path, data=data, method=method)
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def wait_job(server, job_id, timeout=120):
+    start = time.time()
+    while time.time() - start < timeout:
+        status, job = request(server, 'GET', f'/jobs/{job_id}')
+        if job['status'] in ConversionServer.finished_states:
+            return job
+        time.sleep(0.2)
+    raise TimeoutError(f'Job {job_id} not finished')
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    log_filename = str(tmp_path_factory.mktemp('server') / 'server.log')
+    server = ConversionServer(port=0, nworkers=1, log_filename=log_filename)
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_server_jobs(server, synthetic_db, tmp_path):
+    params = {'input_filename': synthetic_db, 'output_folder': str(tmp_path), 'output_format': 'omezarr2'}
+    status, job = request(server, 'POST', '/jobs', params)
+    assert status == 202
+    assert job['status'] == 'queued'
+    # second job queued behind the first, cancelled before it runs
+    status, job2 = request(server, 'POST', '/jobs', dict(params, output_folder=str(tmp_path / 'cancelled')))
+    status, cancelled = request(server, 'DELETE', f'/jobs/{job2["id"]}')
+    assert status == 200
+    assert cancelled['status'] == 'cancelled'
+
+    job = wait_job(server, job['id'])
+    assert job['status'] == 'done', job['error']
+    assert os.path.exists(job['result'][0]['full_path'])
+    assert not os.path.exists(tmp_path / 'cancelled')
+    # finished jobs can not be cancelled
+    status, _ = request(server, 'DELETE', f'/jobs/{job["id"]}')
+    assert status == 409
+
+    # the warm worker is reused for the next job
+    status, job3 = request(server, 'POST', '/jobs', dict(params, output_format='omezarr3'))
+    assert wait_job(server, job3['id'])['status'] == 'done'
+    status, jobs = request(server, 'GET', '/jobs')
+    assert [job['status'] for job in jobs] == ['done', 'cancelled', 'done']
+
+
+def test_server_errors(server, tmp_path):
+    status, response = request(server, 'POST', '/jobs', {'input_filename': 'x', 'unknown': 1})
+    assert status == 400
+    status, _ = request(server, 'GET', '/jobs/unknown')
+    assert status == 404
+    status, job = request(server, 'POST', '/jobs', {'input_filename': str(tmp_path / 'missing.db'),
+                                                    'output_folder': str(tmp_path)})
+    job = wait_job(server, job['id'])
+    assert job['status'] == 'failed'
+    assert job['error']
+
+
+def test_server_cancel_running(server, synthetic_db, tmp_path):
+    # a job long enough to be cancelled while it writes its output
+    input_filename = create_image_db(str(tmp_path / 'input'), nwells=8, sites_x=2, sites_y=2, nchannels=2,
+                                     ntime_points=4, tile_size=512)
+    status, job = request(server, 'POST', '/jobs', {'input_filename': input_filename,
+                                                    'output_folder': str(tmp_path / 'long'),
+                                                    'output_format': 'omezarr3'})
+    pid = server.workers[0].process.pid
+    start = time.time()
+    while not os.path.exists(tmp_path / 'long' / 'Synthetic.ome.zarr'):
+        assert time.time() - start < 60
+        time.sleep(0.05)
+    status, cancelling = request(server, 'DELETE', f'/jobs/{job["id"]}')
+    assert status == 200
+    assert cancelling['status'] in ('cancelling', 'cancelled')
+    assert wait_job(server, job['id'])['status'] == 'cancelled'
+
+    # the worker is restarted, and runs the next job
+    status, job2 = request(server, 'POST', '/jobs', {'input_filename': synthetic_db,
+                                                     'output_folder': str(tmp_path / 'next'),
+                                                     'output_format': 'omezarr2'})
+    job2 = wait_job(server, job2['id'])
+    assert job2['status'] == 'done', job2['error']
+    assert os.path.exists(job2['result'][0]['full_path'])
+    assert server.workers[0].process.pid != pid
+
+
+def test_worker_preload(synthetic_db, tmp_path):
+    # the first job of a (re)started worker imports no sources, writers or their libraries
+    log_filename = str(tmp_path / 'worker.log')
+    worker = ConversionWorker(multiprocessing.get_context('spawn'), log_filename)
+    assert worker.conn.poll(60)
+    status, preloaded = worker.conn.recv()
+    assert status == 'ready'
+    assert {'zarr', 'ome_zarr', 'src.OmeZarrWriter', 'src.OmeTiffWriter', 'src.ImageDbSource'} <= set(preloaded)
+    worker.conn.send({'input_filename': synthetic_db, 'output_folder': str(tmp_path / 'output'),
+                      'output_format': 'omezarr2,ometiff'})
+    assert worker.conn.poll(60)
+    assert worker.conn.recv()[0] == 'done'
+    worker.stop()
+    with open(log_filename) as file:
+        imported = [line.split('modules imported by the job: ')[1] for line in file if 'imported by the job' in line]
+    assert len(imported) == 1
+    for module in ['zarr', 'ome_zarr', 'dask', 'tifffile', 'src.']:
+        assert f"'{module}" not in imported[0]
@@ -0,0 +1,355 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import os
+import pytest
+import sqlite3
+import threading
+import time
+
+from src.FanOutSource import FanOutSource
+from src.helper import create_source
+from src.LruCache import LruCache
+from src.read_util import execute_reads, plan_reads
+from src.StagingCache import StagingCache
+from src.synthetic_data import create_image_db
+from src.util import get_region_index
+
+
+def test_plan_reads():
+    reads = [(1000, 100, 'c'), (0, 100, 'a'), (100, 100, 'b'), (5000, 10, 'd'), (5000, 10, 'e')]
+    runs = plan_reads(reads, max_gap=1000, max_size=10000)
+    assert [(start, end, [key for _, _, key in run_reads]) for start, end, run_reads in runs] == \
+           [(0, 1100, ['a', 'b', 'c']), (5000, 5010, ['d', 'e'])]
+    # maximum read size splits runs
+    runs = plan_reads(reads, max_gap=1000, max_size=200)
+    assert [(start, end) for start, end, _ in runs] == [(0, 200), (1000, 1100), (5000, 5010)]
+
+
+def test_execute_reads(tmp_path):
+    content = np.arange(10000, dtype=np.uint8).tobytes()
+    filenames = [str(tmp_path / f'file{index}.bin') for index in range(3)]
+    for filename in filenames:
+        with open(filename, 'wb') as file:
+            file.write(content)
+
+    file_reads = {filename: [(offset, 50, (filename, offset)) for offset in [9000, 10, 100, 3000]]
+                  for filename in filenames}
+    results = {}
+
+    def place(key, buffer):
+        results[key] = bytes(buffer)
+
+    nruns = execute_reads(file_reads, place, max_gap=1000)
+    assert nruns == 3 * 3
+    assert len(results) == 12
+    for (filename, offset), value in results.items():
+        assert value == content[offset:offset + 50]
+
+
+def test_read_region(synthetic_db):
+    # planned bulk reads give the same result as reading each tile separately
+    source = create_source(synthetic_db)
+    metadata = source.init_metadata()
+    dtype = metadata['dtype']
+    well_info = source._read_well_info(source.get_wells()[0])
+    data = source._read_region(well_info)
+    for info in well_info:
+        with open(metadata['image_files'][info['TimeSeriesElementId']], 'rb') as file:
+            file.seek(info['ImageIndex'])
+            tile = np.fromfile(file, dtype=dtype, count=info['SizeX'] * info['SizeY'])
+        timei = metadata['time_points'].index(info['TimeSeriesElementId'])
+        y, x = info['CoordY'], info['CoordX']
+        assert np.array_equal(data[timei, info['ChannelId'], 0, y:y + info['SizeY'], x:x + info['SizeX']],
+                              tile.reshape(info['SizeY'], info['SizeX']))
+
+    region = (slice(0, 2), slice(1, 2), slice(0, 1), slice(100, 200), slice(200, 300))
+    assert np.array_equal(source._read_region(well_info, region), data[region])
+    source.close()
+
+
+def test_db_reader_threads(synthetic_db):
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    wells = source.get_wells()
+    expected = {well_id: source.get_data(well_id, 0).copy() for well_id in wells}
+
+    def read_well(well_id):
+        well_info = source._read_well_info(well_id)
+        assert source.db.fetch_all('SELECT COUNT(*) FROM SourceImageBase WHERE ZoneIndex = ? AND level = 0',
+                                   (source.metadata['wells'][well_id]['ZoneIndex'],),
+                                   return_dicts=False)[0] == len(well_info)
+        return source._read_region(well_info)
+
+    # concurrent readers: one connection per thread, shared metadata query cache
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(read_well, wells * 4))
+    for well_id, data in zip(wells * 4, results):
+        assert np.array_equal(data[(...,) + source._get_site_window(0)], expected[well_id])
+    assert len(source.db.connections) > 1
+
+    with pytest.raises(sqlite3.OperationalError):
+        source.db.fetch_all('DELETE FROM Well')
+    source.close()
+    assert not source.db.connections
+    with pytest.raises(ValueError):
+        source.db.fetch_all('SELECT * FROM Well')
+
+
+def test_lru_cache():
+    cache = LruCache(max_bytes=3000)
+    for key in ['a', 'b', 'c']:
+        cache.get(key, lambda: np.zeros(1000, dtype=np.uint8))
+    cache.get('a', lambda: None)
+    # least recently used 'b' is evicted
+    cache.get('d', lambda: np.zeros(1000, dtype=np.uint8))
+    assert list(cache.entries) == ['c', 'a', 'd']
+    assert cache.get_stats() == {'hits': 1, 'misses': 4, 'evictions': 1, 'entries': 3, 'bytes': 3000,
+                                 'max_bytes': 3000}
+    # an entry over budget is kept on its own
+    cache.get('e', lambda: np.zeros(5000, dtype=np.uint8))
+    assert list(cache.entries) == ['e']
+
+    # concurrent requests for the same key load once
+    loads = []
+    lock = threading.Lock()
+
+    def load():
+        with lock:
+            loads.append(1)
+        time.sleep(0.1)
+        return np.ones(10, dtype=np.uint8)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: cache.get('f', load), range(8)))
+    assert len(loads) == 1
+    assert all(result is results[0] for result in results)
+
+    # a failed load is not left pending: a later request retries
+    def failing_load():
+        raise OSError('read error')
+
+    with pytest.raises(OSError):
+        cache.get('g', failing_load)
+    assert cache.loading == {}
+    assert cache.get('g', lambda: np.ones(10, dtype=np.uint8)).sum() == 10
+
+
+def test_source_cache(synthetic_db):
+    source = create_source(synthetic_db, cache_size=64 * 1024 * 1024)
+    source.init_metadata()
+    wells = source.get_wells()
+    expected = {well_id: source.get_data(well_id, 0).copy() for well_id in wells}
+    # wells revisited out of order and concurrently are served from the cache
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda well_id: source.get_data(well_id, 0), list(reversed(wells)) * 3))
+    for well_id, data in zip(list(reversed(wells)) * 3, results):
+        assert np.array_equal(data, expected[well_id])
+    stats = source.get_cache_stats()
+    assert stats['misses'] == len(wells)
+    assert stats['hits'] == len(wells) * 3
+    # only the (byte bounded) data cache grows with the wells read, not the query cache
+    assert not any(len(values) > 1 for values in source.db.query_cache.values())
+    source.close()
+
+
+def test_get_region(synthetic_db, synthetic_tiff):
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    well_id = source.get_wells()[1]
+    field = source.get_data(well_id, 1)
+    region = source.get_region(well_id, 1, t=1, c=slice(0, 2), y=slice(10, 100), x=slice(50, 250, 2))
+    assert np.array_equal(region, field[1:2, :, :, 10:100, 50:250:2])
+    source.close()
+
+    # lower level: the same tiles as read by a source at that level
+    level_source = create_source(synthetic_db, selection={'level': 2})
+    level_source.init_metadata()
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    region = source.get_region(well_id, 1, c=1, y=slice(10, 40), level=2)
+    assert region.shape == (2, 1, 1, 30, 64)
+    assert np.array_equal(region, level_source.get_data(well_id, 1)[:, 1:2, :, 10:40])
+    with pytest.raises(ValueError):
+        source.get_region(well_id, 1, level=5)
+    source.close()
+    level_source.close()
+
+    source = create_source(synthetic_tiff)
+    source.init_metadata()
+    data = source.get_data()
+    region = source.get_region(c=1, y=slice(100, 300), x=slice(200, 500))
+    assert np.array_equal(region, data[get_region_index(source.get_dim_order(), c=1, y=slice(100, 300),
+                                                        x=slice(200, 500))])
+    source.close()
+
+
+def test_fan_out_source(synthetic_db):
+    source = create_source(synthetic_db)
+    source.init_metadata()
+    shared_source = FanOutSource(source, 3, max_pending=2)
+    keys = [(well_id, field) for well_id in source.get_wells() for field in range(2)]
+
+    def consume(_):
+        return [shared_source.get_data(*key).sum() for key in keys]
+
+    # consumers in parallel get the same data, with each field read once
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(consume, range(3)))
+    assert results[0] == results[1] == results[2]
+    assert results[0] == [source.get_data(*key).sum() for key in keys]
+    assert shared_source.nloads == len(keys)
+    assert not shared_source.pending
+    # delegated source methods
+    assert shared_source.get_wells() == source.get_wells()
+
+    # a failing consumer releases the others
+    shared_source = FanOutSource(source, 2, max_pending=1)
+    shared_source.get_data(*keys[0])
+    shared_source.abort(ValueError('failed'))
+    with pytest.raises(RuntimeError):
+        shared_source.get_data(*keys[1])
+    source.close()
+
+
+def test_fan_out_source_lazy():
+    import dask
+    import dask.array as da
+
+    class LazySource:
+        # a field of 4 x 4 lazily read slabs
+        def __init__(self):
+            self.data = np.random.default_rng(0).integers(0, 1000, (2, 256, 256), dtype=np.uint16)
+            self.nreads = 0
+            self.lock = threading.Lock()
+
+        def read(self, region):
+            with self.lock:
+                self.nreads += 1
+            return self.data[region]
+
+        def get_data(self, well_id=None, field_id=None):
+            return da.block([[[da.from_delayed(dask.delayed(self.read)((slice(None), slice(y, y + 64),
+                                                                        slice(x, x + 64))), (2, 64, 64), np.uint16)
+                               for x in range(0, 256, 64)] for y in range(0, 256, 64)]])
+
+    source = LazySource()
+    shared_source = FanOutSource(source, 2, cache_size=1024 ** 2)
+
+    def consume(block_size):
+        # writers with different block sizes, computing the lazy data block by block
+        data = shared_source.get_data()
+        return np.block([[[data[:, y:y + block_size, x:x + block_size].compute()
+                           for x in range(0, 256, block_size)] for y in range(0, 256, block_size)]])
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(consume, [64, 128]))
+    for result in results:
+        assert np.array_equal(result, source.data)
+    # each slab is read once for both writers
+    assert source.nreads == 16
+
+
+def test_occupancy(tmp_path):
+    missing = {(1, 'B3', 1, 0), (0, 'B2', 0, 1), (0, 'B2', 1, 1), (1, 'B2', 0, 0), (1, 'B2', 0, 1), (1, 'B2', 1, 0),
+               (1, 'B2', 1, 1)}
+    input_filename = create_image_db(str(tmp_path / 'input'), nwells=2, sites_x=2, nchannels=2, ntime_points=2,
+                                     missing=missing)
+    source = create_source(input_filename)
+    source.init_metadata()
+    occupancy = source.get_occupancy()
+    assert occupancy.shape == (2, 2, 2, 2)
+    wells = source.get_wells()
+    for t, welli, field, channel in np.ndindex(occupancy.shape):
+        assert occupancy[t, welli, field, channel] == ((t, wells[welli], field, channel) not in missing)
+    # exact size of the tiles present
+    assert source.get_total_data_size() == occupancy.sum() * 256 * 256 * 2 < source.metadata['max_data_size']
+    # well B2 is not imaged at time point 1
+    matrix = source.print_timepoint_well_matrix().splitlines()
+    assert matrix[1].endswith('+   +') and matrix[2].endswith('    +')
+    source.close()
+
+    source = create_source(input_filename, selection={'channels': [0]}, fuse_fields=True)
+    source.init_metadata()
+    assert source.get_occupancy()[..., 0].tolist() == [[[True], [True]], [[False], [True]]]
+    source.close()
+
+
+def test_well_queries(tmp_path, monkeypatch):
+    # well B2 is not imaged at time point 0
+    missing = {(0, 'B2', site, channel) for site in range(2) for channel in range(2)}
+    input_filename = create_image_db(str(tmp_path / 'input'), nwells=2, sites_x=2, nchannels=2, ntime_points=2,
+                                     missing=missing)
+    reference = create_source(input_filename)
+    reference.init_metadata()
+    source = create_source(input_filename, max_memory=100 * 1024)
+    source.init_metadata()
+    queries = []
+    fetch_all = source.db.fetch_all
+    monkeypatch.setattr(source.db, 'fetch_all', lambda query, *args, **kwargs:
+                        queries.append(query) or fetch_all(query, *args, **kwargs))
+    for well_id in source.get_wells():
+        for field in range(2):
+            assert np.array_equal(np.asarray(source.get_data(well_id, field)), reference.get_data(well_id, field))
+    # a single tile query per field: the well shape is computed once
+    assert len(queries) == 4
+    source.close()
+
+    # not imaged at the selected time point: empty, in the plate shape
+    source = create_source(input_filename, selection={'time_points': (0, 0)})
+    source.init_metadata()
+    data = source.get_data('B2', 0)
+    assert data.shape == source.get_data('B3', 0).shape and not np.any(data)
+    assert source.get_coverage('B2', 0) == []
+    source.close()
+    reference.close()
+
+
+def test_staging_cache(tmp_path, synthetic_db, monkeypatch):
+    staging_folder = str(tmp_path / 'staging')
+    reference = create_source(synthetic_db)
+    reference.init_metadata()
+    source = create_source(synthetic_db, staging_folder=staging_folder)
+    source.init_metadata()
+    well_id = source.get_wells()[0]
+    assert np.array_equal(source.get_data(well_id, 0), reference.get_data(well_id, 0))
+    # tile references keep pointing to the original files
+    assert source.metadata['image_files'] == reference.metadata['image_files']
+    nfiles = 1 + len(source.metadata['image_files'])
+    stats = source.staging.get_stats()
+    assert stats['staged'] == nfiles and stats['reused'] == 0 and stats['copied_bytes'] > 0
+    source.close()
+    reference.close()
+
+    # reused by the next run
+    source = create_source(synthetic_db, staging_folder=staging_folder)
+    source.init_metadata()
+    source.get_data(well_id, 0)
+    assert source.staging.get_stats()['reused'] == nfiles
+    assert source.staging.get_stats()['copied_bytes'] == 0
+    source.close()
+
+    # least recently used files are evicted beyond the budget
+    staging = StagingCache(staging_folder, max_bytes=1)
+    staged_path = staging.get_path(synthetic_db)
+    assert [os.path.basename(entry[1]) for entry in staging._get_entries()] == [os.path.basename(staged_path)]
+
+    # but not while leased by another instance (or process) sharing the folder
+    other_filename = str(tmp_path / 'other.db')
+    with open(other_filename, 'wb') as file:
+        file.write(b'other')
+    other = StagingCache(staging_folder, max_bytes=1)
+    other_path = other.get_path(other_filename)
+    assert os.path.exists(staged_path) and os.path.exists(other_path)
+    staging.close()
+    other.close()
+    staging = StagingCache(staging_folder, max_bytes=1)
+    staging.get_path(other_filename)
+    assert not os.path.exists(staged_path)
+
+    # a failed copy leaves no temporary file
+    monkeypatch.setattr('shutil.copyfileobj', lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        staging.get_path(synthetic_db)
+    assert not [filename for _, _, filenames in os.walk(staging_folder) for filename in filenames
+                if filename.endswith('.tmp')]
+    staging.close()
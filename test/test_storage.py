@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+import zarr
+from zarr.storage import FsspecStore, MemoryStore
+
+from converter import convert
+from src.storage_util import RetryStore
+
+
+class FlakyStore(MemoryStore):
+    def __init__(self, failures=2, **kwargs):
+        super().__init__(**kwargs)
+        self.failures = failures
+
+    async def set(self, key, value):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError('connection reset')
+        await super().set(key, value)
+
+
+@pytest.fixture(scope='module')
+def s3_server():
+    moto_server = pytest.importorskip('moto.server')
+    s3fs = pytest.importorskip('s3fs')
+
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    storage_options = {'key': 'test', 'secret': 'test', 'client_kwargs': {'endpoint_url': f'http://{host}:{port}'}}
+    s3fs.S3FileSystem(**storage_options).mkdir('plates')
+    yield storage_options
+    server.stop()
+
+
+def test_retry_store():
+    store = RetryStore(FlakyStore(failures=2), retries=3, backoff=0)
+    group = zarr.open_group(store, mode='w')
+    group.attrs['test'] = 1
+    assert zarr.open_group(store, mode='r').attrs['test'] == 1
+
+    store = RetryStore(FlakyStore(failures=5), retries=1, backoff=0)
+    with pytest.raises(ConnectionError):
+        zarr.open_group(store, mode='w')
+
+
+@pytest.mark.parametrize('output_format', ['omezarr2', 'omezarr3'])
+def test_convert_s3(tmp_path, synthetic_db, s3_server, output_format):
+    result = convert(synthetic_db, f's3://plates/{output_format}', output_format=output_format,
+                     storage_options=s3_server, upload_concurrency=4, alt_output_folder=str(tmp_path))
+    assert 's3://plates' in result
+
+    url = f's3://plates/{output_format}/Synthetic.ome.zarr'
+    remote = zarr.open_group(FsspecStore.from_url(url, storage_options=s3_server, read_only=True), mode='r')
+    local = zarr.open_group(str(tmp_path / 'Synthetic.ome.zarr'), mode='r')
+    attrs = remote.attrs.asdict()
+    if output_format == 'omezarr3':
+        attrs = attrs['ome']
+    assert len(attrs['plate']['wells']) == 4
+    for well in attrs['plate']['wells']:
+        path = well['path'] + '/0/0'
+        assert np.array_equal(remote[path][:], local[path][:])
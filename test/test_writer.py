@@ -0,0 +1,130 @@
+import json
+import numpy as np
+import pytest
+import zarr
+from zarr.storage import MemoryStore, WrapperStore
+
+from src.ChannelStatistics import ChannelStatistics
+from src.ome_zarr_util import create_axes_metadata, shared_zarr_config
+from src.OmeZarrWriter import OmeZarrWriter
+
+
+class CountingStore(WrapperStore):
+    def __init__(self, store):
+        super().__init__(store)
+        self.writes = []
+
+    async def set(self, key, value):
+        self.writes.append(key)
+        await self._store.set(key, value)
+
+
+class ArraySource:
+    def get_pixel_size_um(self):
+        return {'x': 0.5, 'y': 0.5}
+
+
+def write_pyramid(zarr_version, data, max_memory=None):
+    store = CountingStore(MemoryStore())
+    group = zarr.open_group(store, mode='w', zarr_format=zarr_version)
+    writer = OmeZarrWriter(zarr_version=zarr_version, ome_version='0.5' if zarr_version == 3 else '0.4',
+                           max_memory=max_memory)
+    chunks, blocks = writer._get_chunk_shapes(data.shape, data.dtype)
+    pixel_size_scales, scaler = writer._create_scale_metadata(ArraySource(), 'tczyx', {})
+    writer._write_pyramid(group, data, create_axes_metadata('tczyx'), pixel_size_scales, scaler, chunks, blocks)
+    return group, store, chunks, blocks
+
+
+@pytest.mark.parametrize('zarr_version', [2, 3])
+def test_write_pyramid(zarr_version):
+    data = np.random.default_rng(0).integers(0, 4096, (1, 2, 1, 2500, 3000), dtype=np.uint16)
+    group, store, chunks, blocks = write_pyramid(zarr_version, data)
+    assert np.array_equal(group['0'][:], data)
+
+    data_writes = [key for key in store.writes if not key.endswith(('zarr.json', '.zarray', '.zattrs', '.zgroup'))]
+    level0_writes = [key for key in data_writes if key.startswith('0/')]
+    nchunks = 2 * int(np.ceil(2500 / 1024)) * int(np.ceil(3000 / 1024))
+    if zarr_version == 3:
+        # a single write per shard: all chunks of a channel plane fit in one shard
+        assert len(level0_writes) == 2
+    else:
+        # no reduction for zarr v2: a write per chunk (file)
+        assert len(level0_writes) == nchunks
+    assert len(set(data_writes)) == len(data_writes)
+
+
+def test_chunk_shapes_max_memory():
+    writer = OmeZarrWriter(zarr_version=3, ome_version='0.5', max_memory=16 * 1024 * 1024)
+    chunks, blocks = writer._get_chunk_shapes((1, 2, 1, 20000, 20000), np.dtype(np.uint16))
+    assert chunks == [1, 1, 1, 1024, 1024]
+    assert np.prod(blocks) * 2 <= 4 * 1024 * 1024
+    assert all(block % chunk == 0 for block, chunk in zip(blocks, chunks))
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int16, np.float32])
+def test_channel_statistics(dtype):
+    rng = np.random.default_rng(0)
+    if np.dtype(dtype).kind == 'f':
+        data = rng.random((1, 2, 1, 200, 300)).astype(dtype)
+    else:
+        data = rng.integers(0, 100, (1, 2, 1, 200, 300)).astype(dtype)
+        data[:, 1] += 10
+    statistics = ChannelStatistics(dtype, nchannels=2)
+    # incremental updates per block give the same result as a single update
+    for channeli in range(2):
+        for y in range(0, 200, 64):
+            statistics.update(data[:, channeli:channeli + 1, :, y:y + 64], channel_axis=1, channel_offset=channeli)
+    for channeli in range(2):
+        channel_data = data[:, channeli]
+        window = statistics.get_window(channeli, 1, 99)
+        assert window['min'] == channel_data.min()
+        assert window['max'] == channel_data.max()
+        for key, percentile in [('start', 1), ('end', 99)]:
+            assert window[key] == pytest.approx(np.percentile(channel_data, percentile), abs=2e-3 + 1)
+
+
+@pytest.mark.parametrize('dtype', [np.int8, np.uint16, np.int16])
+def test_channel_statistics_histogram(dtype, monkeypatch):
+    # full value range, counted in several sub-chunks
+    monkeypatch.setattr('src.ChannelStatistics.BINCOUNT_CHUNK_SIZE', 1000)
+    info = np.iinfo(dtype)
+    data = np.random.default_rng(0).integers(info.min, info.max, (2, 50, 70), endpoint=True).astype(dtype)
+    statistics = ChannelStatistics(dtype, nchannels=2)
+    statistics.update(data, channel_axis=0)
+    for channeli in range(2):
+        expected = np.bincount(data[channeli].ravel().astype(np.int64) - info.min, minlength=statistics.nbins)
+        assert np.array_equal(statistics.histograms[channeli], expected)
+
+
+@pytest.mark.parametrize('dtype', [np.uint32, np.int32, np.float32])
+def test_channel_statistics_window(dtype):
+    # bins over the values seen, not the dtype range; growing ranges and combined (part) statistics
+    rng = np.random.default_rng(0)
+    data = (rng.random((2, 300, 300)) * 59900 + 100).astype(dtype)
+    data[1] = data[1] / 1000
+    statistics = ChannelStatistics(dtype, nchannels=2)
+    for y in range(0, 300, 50):
+        statistics.update(data[:, y:y + 50] * (1 + y // 100), channel_axis=0)
+    combined = ChannelStatistics(dtype, nchannels=2)
+    combined.update_from_dict(json.loads(json.dumps(statistics.to_dict())))
+    for channeli in range(2):
+        channel_data = np.concatenate([data[channeli, y:y + 50] * (1 + y // 100) for y in range(0, 300, 50)])
+        value_range = float(channel_data.max() - channel_data.min())
+        for result in [statistics, combined]:
+            window = result.get_window(channeli, 1, 99)
+            assert window['min'] <= window['start'] < window['end'] <= window['max']
+            for key, percentile in [('start', 1), ('end', 99)]:
+                assert window[key] == pytest.approx(np.percentile(channel_data, percentile), abs=0.01 * value_range)
+
+
+def test_shared_zarr_config():
+    default = zarr.config.get('async.concurrency')
+    with shared_zarr_config({'async.concurrency': 3}):
+        # concurrent writers with the same configuration share it
+        with shared_zarr_config({'async.concurrency': 3}):
+            assert zarr.config.get('async.concurrency') == 3
+        with pytest.raises(ValueError, match='Conflicting'):
+            with shared_zarr_config({'async.concurrency': 5}):
+                pass
+        assert zarr.config.get('async.concurrency') == 3
+    assert zarr.config.get('async.concurrency') == default
@@ -0,0 +1,30 @@
+import sys
+import argparse
+import json
+import os
+
+from converter import init_logging
+from src.checksum_util import verify_output
+
+
+parser = argparse.ArgumentParser(description='Verify ome-zarr output against its checksum manifest')
+parser.add_argument('--outputpath', required=True, help='ome-zarr path or url, converted with --checksums')
+parser.add_argument('--inputfile', help='source file: also check a sample of source tiles against the source files')
+parser.add_argument('--samples', type=int, default=100, help='number of source tiles to check')
+parser.add_argument('--workers', type=int, help='number of parallel checks')
+parser.add_argument('--storage_options', help='fsspec storage options for output urls, as json string')
+parser.add_argument('--verbose', action='store_true')
+args = parser.parse_args()
+
+init_logging('db_to_zarr.log', verbose=args.verbose)
+
+result = verify_output(
+    args.outputpath,
+    source_folder = os.path.dirname(args.inputfile) if args.inputfile else None,
+    nsamples = args.samples,
+    max_workers = args.workers,
+    storage_options = json.loads(args.storage_options) if args.storage_options else None
+)
+
+print(json.dumps(result))
+sys.exit(0 if result['valid'] else 1)